@@ -1,24 +1,153 @@
-import argparse
-import sys ,json ,hashlib,zlib,time
+import argparse,asyncio
+import sys ,json ,hashlib,zlib,time,os,struct,mmap,tempfile,bisect,heapq,threading,re,sqlite3
+import ctypes,select,socket,subprocess,shlex,functools,itertools,random,io,math,shutil
+from abc import ABC,abstractmethod
+from collections import deque,OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager,redirect_stdout
 from pathlib import Path
-from typing import Dict,List,Tuple
+from typing import Dict,Iterator,List,Tuple
+
+
+class Trace:
+    # per-phase timings for --profile (or PYGIT_PROFILE=1), a no-op unless enabled
+    # times are exclusive: while a nested phase runs the enclosing one is paused, so the phases add up
+    # to the traced time; worker threads keep their own phase stack and their time is summed in
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.times: Dict[str,float] = {}
+        self.calls: Dict[str,int] = {}
+        self.counters: Dict[str,int] = {}
+
+    def phase(self,name:str):
+        return _TracePhase(self,name) if self.enabled else _NO_PHASE
+
+    def count(self,name:str,n:int = 1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name,0) + n
+
+    def _stack(self)->list:
+        stack = getattr(self.local,"stack",None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _add(self,name:str,seconds:float,calls:int):
+        with self.lock:
+            self.times[name] = self.times.get(name,0.0) + seconds
+            self.calls[name] = self.calls.get(name,0) + calls
+
+    def report(self,out,wall:float = None,extra:Dict[str,Dict[str,int]] = None):
+        total = sum(self.times.values())
+        if wall is not None:
+            print(f"{'wall':<20}{wall * 1000:>10.1f} ms",file=out)
+        print(f"{'phase':<20}{'ms':>10}{'calls':>9}{'share':>8}",file=out)
+        for name,seconds in sorted(self.times.items(),key=lambda item: -item[1]):
+            share = seconds / total * 100 if total else 0
+            print(f"{name:<20}{seconds * 1000:>10.1f}{self.calls.get(name,0):>9}{share:>7.1f}%",file=out)
+        for name,value in sorted(self.counters.items()):
+            print(f"{name:<20}{value:>10}",file=out)
+        for group,values in (extra or {}).items():
+            print(f"{group}: " + ", ".join(f"{key} {value}" for key,value in values.items()),file=out)
+
+
+class _TracePhase:
+    __slots__ = ("trace","name")
+
+    def __init__(self,trace:Trace,name:str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        stack = self.trace._stack()
+        now = time.perf_counter()
+        if stack:
+            outer = stack[-1]
+            self.trace._add(outer[0],now - outer[1],0)
+        stack.append([self.name,now])
+
+    def __exit__(self,*exc):
+        stack = self.trace._stack()
+        now = time.perf_counter()
+        name,start = stack.pop()
+        self.trace._add(name,now - start,1)
+        if stack:
+            stack[-1][1] = now
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self,*exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+TRACE = Trace()
+
+def traced(name:str):
+    #a whole function as one TRACE phase
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args,**kwargs):
+            with TRACE.phase(name):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorate
+
+
+def locks_index(wait:bool=True):
+    #a Repository method that reads, changes and writes the index does it all under index.lock (see index_lock)
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(self,*args,**kwargs):
+            with self.index_lock(wait):
+                return func(self,*args,**kwargs)
+        return wrapper
+    return decorate
 
 
 class GitObject:
+    #__slots__: no per-object __dict__, log/status/checkout create one of these for every object they read
+    __slots__ = ("type","_content","_hash")
+
     def __init__(self,obj_type:str,content:bytes):
         self.type = obj_type
         self.content = content
+
+    @property
+    def content(self)->bytes:
+        return self._content
+
+    @content.setter
+    def content(self,content:bytes):
+        self._content = content
+        self._hash = None
     
     def hash(self)->str:
-        #f(<type> <size> \0<content>)
-        header = f"{self.type} {len(self.content)}\0".encode()
-        return hashlib.sha1(header + self.content).hexdigest()
+        #f(<type> <size> \0<content>), computed once per object
+        if self._hash is None:
+            content = self.content
+            sha = hashlib.sha1(f"{self.type} {len(content)}\0".encode())
+            sha.update(content) #no header + content copy
+            self._hash = sha.hexdigest()
+        return self._hash
     
 
     def serialize(self)->bytes: 
         #lossless compression
-        header = f"{self.type} {len(self.content)}\0".encode()
-        return zlib.compress(header + self.content)
+        content = self.content
+        compressor = zlib.compressobj()
+        return compressor.compress(f"{self.type} {len(content)}\0".encode()) + compressor.compress(content) + compressor.flush()
     
     @classmethod
     # because we nedd to apply the logic to entire class not a aprticular object
@@ -34,114 +163,2606 @@ class GitObject:
     
 class Blob(GitObject):
     #(Binary Large object)
+    __slots__ = ()
+
     def __init__(self,content:bytes):
         super().__init__('blob',content)
     
     def get_content(self)->bytes:
         return self.content
 
-class Tree(GitObject):
-    #Tree object for hierarchy
-    
-    def __init__(self,entries:List[Tuple[str,str,str]]=None):
-        self.entries = entries or []
-        content = self._serialize_entries() #of the entire list contains multiple files folder 
-        super().__init__('tree',content)
-        
-    def _serialize_entries(self)->bytes:
-        #<mode> <name>\0<hash><mode> <name>\0<hash><mode> <name>\0<hash> tree content is like this
-        #why sorted to give (a.txt,b.txt) or we do (b.txt,a.txt) hash reamins same
-        content = b""
-        for mode,name,obj_hash in sorted(self.entries):
-            content += f"{mode} {name}\0".encode()
-            content += bytes.fromhex(obj_hash)#hash is hexa_Decimal so we convert back to bytes
-        return content
-    
-    def add_entry(self,mode:str,name:str,obj_hash:str):
-        self.entries.append((mode,name,obj_hash))
-        self.content = self._serialize_entries() #directly changing the content variable og gitobj class
+class Tree(GitObject):
+    #Tree object for hierarchy
+    #content is serialized from the entries only when it is needed (hash/serialize), and a tree read
+    #from the database keeps its raw content and only parses entries if somebody asks for them
+    ENTRY_MODES = ("100644","100755","120000","40000")
+    __slots__ = ("_entries","_offsets")
+    
+    def __init__(self,entries:List[Tuple[str,str,str]]=None):
+        self._entries = entries or []
+        self._offsets = None
+        super().__init__('tree',None) #content is built lazily
+
+    @property
+    def content(self)->bytes:
+        if self._content is None:
+            self._content = self._serialize_entries() #of the entire list contains multiple files folder 
+        return self._content
+
+    @content.setter
+    def content(self,content:bytes):
+        self._content = content
+        self._offsets = None
+        self._hash = None
+
+    @property
+    def entries(self)->List[Tuple[str,str,str]]:
+        if self._entries is None:
+            self._entries = list(self.iter_entries(self._content))
+        return self._entries
+        
+    def _serialize_entries(self)->bytes:
+        #<mode> <name>\0<hash><mode> <name>\0<hash><mode> <name>\0<hash> tree content is like this
+        #why sorted to give (a.txt,b.txt) or we do (b.txt,a.txt) hash reamins same
+        #one join over the encoded entries instead of growing bytes with +=, linear in the size of the tree
+        #hash is hexa_Decimal so we convert back to bytes
+        return b"".join(
+            f"{mode} {name}\0".encode() + bytes.fromhex(obj_hash)
+            for mode,name,obj_hash in sorted(self._entries)
+        )
+    
+    def add_entry(self,mode:str,name:str,obj_hash:str):
+        self.entries.append((mode,name,obj_hash))
+        self.content = None #serialized again on next use, not on every append
+
+    @staticmethod
+    def iter_entries(content:bytes):
+        # 100644 README.md\0[20bytes of content hash]100644 xyz.md\0[20bytes of content hash]
+        #slices of the memoryview are decoded in place, no intermediate bytes copies
+        view = memoryview(content)
+        i = 0
+        while i < len(content):
+            null_idx = content.find(b"\0",i)
+            if null_idx == -1:
+                break
+            mode,name = str(view[i:null_idx],"utf-8").split(' ',1)
+            yield mode,name,view[null_idx + 1 : null_idx + 21].hex()
+            i = null_idx + 21
+
+    @classmethod
+    # because we nedd to apply the logic to entire class not a particular object
+    def from_content(cls,content:bytes)->"Tree": 
+        tree = cls() # empty instance of the class being assigned to the variable name tree
+        tree._entries = None #parsed on first access
+        tree.content = content
+        return tree
+
+    def _entry_offsets(self)->List[int]:
+        #start of every entry, found by jumping from \0 to \0 without decoding anything
+        if self._offsets is None:
+            content = self.content
+            offsets = []
+            i = 0
+            while i < len(content):
+                null_idx = content.find(b"\0",i)
+                if null_idx == -1:
+                    break
+                offsets.append(i)
+                i = null_idx + 21
+            self._offsets = offsets
+        return self._offsets
+
+    def find(self,name:str)->Tuple[str,str]:
+        #(mode,hash) of one entry or None
+        #entries are sorted by (mode,name) so "<mode> <name>" keys are in byte order: one binary search per mode
+        content = self.content
+        offsets = self._entry_offsets()
+        for mode in self.ENTRY_MODES:
+            key = f"{mode} {name}".encode()
+            lo,hi = 0,len(offsets)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = offsets[mid]
+                null_idx = content.find(b"\0",start)
+                entry_key = content[start:null_idx]
+                if entry_key < key:
+                    lo = mid + 1
+                elif entry_key > key:
+                    hi = mid
+                else:
+                    return mode,content[null_idx + 1:null_idx + 21].hex()
+        return None
+
+
+class Commit(GitObject):
+    #a commit read from the database keeps its raw bytes, the header is only parsed when a field is
+    #read and the message only decoded when it is asked for. A new commit is serialized on first use.
+    __slots__ = ("_tree_hash","_parent_hashes","_author","_committer","_timestamp","_message","_message_start","_parsed")
+
+    def __init__(
+            self,
+            tree_hash:str,
+            parent_hashes:List[str],
+            author:str,
+            committer:str,
+            message:str,
+            timestamp:int = None,
+        ):
+            self._tree_hash = tree_hash
+            self._parent_hashes = parent_hashes 
+            self._author = author
+            self._committer=committer
+            self._message = message
+            self._timestamp =timestamp or int(time.time())
+            self._parsed = True
+
+            super().__init__("commit",None) #content is built lazily
+
+    @property
+    def content(self)->bytes:
+        if self._content is None:
+            self._content = self._serialize_commit()
+        return self._content
+
+    @content.setter
+    def content(self,content:bytes):
+        self._content = content
+        self._hash = None
+        
+    def _serialize_commit(self):
+        lines = [f"tree {self.tree_hash}"]
+        for parent in self.parent_hashes:
+            lines.append(f"parent {parent}")   
+        lines.append(f"author {self.author} {self.timestamp} +0000")
+        lines.append(f"committer {self.committer} {self.timestamp} +0000")
+        lines.append("")
+        lines.append(self.message)
+
+        return "\n".join(lines).encode()
+    
+    @classmethod
+    def from_content(cls,content:bytes)->"Commit":
+        #no parsing and no re-serializing here, just keep the bytes
+        commit = cls.__new__(cls)
+        commit.type = "commit"
+        commit.content = content
+        commit._message = None
+        commit._parsed = False
+        return commit
+
+    def _parse(self):
+        content = self._content
+        #headers end at the first empty line, the message is everything after it
+        header_end = content.find(b"\n\n")
+        if header_end == -1:
+            header_end = self._message_start = len(content)
+        else:
+            self._message_start = header_end + 2
+        self._tree_hash = None
+        self._parent_hashes = []
+        self._author = None
+        self._committer =None
+        self._timestamp = None
+
+        for line in content[:header_end].split(b"\n"):
+            if line.startswith(b"tree "):
+                self._tree_hash = line[5:].decode()
+            elif line.startswith(b"parent "):
+                self._parent_hashes.append(line[7:].decode())
+            elif line.startswith(b"author "):
+                author_parts = line[7:].decode().rsplit(" ",2)
+                self._author = author_parts[0]
+                self._timestamp = int(author_parts[1])
+            elif line.startswith(b"committer "):
+                commit_parts = line[10:].decode().rsplit(" ",2)
+                self._committer = commit_parts[0]
+        self._parsed = True
+
+    @property
+    def tree_hash(self)->str:
+        if not self._parsed:
+            self._parse()
+        return self._tree_hash
+
+    @property
+    def parent_hashes(self)->List[str]:
+        if not self._parsed:
+            self._parse()
+        return self._parent_hashes
+
+    @property
+    def author(self)->str:
+        if not self._parsed:
+            self._parse()
+        return self._author
+
+    @property
+    def committer(self)->str:
+        if not self._parsed:
+            self._parse()
+        return self._committer
+
+    @property
+    def timestamp(self)->int:
+        if not self._parsed:
+            self._parse()
+        return self._timestamp
+
+    @property
+    def message(self)->str:
+        if self._message is None:
+            if not self._parsed:
+                self._parse()
+            self._message = self._content[self._message_start:].decode()
+        return self._message
+            
+
+class IgnoreRules:
+    # .pygitignore patterns compiled once to regexes, gitignore style, the last matching rule wins
+    #   name       that name at any depth (an ignored directory hides everything under it)
+    #   dir/       directories only
+    #   /name a/b  anchored at the repository root
+    #   * ? [..]   inside one path component, ** across components, !pattern re-includes
+    def __init__(self,lines:List[str]):
+        self.rules: List[Tuple[re.Pattern,bool,bool]] = [] # (regex,negate,directory only)
+        for line in lines:
+            pattern = line.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            negate = pattern.startswith("!")
+            if negate:
+                pattern = pattern[1:]
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            if not pattern:
+                continue
+            anchored = "/" in pattern
+            regex = self._translate(pattern.lstrip("/"))
+            if not anchored:
+                regex = "(?:.*/)?" + regex
+            self.rules.append((re.compile(regex),negate,dir_only))
+
+    @staticmethod
+    def _translate(pattern:str)->str:
+        out = []
+        i = 0
+        while i < len(pattern):
+            c = pattern[i]
+            if pattern.startswith("**/",i):
+                out.append("(?:.*/)?")
+                i += 3
+            elif pattern.startswith("**",i):
+                out.append(".*")
+                i += 2
+            elif c == "*":
+                out.append("[^/]*")
+                i += 1
+            elif c == "?":
+                out.append("[^/]")
+                i += 1
+            elif c == "[" and pattern.find("]",i + 1) != -1:
+                end = pattern.find("]",i + 1)
+                chars = pattern[i + 1:end]
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                out.append("[" + chars.replace("\\","\\\\") + "]")
+                i = end + 1
+            elif c == "\\" and i + 1 < len(pattern):
+                out.append(re.escape(pattern[i + 1]))
+                i += 2
+            else:
+                out.append(re.escape(c))
+                i += 1
+        return "".join(out)
+
+    def is_ignored(self,rel_path:str,is_dir:bool = False)->bool:
+        ignored = False
+        for regex,negate,dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.fullmatch(rel_path):
+                ignored = not negate
+        return ignored
+
+
+class SparseCone:
+    # cone-mode sparse checkout, .pygit/info/sparse-checkout lists directories one per line:
+    # everything under a listed directory is checked out, plus the files directly inside the root and inside
+    # every parent of a listed directory; the rest only lives in the index (a sparse index keeps each such
+    # directory as one entry) and is never read, written or stat'ed in the working tree
+    def __init__(self,dirs:List[str]):
+        self.dirs = sorted({dir_path.strip().strip("/") for dir_path in dirs if dir_path.strip().strip("/")})
+        self.recursive = set(self.dirs)
+        self.parents = {""}
+        for dir_path in self.dirs:
+            end = dir_path.find("/")
+            while end != -1:
+                self.parents.add(dir_path[:end])
+                end = dir_path.find("/",end + 1)
+
+    def includes_dir(self,dir_path:str)->bool:
+        #something under dir_path is checked out; a directory this says no to is out of the cone as a whole
+        if dir_path in self.parents or dir_path in self.recursive:
+            return True
+        end = dir_path.find("/")
+        while end != -1:
+            if dir_path[:end] in self.recursive:
+                return True
+            end = dir_path.find("/",end + 1)
+        return False
+
+    def contains(self,path:str)->bool:
+        #the file is checked out, never true for a "dir/" entry of a sparse index
+        return self.includes_dir(path.rpartition("/")[0]) and not path.endswith("/")
+
+
+class Index(dict):
+    # staging area: path -> blob hash, plus the stat data of the file at the time it was staged
+    # so status can skip rehashing files whose stat did not change
+    # on disk: header | sorted entries | extensions | sha1 trailer
+    # entry: mtime_ns ctime_ns inode size st_mode tree_mode sha(20 bytes) path_len path
+    # (version 1 had no tree_mode, every entry was a regular 100644 file)
+    # TREE extension (cache tree): directory -> (tree hash, number of index entries under it)
+    # UNTR extension (untracked cache): directory -> (mtime, files, subdirectories) as last listed,
+    # together with the digest of the ignore rules that listing was filtered with
+    # FSMN extension: fsmonitor token of the last status and the paths not known to be clean at that point
+    # SDIR extension: sparse index, directories outside the sparse-checkout cone are single "dir/" entries
+    # with mode 40000 and the hash of their tree
+    SIGNATURE = b"PIDX"
+    VERSION = 2
+    HEADER = struct.Struct(">4sII")
+    ENTRY = struct.Struct(">qqQQII20sH")
+    ENTRY_V1 = struct.Struct(">qqQQI20sH")
+    EXTENSION = struct.Struct(">4sI")
+
+    def __init__(self,entries:Dict[str,str]=None):
+        super().__init__(entries or {})
+        self.stats: Dict[str,Tuple[int,int,int,int,int]] = {}
+        #tree mode of entries that are not plain 100644 files (executables)
+        self.modes: Dict[str,str] = {}
+        #mtime of the index file when it was read, entries modified in the same tick are not trusted
+        self.timestamp = 0
+        #"" is the root directory, entries are dropped along the path of every changed file
+        self.cache_tree: Dict[str,Tuple[str,int]] = {}
+        self.untracked_cache: Dict[str,Tuple[int,List[str],List[str]]] = {}
+        self.untracked_digest = b"\0" * 20
+        #every entry not in fsmonitor_dirty matched the working tree when fsmonitor_token was handed out
+        self.fsmonitor_token = None
+        self.fsmonitor_dirty = set()
+        self.sparse = False
+        #sorted list of the entry paths, kept up to date once built so repeated tree writes do not re-sort
+        self._sorted_paths = None
+        #directories that have (or had) entries under them, built when a conflict check first needs it
+        self._dirs = None
+
+    @staticmethod
+    def stat_key(st:os.stat_result)->Tuple[int,int,int,int,int]:
+        return (st.st_mtime_ns,st.st_ctime_ns,st.st_ino,st.st_size,st.st_mode)
+
+    def __setitem__(self,path:str,blob_hash:str):
+        if self.get(path) != blob_hash:
+            self.invalidate_tree(path)
+        if path not in self:
+            if self._sorted_paths is not None:
+                bisect.insort(self._sorted_paths,path)
+        #a new hash without a stat means the recorded stat no longer describes it
+        super().__setitem__(path,blob_hash)
+        self.stats.pop(path,None)
+        self.fsmonitor_dirty.add(path)
+
+    def __delitem__(self,path:str):
+        super().__delitem__(path)
+        if self._sorted_paths is not None:
+            del self._sorted_paths[bisect.bisect_left(self._sorted_paths,path)]
+        self.stats.pop(path,None)
+        self.modes.pop(path,None)
+        self.invalidate_tree(path)
+        self.fsmonitor_dirty.add(path)
+
+    def sorted_paths(self)->List[str]:
+        #shared with the index, callers must not modify it
+        if self._sorted_paths is None:
+            self._sorted_paths = sorted(self)
+        return self._sorted_paths
+
+    def mode(self,path:str)->str:
+        return self.modes.get(path,"100644")
+
+    def _set_mode(self,path:str,mode:str):
+        if mode != self.mode(path):
+            self.invalidate_tree(path)
+        if mode == "100644":
+            self.modes.pop(path,None)
+        else:
+            self.modes[path] = mode
+
+    def invalidate_tree(self,path:str):
+        #every directory above path now has a different tree
+        self.cache_tree.pop("",None)
+        end = path.find("/")
+        while end != -1:
+            self.cache_tree.pop(path[:end],None)
+            end = path.find("/",end + 1)
+
+    def set_entry(self,path:str,blob_hash:str,st:os.stat_result=None,mode:str=None):
+        #without an explicit mode it follows the executable bit of the file
+        if mode is None and st is not None:
+            mode = "100755" if st.st_mode & 0o111 else "100644"
+        if path not in self:
+            self._drop_conflicts(path)
+        self[path] = blob_hash
+        if mode is not None:
+            self._set_mode(path,mode)
+        if st is not None:
+            self.stats[path] = self.stat_key(st)
+
+    def _drop_conflicts(self,path:str):
+        #a path is a file or a directory, never both: a file replaces whatever was under its name and a file
+        #under a directory replaces a file of that directory's name (a sparse "dir/" entry counts as its directory)
+        name = path.rstrip("/")
+        if self._dirs is None:
+            self._dirs = set()
+            for tracked in self:
+                parent = tracked.rstrip("/")
+                while "/" in parent:
+                    parent = parent.rpartition("/")[0]
+                    self._dirs.add(parent)
+        #replacing a whole directory with a file is rare, only then are the entries looked for
+        if name in self._dirs:
+            for nested in [tracked for tracked in self if tracked.startswith(name + "/") and tracked != path]:
+                del self[nested]
+            if name == path:
+                self._dirs.discard(name)
+        if name != path:
+            if name in self:
+                del self[name]
+            self._dirs.add(name)
+        #a known directory has no file of its name and neither has any directory above it
+        parent = name.rpartition("/")[0]
+        while parent and parent not in self._dirs:
+            if parent in self:
+                del self[parent]
+            self._dirs.add(parent)
+            parent = parent.rpartition("/")[0]
+
+    def refresh_stat(self,path:str,st:os.stat_result)->bool:
+        #content is known to match, remember the new stat unless that would silently stage a chmod
+        #False for a chmod: the file differs from the index by its mode
+        if ("100755" if st.st_mode & 0o111 else "100644") != self.mode(path):
+            return False
+        self.stats[path] = self.stat_key(st)
+        return True
+
+    def is_unchanged(self,path:str,st:os.stat_result)->bool:
+        recorded = self.stats.get(path)
+        if recorded is None or recorded != self.stat_key(st):
+            return False
+        #racy clean: the file could have changed again after we hashed it within the same mtime tick
+        return recorded[0] < self.timestamp
+
+    def to_bytes(self)->bytes:
+        parts = [self.HEADER.pack(self.SIGNATURE,self.VERSION,len(self))]
+        for path in sorted(self):
+            mtime,ctime,ino,size,mode = self.stats.get(path,(0,0,0,0,0))
+            encoded_path = path.encode()
+            tree_mode = int(self.mode(path),8)
+            parts.append(self.ENTRY.pack(mtime,ctime,ino,size,mode,tree_mode,bytes.fromhex(self[path]),len(encoded_path)))
+            parts.append(encoded_path)
+        for signature,data in self._extensions():
+            parts.append(self.EXTENSION.pack(signature,len(data)))
+            parts.append(data)
+        content = b"".join(parts)
+        return content + hashlib.sha1(content).digest()
+
+    def _extensions(self)->List[Tuple[bytes,bytes]]:
+        extensions = []
+        if self.cache_tree:
+            parts = []
+            for dir_path,(tree_hash,count) in sorted(self.cache_tree.items()):
+                parts.append(dir_path.encode() + b"\0" + struct.pack(">I",count) + bytes.fromhex(tree_hash))
+            extensions.append((b"TREE",b"".join(parts)))
+        if self.untracked_cache:
+            parts = [self.untracked_digest]
+            for dir_path,(mtime,files,dirs) in sorted(self.untracked_cache.items()):
+                parts.append(dir_path.encode() + b"\0" + struct.pack(">qII",mtime,len(files),len(dirs)))
+                parts.extend(name.encode() + b"\0" for name in files + dirs)
+            extensions.append((b"UNTR",b"".join(parts)))
+        if self.fsmonitor_token is not None:
+            names = [self.fsmonitor_token] + sorted(self.fsmonitor_dirty)
+            extensions.append((b"FSMN",b"".join(name.encode() + b"\0" for name in names)))
+        if self.sparse:
+            extensions.append((b"SDIR",b""))
+        return extensions
+
+    def _read_extension(self,signature:bytes,data:bytes):
+        if signature == b"TREE":
+            pos = 0
+            while pos < len(data):
+                null_idx = data.index(b"\0",pos)
+                count, = struct.unpack_from(">I",data,null_idx + 1)
+                tree_hash = data[null_idx + 5:null_idx + 25].hex()
+                self.cache_tree[data[pos:null_idx].decode()] = (tree_hash,count)
+                pos = null_idx + 25
+        elif signature == b"UNTR":
+            self.untracked_digest = data[:20]
+            pos = 20
+            while pos < len(data):
+                null_idx = data.index(b"\0",pos)
+                dir_path = data[pos:null_idx].decode()
+                mtime,file_count,dir_count = struct.unpack_from(">qII",data,null_idx + 1)
+                pos = null_idx + 17
+                names = []
+                for _ in range(file_count + dir_count):
+                    null_idx = data.index(b"\0",pos)
+                    names.append(data[pos:null_idx].decode())
+                    pos = null_idx + 1
+                self.untracked_cache[dir_path] = (mtime,names[:file_count],names[file_count:])
+        elif signature == b"FSMN":
+            names = data.decode().split("\0")[:-1]
+            self.fsmonitor_token = names[0]
+            self.fsmonitor_dirty = set(names[1:])
+        elif signature == b"SDIR":
+            self.sparse = True
+        #unknown extensions are optional caches, safe to drop
+
+    @classmethod
+    def from_bytes(cls,data:bytes)->"Index":
+        content,checksum = data[:-20],data[-20:]
+        if hashlib.sha1(content).digest() != checksum:
+            raise ValueError("index checksum mismatch")
+        signature,version,count = cls.HEADER.unpack_from(content,0)
+        if signature != cls.SIGNATURE or version not in (1,cls.VERSION):
+            raise ValueError("unknown index format")
+
+        index = cls()
+        pos = cls.HEADER.size
+        for _ in range(count):
+            if version == 1:
+                mtime,ctime,ino,size,mode,sha,path_len = cls.ENTRY_V1.unpack_from(content,pos)
+                tree_mode = 0o100644
+                pos += cls.ENTRY_V1.size
+            else:
+                mtime,ctime,ino,size,mode,tree_mode,sha,path_len = cls.ENTRY.unpack_from(content,pos)
+                pos += cls.ENTRY.size
+            path = content[pos:pos + path_len].decode()
+            pos += path_len
+            dict.__setitem__(index,path,sha.hex())
+            if tree_mode != 0o100644:
+                index.modes[path] = f"{tree_mode:o}"
+            if mode:
+                index.stats[path] = (mtime,ctime,ino,size,mode)
+
+        while pos < len(content):
+            signature,length = cls.EXTENSION.unpack_from(content,pos)
+            pos += cls.EXTENSION.size
+            index._read_extension(signature,content[pos:pos + length])
+            pos += length
+        return index
+
+
+#pack entry types, 6 and 7 are deltas against another object
+PACK_TYPES = {"commit":1,"tree":2,"blob":3}
+PACK_TYPE_NAMES = {code:name for name,code in PACK_TYPES.items()}
+OFS_DELTA = 6
+REF_DELTA = 7
+PACK_HEADER = struct.Struct(">4sII")
+IDX_MAGIC = b"\377tOc"
+DELTA_BLOCK = 16 #bytes of the base indexed at a time when searching for copies
+MAX_COPY = 0xffffff
+
+
+def _encode_varint(value:int)->bytes:
+    #little endian 7 bits per byte, used in delta headers
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def _decode_varint(data:bytes,pos:int)->Tuple[int,int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value,pos
+
+def _encode_copy(offset:int,size:int)->bytes:
+    #copy op: 0x80 | which offset/size bytes follow, zero bytes are left out
+    cmd = 0x80
+    args = bytearray()
+    for i in range(4):
+        byte = (offset >> (8 * i)) & 0xff
+        if byte:
+            cmd |= 1 << i
+            args.append(byte)
+    for i in range(3):
+        byte = (size >> (8 * i)) & 0xff
+        if byte:
+            cmd |= 0x10 << i
+            args.append(byte)
+    return bytes([cmd]) + bytes(args)
+
+def delta_index(base:bytes)->Dict[bytes,int]:
+    #block -> first offset in base, built once per base when it is tried against several targets
+    blocks = {}
+    for offset in range(0,len(base) - DELTA_BLOCK + 1,DELTA_BLOCK):
+        blocks.setdefault(base[offset:offset + DELTA_BLOCK],offset)
+    return blocks
+
+def create_delta(base:bytes,target:bytes,max_size:int=None,blocks:Dict[bytes,int]=None)->bytes:
+    # delta = src size, target size, then copy(offset,size) from base / insert(literal bytes) ops
+    # returns None as soon as the delta would grow past max_size, the caller stores the object whole then
+    # blocks: delta_index(base) if the caller already has it
+    out = bytearray(_encode_varint(len(base)) + _encode_varint(len(target)))
+    if blocks is None:
+        blocks = delta_index(base)
+    #literal bytes the pending insert may still take before the delta is too big
+    room = max_size - len(out) if max_size is not None else len(target)
+
+    def flush_insert(start:int,end:int):
+        while start < end:
+            chunk = target[start:min(end,start + 127)]
+            out.append(len(chunk))
+            out.extend(chunk)
+            start += len(chunk)
+
+    insert_start = 0
+    i = 0
+    last = len(target) - DELTA_BLOCK
+    while i <= last:
+        base_offset = blocks.get(target[i:i + DELTA_BLOCK])
+        if base_offset is None:
+            #on to the next position starting a base block; a target with nothing in common gives up once
+            #the pending insert alone is too big instead of after walking all of it
+            stop = min(last,insert_start + room)
+            i = next((j for j in range(i + 1,stop + 1) if target[j:j + DELTA_BLOCK] in blocks),stop + 1)
+            if i - insert_start > room:
+                return None
+            continue
+        #grow the match forwards, 64 bytes at a time first
+        length = DELTA_BLOCK
+        limit = min(len(base) - base_offset,len(target) - i)
+        while length + 64 <= limit and base[base_offset + length:base_offset + length + 64] == target[i + length:i + length + 64]:
+            length += 64
+        while length < limit and base[base_offset + length] == target[i + length]:
+            length += 1
+        #and backwards into bytes we were about to insert
+        while i > insert_start and base_offset > 0 and base[base_offset - 1] == target[i - 1]:
+            i -= 1
+            base_offset -= 1
+            length += 1
+
+        flush_insert(insert_start,i)
+        while length:
+            size = min(length,MAX_COPY)
+            out.extend(_encode_copy(base_offset,size))
+            base_offset += size
+            i += size
+            length -= size
+        insert_start = i
+        if max_size is not None:
+            room = max_size - len(out)
+            if room < 0:
+                return None
+    flush_insert(insert_start,len(target))
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+def apply_delta(base:bytes,delta:bytes)->bytes:
+    src_size,pos = _decode_varint(delta,0)
+    dst_size,pos = _decode_varint(delta,pos)
+    if src_size != len(base):
+        raise ValueError("delta base size mismatch")
+    out = bytearray()
+    while pos < len(delta):
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif cmd:
+            out += delta[pos:pos + cmd]
+            pos += cmd
+        else:
+            raise ValueError("invalid delta opcode")
+    if len(out) != dst_size:
+        raise ValueError("delta result size mismatch")
+    return bytes(out)
+
+
+#content-defined chunking of big blobs (FastCDC): a gear hash rolls over the data and a chunk ends where its
+#low bits are all zero, so an edit only changes the chunks around it and the rest dedupe against older revisions
+GEAR = [int.from_bytes(hashlib.sha1(bytes([i])).digest()[:2],"little") for i in range(256)]
+GEAR_LOW = bytes(value & 0xFF for value in GEAR)
+GEAR_HIGH = bytes(value >> 8 for value in GEAR)
+GEAR_WINDOW = 16 #h = (h << 1) + GEAR[byte] kept to 16 bits only depends on the last 16 bytes
+
+
+def _gear_cut_candidates(data:bytes,mask:int)->List[Tuple[int,int]]:
+    #(i,hash) for every position whose gear hash has none of the mask bits set (mask covers the low byte)
+    #all positions are hashed at once instead of byte by byte: every byte's gear value sits in a 32 bit
+    #lane of one big int, adding it to itself shifted by 1,2,4,8 lanes (+1 bit each) sums the 16 shifted
+    #values of a window into each lane, a lane never exceeds 32 bits so no carry leaks into the next one
+    n = len(data)
+    lanes = bytearray(4 * n)
+    lanes[0::4] = data.translate(GEAR_LOW)
+    lanes[1::4] = data.translate(GEAR_HIGH)
+    total = int.from_bytes(lanes,"little")
+    for step in (1,2,4,8):
+        total += total << (33 * step)
+    hashes = total.to_bytes(4 * (n + 2 * GEAR_WINDOW),"little")
+    low = hashes[0:4 * n:4]
+    high = hashes[1:4 * n:4]
+    found = []
+    i = low.find(0)
+    while i != -1:
+        value = high[i] << 8
+        if not value & mask:
+            found.append((i,value))
+        i = low.find(0,i + 1)
+    return found
+
+
+class Chunker:
+    # splits a stream into chunks of min..max bytes around an average, cut points depend only on content
+    # normalized chunking: a stricter mask before the average size and a looser one after it
+    # keeps the sizes close to the average
+    def __init__(self,avg_size:int = 64 * 1024):
+        bits = max(10,min(16,avg_size.bit_length() - 1))
+        self.avg_size = 1 << bits
+        self.min_size = self.avg_size // 4
+        self.max_size = self.avg_size * 4
+        self.strict_mask = (1 << bits) - 1
+        self.loose_mask = (1 << (bits - 2)) - 1
+
+    def _cuts(self,data:bytes,final:bool)->List[int]:
+        #chunk end offsets in data, a chunk that could still grow past the end of data is left for later
+        candidates = _gear_cut_candidates(data,self.loose_mask)
+        positions = [i for i,_ in candidates]
+        strict = [i for i,value in candidates if not value & self.strict_mask]
+        cuts = []
+        start = 0
+        while len(data) - start > (0 if final else self.max_size - 1):
+            if len(data) - start <= self.min_size:
+                cuts.append(len(data))
+                break
+            normal = min(start + self.avg_size,len(data))
+            limit = min(start + self.max_size,len(data))
+            #a cut after byte i ends the chunk at i + 1
+            j = bisect.bisect_left(strict,start + self.min_size - 1)
+            if j < len(strict) and strict[j] < normal - 1:
+                end = strict[j] + 1
+            else:
+                j = bisect.bisect_left(positions,normal - 1)
+                end = positions[j] + 1 if j < len(positions) and positions[j] < limit else limit
+            cuts.append(end)
+            start = end
+        return cuts
+
+    def split(self,blocks):
+        #blocks: any iterable of bytes (e.g. file reads), yields the chunks in order
+        pending = b""
+        for block in blocks:
+            pending = pending + block if pending else block
+            if len(pending) < self.max_size:
+                continue
+            start = 0
+            for end in self._cuts(pending,False):
+                yield pending[start:end]
+                start = end
+            pending = pending[start:]
+        start = 0
+        for end in self._cuts(pending,True):
+            yield pending[start:end]
+            start = end
+
+
+#line diff: lines are interned to ints, common prefix/suffix are stripped, lines unique to both sides anchor
+#the rest (patience), and the gaps between anchors go to a linear-space Myers diff, everything is produced in order
+def _middle_snake(a:List[int],a_lo:int,a_hi:int,b:List[int],b_lo:int,b_hi:int)->Tuple[int,int,int,int]:
+    #(x,y,u,v): a snake on an optimal path around the middle of it, the forward and backward searches
+    #only keep the furthest x per diagonal (two arrays of n+m), not the whole edit graph
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta & 1
+    limit = (n + m + 1) // 2 + 1
+    forward = [0] * (2 * limit + 2)
+    backward = [0] * (2 * limit + 2)
+    for d in range(limit):
+        for k in range(-d,d + 1,2):
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                x = forward[k + 1]
+            else:
+                x = forward[k - 1] + 1
+            y = x - k
+            start_x,start_y = x,y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[delta - k] >= n:
+                return a_lo + start_x,b_lo + start_y,a_lo + x,b_lo + y
+        for k in range(-d,d + 1,2):
+            #x counts from the end here, backward diagonal k is forward diagonal delta - k
+            if k == -d or (k != d and backward[k - 1] < backward[k + 1]):
+                x = backward[k + 1]
+            else:
+                x = backward[k - 1] + 1
+            y = x - k
+            start_x,start_y = x,y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[k] = x
+            if not odd and -d <= delta - k <= d and x + forward[delta - k] >= n:
+                return a_hi - x,b_hi - y,a_hi - start_x,b_hi - start_y
+    raise ValueError("no middle snake") #unreachable, the paths always meet by d = (n+m)/2
+
+
+def _myers_pairs(a:List[int],b:List[int]):
+    #(i,j) of every matched element, in order; explicit stack, pieces are pushed right to left
+    stack = [(0,len(a),0,len(b))]
+    while stack:
+        item = stack.pop()
+        if len(item) == 3: #a run of matches
+            i,j,length = item
+            for offset in range(length):
+                yield i + offset,j + offset
+            continue
+        a_lo,a_hi,b_lo,b_hi = item
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            yield a_lo,b_lo
+            a_lo += 1
+            b_lo += 1
+        suffix = 0
+        while a_lo < a_hi - suffix and b_lo < b_hi - suffix and a[a_hi - 1 - suffix] == b[b_hi - 1 - suffix]:
+            suffix += 1
+        stack.append((a_hi - suffix,b_hi - suffix,suffix))
+        a_hi -= suffix
+        b_hi -= suffix
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+        x,y,u,v = _middle_snake(a,a_lo,a_hi,b,b_lo,b_hi)
+        if (x,y,u,v) in ((a_lo,b_lo,a_lo,b_lo),(a_hi,b_hi,a_hi,b_hi)):
+            continue #no split means no common element left (can't happen after the trimming, but never loop)
+        stack.append((u,a_hi,v,b_hi))
+        stack.append((x,y,u - x))
+        stack.append((a_lo,x,b_lo,y))
+
+
+def _unique_anchors(a:List[int],a_lo:int,a_hi:int,b:List[int],b_lo:int,b_hi:int)->List[Tuple[int,int]]:
+    #lines occurring exactly once on each side, longest run of them in the same order on both (patience)
+    counts = {}
+    for i in range(a_lo,a_hi):
+        entry = counts.get(a[i])
+        counts[a[i]] = [i,None,0] if entry is None else [entry[0],None,2]
+    for j in range(b_lo,b_hi):
+        entry = counts.get(b[j])
+        if entry is not None and entry[2] < 2:
+            entry[1] = j if entry[1] is None else -1
+    pairs = sorted((i,j) for i,j,count in counts.values() if count == 0 and j is not None and j >= 0)
+    #longest increasing subsequence of j, patience sorting with back pointers
+    tails = []
+    tail_index = []
+    previous = [-1] * len(pairs)
+    for index,(_,j) in enumerate(pairs):
+        pile = bisect.bisect_left(tails,j)
+        if pile:
+            previous[index] = tail_index[pile - 1]
+        if pile == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[pile] = j
+            tail_index[pile] = index
+    anchors = []
+    index = tail_index[-1] if tail_index else -1
+    while index != -1:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def diff_matches(a:List[bytes],b:List[bytes]):
+    #(i,j) for every line of a kept as line j of b, in order
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        yield prefix,prefix
+        prefix += 1
+    suffix = 0
+    while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    ids = {}
+    a_ids = [ids.setdefault(line,len(ids)) for line in a[prefix:len(a) - suffix]]
+    b_ids = [ids.setdefault(line,len(ids)) for line in b[prefix:len(b) - suffix]]
+    anchors = _unique_anchors(a_ids,0,len(a_ids),b_ids,0,len(b_ids))
+    a_lo = b_lo = 0
+    for a_hi,b_hi in anchors + [(len(a_ids),len(b_ids))]:
+        if a_lo < a_hi and b_lo < b_hi:
+            #lines that don't occur on the other side can't match, Myers only sees the rest
+            in_a = set(a_ids[a_lo:a_hi])
+            in_b = set(b_ids[b_lo:b_hi])
+            a_index = [i for i in range(a_lo,a_hi) if a_ids[i] in in_b]
+            b_index = [j for j in range(b_lo,b_hi) if b_ids[j] in in_a]
+            for i,j in _myers_pairs([a_ids[i] for i in a_index],[b_ids[j] for j in b_index]):
+                yield prefix + a_index[i],prefix + b_index[j]
+        if a_hi < len(a_ids):
+            yield prefix + a_hi,prefix + b_hi
+        a_lo,b_lo = a_hi + 1,b_hi + 1
+    for offset in range(suffix):
+        yield len(a) - suffix + offset,len(b) - suffix + offset
+
+
+def diff_opcodes(a:List[bytes],b:List[bytes]):
+    #("equal"|"replace"|"delete"|"insert",i1,i2,j1,j2) covering both sides, like difflib
+    i = j = 0
+    run = None # [i1,j1,length] of the current run of matches
+    for match_i,match_j in diff_matches(a,b):
+        if run and match_i == run[0] + run[2] and match_j == run[1] + run[2]:
+            run[2] += 1
+            continue
+        if run:
+            yield "equal",run[0],run[0] + run[2],run[1],run[1] + run[2]
+            i,j = run[0] + run[2],run[1] + run[2]
+        if i < match_i or j < match_j:
+            tag = "replace" if i < match_i and j < match_j else "delete" if i < match_i else "insert"
+            yield tag,i,match_i,j,match_j
+        run = [match_i,match_j,1]
+    if run:
+        yield "equal",run[0],run[0] + run[2],run[1],run[1] + run[2]
+        i,j = run[0] + run[2],run[1] + run[2]
+    if i < len(a) or j < len(b):
+        tag = "replace" if i < len(a) and j < len(b) else "delete" if i < len(a) else "insert"
+        yield tag,i,len(a),j,len(b)
+
+
+def _unified_range(start:int,stop:int)->str:
+    length = stop - start
+    if length == 1:
+        return f"{start + 1}"
+    return f"{start if not length else start + 1},{length}"
+
+
+def unified_hunks(a:List[bytes],b:List[bytes],context:int = 3):
+    #yields the lines of each hunk (header first) as soon as the opcodes after it show the hunk is complete
+    group = []
+    leading = None
+    for tag,i1,i2,j1,j2 in diff_opcodes(a,b):
+        if tag == "equal":
+            if not group:
+                leading = (i1,i2,j1,j2)
+                continue
+            if i2 - i1 <= 2 * context:
+                group.append((tag,i1,i2,j1,j2))
+                continue
+            group.append((tag,i1,i1 + context,j1,j1 + context))
+            yield from _format_hunk(a,b,group)
+            group = []
+            leading = (i1,i2,j1,j2)
+            continue
+        if not group and leading:
+            i1_,i2_,j1_,j2_ = leading
+            keep = min(context,i2_ - i1_)
+            group.append(("equal",i2_ - keep,i2_,j2_ - keep,j2_))
+        group.append((tag,i1,i2,j1,j2))
+    if group:
+        if group[-1][0] == "equal":
+            tag,i1,i2,j1,j2 = group[-1]
+            group[-1] = (tag,i1,min(i2,i1 + context),j1,min(j2,j1 + context))
+        yield from _format_hunk(a,b,group)
+
+
+def _format_hunk(a:List[bytes],b:List[bytes],group:list):
+    yield f"@@ -{_unified_range(group[0][1],group[-1][2])} +{_unified_range(group[0][3],group[-1][4])} @@\n".encode()
+    for tag,i1,i2,j1,j2 in group:
+        if tag == "equal":
+            for line in a[i1:i2]:
+                yield b" " + line
+            continue
+        for line in a[i1:i2]:
+            yield b"-" + line
+        for line in b[j1:j2]:
+            yield b"+" + line
+
+
+def merge3(base:List[bytes],ours:List[bytes],theirs:List[bytes],labels:Tuple[str,str] = ("ours","theirs"))->Tuple[bytes,bool]:
+    # line-level three-way merge (diff3): base lines kept by both sides are sync points, between two of them
+    # whichever side changed wins, both changing the same lines differently is a conflict (marked in the text)
+    ours_match = dict(diff_matches(base,ours))
+    theirs_match = dict(diff_matches(base,theirs))
+    out = []
+    clean = True
+    i = j = k = 0
+
+    def region(i_end:int,j_end:int,k_end:int):
+        nonlocal clean
+        base_part,ours_part,theirs_part = base[i:i_end],ours[j:j_end],theirs[k:k_end]
+        if ours_part == theirs_part or theirs_part == base_part:
+            out.extend(ours_part)
+        elif ours_part == base_part:
+            out.extend(theirs_part)
+        else:
+            clean = False
+            out.append(f"<<<<<<< {labels[0]}\n".encode())
+            out.extend(ours_part)
+            if ours_part and not ours_part[-1].endswith(b"\n"):
+                out.append(b"\n")
+            out.append(b"=======\n")
+            out.extend(theirs_part)
+            if theirs_part and not theirs_part[-1].endswith(b"\n"):
+                out.append(b"\n")
+            out.append(f">>>>>>> {labels[1]}\n".encode())
+
+    for base_index in range(len(base)):
+        ours_index = ours_match.get(base_index)
+        theirs_index = theirs_match.get(base_index)
+        if ours_index is None or theirs_index is None:
+            continue
+        region(base_index,ours_index,theirs_index)
+        out.append(ours[ours_index])
+        i,j,k = base_index + 1,ours_index + 1,theirs_index + 1
+    region(len(base),len(ours),len(theirs))
+    return b"".join(out),clean
+
+
+class DeltaBaseCache:
+    # LRU of inflated delta bases keyed by (pack,offset), bounded by total bytes
+    # so walking a long delta chain in log/checkout doesn't inflate the same bases again and again
+    def __init__(self,max_bytes:int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock() #checkout reads objects from a pool of threads
+
+    def get(self,key:Tuple[str,int]):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self,key:Tuple[str,int],obj_type:str,content:bytes):
+        with self.lock:
+            if len(content) > self.max_bytes or key in self.entries:
+                return
+            self.entries[key] = (obj_type,content)
+            self.size += len(content)
+            while self.size > self.max_bytes:
+                _,(_,evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self)->Dict[str,int]:
+        return {"hits":self.hits,"misses":self.misses,"entries":len(self.entries),"bytes":self.size}
+
+
+class PackFile:
+    # reader for objects/pack/pack-<sha>.pack and its .idx, both mmap'd
+    # idx: magic, version, fanout[256], sorted shas, crc32s, offsets, 64 bit offsets, pack sha, idx sha
+    # fanout[b] = number of objects whose first byte is <= b, so a lookup is a binary search in one bucket
+    def __init__(self,pack_path:Path,cache:DeltaBaseCache=None):
+        self.pack_path = pack_path
+        self.idx_path = pack_path.with_suffix(".idx")
+        self.cache = cache
+        self.idx_file = open(self.idx_path,"rb")
+        self.idx = mmap.mmap(self.idx_file.fileno(),0,access=mmap.ACCESS_READ)
+        magic,version = struct.unpack_from(">4sI",self.idx,0)
+        if magic != IDX_MAGIC or version != 2:
+            raise ValueError(f"unsupported pack index {self.idx_path}")
+        self.fanout = struct.unpack_from(">256I",self.idx,8)
+        self.count = self.fanout[255]
+        self.sha_start = 8 + 256 * 4
+        self.crc_start = self.sha_start + 20 * self.count
+        self.offset_start = self.crc_start + 4 * self.count
+        self.large_offset_start = self.offset_start + 4 * self.count
+        self.file = open(pack_path,"rb")
+        self.data = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+        self._sorted_offsets = None
+        self._offset_positions = None
+
+    def close(self):
+        self.view.release()
+        self.data.close()
+        self.file.close()
+        self.idx.close()
+        self.idx_file.close()
+
+    def sha_at(self,i:int)->bytes:
+        start = self.sha_start + 20 * i
+        return self.idx[start:start + 20]
+
+    def hashes(self):
+        for i in range(self.count):
+            yield self.sha_at(i).hex()
+
+    def find(self,obj_hash:str)->int:
+        #position of obj_hash in the sorted sha table or -1
+        sha = bytes.fromhex(obj_hash)
+        lo = self.fanout[sha[0] - 1] if sha[0] else 0
+        hi = self.fanout[sha[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_sha = self.sha_at(mid)
+            if mid_sha < sha:
+                lo = mid + 1
+            elif mid_sha > sha:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def __contains__(self,obj_hash:str)->bool:
+        return self.find(obj_hash) >= 0
+
+    def offset_at(self,i:int)->int:
+        offset, = struct.unpack_from(">I",self.idx,self.offset_start + 4 * i)
+        if offset & 0x80000000:
+            offset, = struct.unpack_from(">Q",self.idx,self.large_offset_start + 8 * (offset & 0x7fffffff))
+        return offset
+
+    def _read_entry_header(self,pos:int)->Tuple[int,int,int]:
+        #type in bits 4-6 of the first byte, size as 4 bits + 7 bits per continuation byte
+        byte = self.data[pos]
+        pos += 1
+        obj_type = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = self.data[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        return obj_type,size,pos
+
+    def _entry_end(self,offset:int)->int:
+        #an entry ends where the next one starts, the last one at the trailing checksum
+        if self._sorted_offsets is None:
+            self._sorted_offsets = sorted(self.offset_at(i) for i in range(self.count))
+        i = bisect.bisect_right(self._sorted_offsets,offset)
+        if i < len(self._sorted_offsets):
+            return self._sorted_offsets[i]
+        return len(self.data) - 20
+
+    def hash_at_offset(self,offset:int)->str:
+        if self._offset_positions is None:
+            self._offset_positions = {self.offset_at(i):i for i in range(self.count)}
+        return self.sha_at(self._offset_positions[offset]).hex()
+
+    def raw_entry(self,i:int)->Tuple[int,int,str,memoryview]:
+        # (type code, size, delta base hash or None, compressed payload) of the i-th object as it is stored,
+        # so it can be copied into another pack without inflating it
+        offset = self.offset_at(i)
+        obj_type,size,pos = self._read_entry_header(offset)
+        base_hash = None
+        if obj_type == OFS_DELTA:
+            byte = self.data[pos]
+            pos += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = self.data[pos]
+                pos += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+            base_hash = self.hash_at_offset(offset - distance)
+        elif obj_type == REF_DELTA:
+            base_hash = self.data[pos:pos + 20].hex()
+            pos += 20
+        return obj_type,size,base_hash,self.view[pos:self._entry_end(offset)]
+
+    def _inflate(self,pos:int,offset:int,size:int)->bytes:
+        #memoryview slice of exactly the compressed payload, zlib reads straight from the mapping
+        try:
+            content = zlib.decompress(self.view[pos:self._entry_end(offset)],bufsize=max(size,1))
+        except zlib.error as e:
+            raise ValueError(f"corrupt object in {self.pack_path}: {e}")
+        if len(content) != size:
+            raise ValueError(f"corrupt object in {self.pack_path}")
+        return content
+
+    def _read_base(self,offset:int)->Tuple[str,bytes]:
+        if self.cache is None:
+            return self.read_at(offset)
+        key = (self.pack_path.name,offset)
+        entry = self.cache.get(key)
+        if entry is None:
+            entry = self.read_at(offset)
+            self.cache.put(key,*entry)
+        return entry
+
+    def read_at(self,offset:int)->Tuple[str,bytes]:
+        obj_type,size,pos = self._read_entry_header(offset)
+        if obj_type == OFS_DELTA:
+            byte = self.data[pos]
+            pos += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = self.data[pos]
+                pos += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+            base_type,base = self._read_base(offset - distance)
+            return base_type,apply_delta(base,self._inflate(pos,offset,size))
+        if obj_type == REF_DELTA:
+            base_index = self.find(self.data[pos:pos + 20].hex())
+            if base_index < 0:
+                raise ValueError(f"missing delta base in {self.pack_path}")
+            base_type,base = self._read_base(self.offset_at(base_index))
+            return base_type,apply_delta(base,self._inflate(pos + 20,offset,size))
+        return PACK_TYPE_NAMES[obj_type],self._inflate(pos,offset,size)
+
+    def load(self,obj_hash:str)->GitObject:
+        i = self.find(obj_hash)
+        if i < 0:
+            return None
+        obj_type,content = self.read_at(self.offset_at(i))
+        return GitObject(obj_type,content)
+
+    @staticmethod
+    def _encode_entry_header(obj_type:int,size:int)->bytes:
+        byte = (obj_type << 4) | (size & 0x0f)
+        size >>= 4
+        out = bytearray()
+        while size:
+            out.append(byte | 0x80)
+            byte = size & 0x7f
+            size >>= 7
+        out.append(byte)
+        return bytes(out)
+
+    @staticmethod
+    def _encode_ofs_distance(distance:int)->bytes:
+        #big endian 7 bit groups, each continuation adds one so there is a single encoding per value
+        out = [distance & 0x7f]
+        distance >>= 7
+        while distance:
+            distance -= 1
+            out.append(0x80 | (distance & 0x7f))
+            distance >>= 7
+        return bytes(reversed(out))
+
+    @staticmethod
+    def write_index(idx_path:Path,entries:Dict[str,Tuple[int,int]],pack_sha:bytes):
+        #entries: hash -> (offset,crc32)
+        shas = sorted(entries)
+        fanout = [0] * 256
+        for obj_hash in shas:
+            fanout[int(obj_hash[:2],16)] += 1
+        for i in range(1,256):
+            fanout[i] += fanout[i - 1]
+
+        offsets = []
+        large_offsets = []
+        for obj_hash in shas:
+            offset = entries[obj_hash][0]
+            if offset < 0x80000000:
+                offsets.append(offset)
+            else:
+                offsets.append(0x80000000 | len(large_offsets))
+                large_offsets.append(offset)
+
+        parts = [IDX_MAGIC,struct.pack(">I",2),struct.pack(">256I",*fanout)]
+        parts.append(b"".join(bytes.fromhex(obj_hash) for obj_hash in shas))
+        parts.append(struct.pack(f">{len(shas)}I",*(entries[obj_hash][1] for obj_hash in shas)))
+        parts.append(struct.pack(f">{len(offsets)}I",*offsets))
+        parts.append(struct.pack(f">{len(large_offsets)}Q",*large_offsets))
+        parts.append(pack_sha)
+        content = b"".join(parts)
+        idx_path.write_bytes(content + hashlib.sha1(content).digest())
+
+
+class PackWriter:
+    # streams objects into a temporary pack, the object count in the header is patched in finish()
+    def __init__(self,pack_dir:Path):
+        self.pack_dir = pack_dir
+        pack_dir.mkdir(parents=True,exist_ok=True)
+        fd,tmp_path = tempfile.mkstemp(prefix="tmp_pack_",dir=pack_dir)
+        self.tmp_path = Path(tmp_path)
+        self.file = os.fdopen(fd,"wb")
+        self.file.write(PACK_HEADER.pack(b"PACK",2,0))
+        self.offset = PACK_HEADER.size
+        self.entries: Dict[str,Tuple[int,int]] = {} # hash -> (offset,crc32)
+
+    def __contains__(self,obj_hash:str)->bool:
+        return obj_hash in self.entries
+
+    def add(self,obj_hash:str,obj_type:str,content:bytes,base_hash:str=None,delta:bytes=None):
+        if obj_hash in self.entries:
+            return
+        if base_hash is not None:
+            #bases are always written first, so the delta can point backwards at them
+            header = PackFile._encode_entry_header(OFS_DELTA,len(delta))
+            header += PackFile._encode_ofs_distance(self.offset - self.entries[base_hash][0])
+            payload = zlib.compress(delta)
+        else:
+            header = PackFile._encode_entry_header(PACK_TYPES[obj_type],len(content))
+            payload = zlib.compress(content)
+        self.file.write(header)
+        self.file.write(payload)
+        self.entries[obj_hash] = (self.offset,zlib.crc32(payload,zlib.crc32(header)))
+        self.offset += len(header) + len(payload)
+
+    def read(self,obj_hash:str)->GitObject:
+        #objects already written to the unfinished pack (never deltas here)
+        offset,_ = self.entries[obj_hash]
+        self.file.flush()
+        with open(self.tmp_path,"rb") as f:
+            f.seek(offset)
+            header = f.read(16)
+            obj_type = (header[0] >> 4) & 7
+            pos = 1
+            while header[pos - 1] & 0x80: #size continuation bytes, zlib knows where the data ends
+                pos += 1
+            f.seek(offset + pos)
+            decompressor = zlib.decompressobj()
+            parts = []
+            while not decompressor.eof:
+                chunk = f.read(1 << 16)
+                if not chunk:
+                    raise ValueError("truncated object in pack being written")
+                parts.append(decompressor.decompress(chunk))
+        return GitObject(PACK_TYPE_NAMES[obj_type],b"".join(parts))
+
+    def abort(self):
+        self.file.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+    def finish(self)->Path:
+        if not self.entries:
+            self.abort()
+            return None
+        self.file.seek(8)
+        self.file.write(struct.pack(">I",len(self.entries)))
+        self.file.close()
+
+        checksum = hashlib.sha1()
+        with open(self.tmp_path,"rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20),b""):
+                checksum.update(chunk)
+        pack_sha = checksum.digest()
+        with open(self.tmp_path,"ab") as f:
+            f.write(pack_sha)
+            f.flush()
+            os.fsync(f.fileno())
+
+        pack_path = self.pack_dir / f"pack-{pack_sha.hex()}.pack"
+        os.chmod(self.tmp_path,0o444) #packs are never modified in place
+        os.replace(self.tmp_path,pack_path)
+        #the idx goes last, readers only look at packs that have one
+        tmp_idx = pack_path.with_suffix(".idx.tmp")
+        PackFile.write_index(tmp_idx,self.entries,pack_sha)
+        os.replace(tmp_idx,pack_path.with_suffix(".idx"))
+        return pack_path
+
+
+# clone/fetch talk to "pygit upload-pack <path>" over its stdin/stdout, framed as pkt-lines:
+# 4 hex digits of length (including themselves) + payload, "0000" (flush) ends a section
+C_QUOTE_ESCAPES = {ord("a"):7,ord("b"):8,ord("f"):12,ord("n"):10,ord("r"):13,ord("t"):9,ord("v"):11,ord("\\"):92,ord('"'):34}
+
+def unquote_c_path(data:bytes,last:bool = True)->Tuple[str,bytes]:
+    #a path the way git writes it in fast-export streams: names with special or non-ASCII characters come in double
+    #quotes with C escapes, octal ones are the bytes of the UTF-8 name ("\303\251.txt" is é.txt)
+    #returns the path and the rest of the line; unquoted, the last path of a line runs to its end, others to a space
+    if not data.startswith(b'"'):
+        if last:
+            return data.decode(),b""
+        path,_,rest = data.partition(b" ")
+        return path.decode(),rest
+    name = bytearray()
+    pos = 1
+    while pos < len(data):
+        byte = data[pos]
+        if byte == 0x22:
+            rest = data[pos + 1:]
+            return name.decode(),rest[1:] if rest.startswith(b" ") else rest
+        if byte != 0x5c:
+            name.append(byte)
+            pos += 1
+        elif re.fullmatch(rb"[0-3][0-7][0-7]",data[pos + 1:pos + 4]):
+            name.append(int(data[pos + 1:pos + 4],8))
+            pos += 4
+        elif pos + 1 < len(data) and data[pos + 1] in C_QUOTE_ESCAPES:
+            name.append(C_QUOTE_ESCAPES[data[pos + 1]])
+            pos += 2
+        else:
+            raise ValueError(f"bad escape in quoted path {data[:60]!r}")
+    raise ValueError(f"unterminated quoted path {data[:60]!r}")
+
+FLUSH_PKT = b"0000"
+
+def pkt_line(line:str)->bytes:
+    data = line.encode()
+    return b"%04x" % (len(data) + 4) + data
+
+def read_pkt(stream)->str:
+    #payload of the next pkt-line, None for a flush
+    header = stream.read(4)
+    if len(header) < 4:
+        raise ValueError("remote end hung up unexpectedly")
+    length = int(header,16)
+    if length == 0:
+        return None
+    data = stream.read(length - 4)
+    if len(data) < length - 4:
+        raise ValueError("remote end hung up unexpectedly")
+    return data.decode()
+
+def write_pack_stream(out,count:int,entries:Iterator[Tuple[int,int,str,bytes]])->int:
+    # entries: (type code, size, REF_DELTA base hash or None, compressed payload); deltas may use a base
+    # the receiver already has and is not in the stream (a thin pack). Returns the bytes written.
+    # the header needs the count up front, the entries themselves are written as they come
+    sha = hashlib.sha1()
+    written = 0
+
+    def write(data:bytes):
+        nonlocal written
+        sha.update(data)
+        out.write(data)
+        written += len(data)
+
+    write(PACK_HEADER.pack(b"PACK",2,count))
+    sent = 0
+    for obj_type,size,base_hash,payload in entries:
+        header = PackFile._encode_entry_header(REF_DELTA if base_hash else obj_type,size)
+        write(header + bytes.fromhex(base_hash) if base_hash else header)
+        write(payload)
+        sent += 1
+    if sent != count:
+        raise ValueError(f"pack stream promised {count} objects but has {sent}")
+    out.write(sha.digest())
+    out.flush()
+    return written + 20
+
+
+class PackStreamReader:
+    # reads a pack from a pipe entry by entry: the compressed length is unknown, so every entry is
+    # inflated until zlib reports its end and whatever it read past that is kept for the next one
+    def __init__(self,stream):
+        self.stream = stream
+        self.buffer = b""
+        self.sha = hashlib.sha1()
+        self.received = 0
+
+    def _fill(self)->bool:
+        data = self.stream.read1(1 << 16) if hasattr(self.stream,"read1") else self.stream.read(1 << 16)
+        self.received += len(data)
+        self.buffer += data
+        return bool(data)
+
+    def read(self,n:int,hashed:bool = True)->bytes:
+        while len(self.buffer) < n:
+            if not self._fill():
+                raise ValueError("pack stream ended early")
+        data,self.buffer = self.buffer[:n],self.buffer[n:]
+        if hashed:
+            self.sha.update(data)
+        return data
+
+    def inflate(self)->bytes:
+        decompressor = zlib.decompressobj()
+        parts = []
+        while not decompressor.eof:
+            if not self.buffer and not self._fill():
+                raise ValueError("pack stream ended early")
+            consumed = self.buffer
+            parts.append(decompressor.decompress(consumed))
+            self.buffer = decompressor.unused_data
+            self.sha.update(consumed[:len(consumed) - len(self.buffer)])
+        return b"".join(parts)
+
+    def entries(self):
+        # (type name or None for a delta, content or delta, base hash) per entry, checks the trailer at the end
+        signature,version,count = PACK_HEADER.unpack(self.read(PACK_HEADER.size))
+        if signature != b"PACK" or version != 2:
+            raise ValueError("not a pack stream")
+        for _ in range(count):
+            byte = self.read(1)[0]
+            obj_type = (byte >> 4) & 7
+            while byte & 0x80: #the size is implied by the inflated data
+                byte = self.read(1)[0]
+            base_hash = self.read(20).hex() if obj_type == REF_DELTA else None
+            if obj_type not in PACK_TYPE_NAMES and obj_type != REF_DELTA:
+                raise ValueError(f"unsupported entry type {obj_type} in pack stream")
+            yield PACK_TYPE_NAMES.get(obj_type),self.inflate(),base_hash
+        if self.read(20,hashed = False) != self.sha.digest():
+            raise ValueError("pack stream checksum mismatch")
+
+
+class CommitGraph:
+    # objects/info/commit-graph: tree, parents, generation and time of every commit in fixed size records,
+    # so history walks don't have to inflate and parse commit objects
+    # header | chunk table | OIDF fanout | OIDL sorted ids | CDAT records | EDGE extra parents | BIDX | BDAT | sha1
+    # generation = 1 + max(generation of parents): a commit can only reach commits with a smaller one
+    # BIDX/BDAT: a bloom filter per commit of the paths it changed against its first parent (with their
+    # directories), BIDX holds where each commit's filter ends in BDAT, so path-limited walks skip most trees
+    SIGNATURE = b"CGPH"
+    VERSION = 1
+    HEADER = struct.Struct(">4sII") #signature, version, chunk count
+    CHUNK = struct.Struct(">4sQ") #chunk id, offset (the table ends with a zero id at the end offset)
+    RECORD = struct.Struct(">20sIIIQ") #tree, parent1, parent2, generation, commit time
+    NO_PARENT = 0x70000000
+    EXTRA_EDGES = 0x80000000 #parent2 points into EDGE, the last edge of an octopus has this bit set
+    GENERATION_INFINITY = 0xffffffff #commits that are not in the graph
+    BLOOM_HEADER = struct.Struct(">III") #hash version, hashes per path, bits per path
+    BLOOM_VERSION = 1 #blake2b of the path split into two 32 bit halves, double hashed
+    BLOOM_HASHES = 7
+    BLOOM_BITS = 10
+    BLOOM_MAX_PATHS = 512 #commits changing more get a filter with every bit set: always "maybe"
+    BLOOM_TOO_LARGE = b"\xff"
+
+    def __init__(self,data:bytes):
+        content,checksum = data[:-20],data[-20:]
+        if hashlib.sha1(content).digest() != checksum:
+            raise ValueError("commit-graph checksum mismatch")
+        signature,version,chunk_count = self.HEADER.unpack_from(content,0)
+        if signature != self.SIGNATURE or version != self.VERSION:
+            raise ValueError("unknown commit-graph format")
+        self.data = content
+        self.chunks = {}
+        pos = self.HEADER.size
+        table = [self.CHUNK.unpack_from(content,pos + i * self.CHUNK.size) for i in range(chunk_count + 1)]
+        for (chunk_id,start),(_,end) in zip(table,table[1:]):
+            self.chunks[chunk_id] = (start,end)
+        self.fanout = struct.unpack_from(">256I",content,self.chunks[b"OIDF"][0])
+        self.count = self.fanout[255]
+        self.oid_start = self.chunks[b"OIDL"][0]
+        self.record_start = self.chunks[b"CDAT"][0]
+        self.edge_start = self.chunks.get(b"EDGE",(0,0))[0]
+        self.bloom_index = None
+        if b"BIDX" in self.chunks and b"BDAT" in self.chunks:
+            version,hashes,_ = self.BLOOM_HEADER.unpack_from(content,self.chunks[b"BDAT"][0])
+            #filters written with another hash scheme can't answer queries, the graph is still usable
+            if version == self.BLOOM_VERSION and hashes == self.BLOOM_HASHES:
+                self.bloom_index = struct.unpack_from(f">{self.count}I",content,self.chunks[b"BIDX"][0])
+                self.bloom_start = self.chunks[b"BDAT"][0] + self.BLOOM_HEADER.size
+
+    @classmethod
+    def load(cls,path:Path)->"CommitGraph":
+        try:
+            return cls(path.read_bytes())
+        except (FileNotFoundError,ValueError,KeyError,struct.error):
+            #missing or broken graph just means walking the objects
+            return None
+
+    def oid(self,pos:int)->str:
+        start = self.oid_start + 20 * pos
+        return self.data[start:start + 20].hex()
+
+    def find(self,commit_hash:str)->int:
+        sha = bytes.fromhex(commit_hash)
+        lo = self.fanout[sha[0] - 1] if sha[0] else 0
+        hi = self.fanout[sha[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.oid_start + 20 * mid
+            mid_sha = self.data[start:start + 20]
+            if mid_sha < sha:
+                lo = mid + 1
+            elif mid_sha > sha:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def __contains__(self,commit_hash:str)->bool:
+        return self.find(commit_hash) >= 0
+
+    def record(self,pos:int)->Tuple[str,List[int],int,int]:
+        #(tree hash, parent positions, generation, commit time)
+        tree,parent1,parent2,generation,commit_time = self.RECORD.unpack_from(self.data,self.record_start + self.RECORD.size * pos)
+        parents = []
+        if parent1 != self.NO_PARENT:
+            parents.append(parent1)
+        if parent2 & self.EXTRA_EDGES:
+            edge = parent2 & ~self.EXTRA_EDGES
+            while True:
+                value, = struct.unpack_from(">I",self.data,self.edge_start + 4 * edge)
+                parents.append(value & ~self.EXTRA_EDGES)
+                if value & self.EXTRA_EDGES:
+                    break
+                edge += 1
+        elif parent2 != self.NO_PARENT:
+            parents.append(parent2)
+        return tree.hex(),parents,generation,commit_time
+
+    def parents(self,pos:int)->List[int]:
+        return self.record(pos)[1]
+
+    def generation(self,pos:int)->int:
+        return self.RECORD.unpack_from(self.data,self.record_start + self.RECORD.size * pos)[3]
+
+    @staticmethod
+    def bloom_hash(path:str)->Tuple[int,int]:
+        return struct.unpack(">II",hashlib.blake2b(path.encode(),digest_size=8).digest())
+
+    @classmethod
+    def bloom_keys(cls,path:str)->List[Tuple[int,int]]:
+        #what a query for path has to find: the path and every directory above it
+        keys = []
+        while path:
+            keys.append(cls.bloom_hash(path))
+            path = path.rpartition("/")[0]
+        return keys
+
+    @classmethod
+    def bloom_filter(cls,paths)->bytes:
+        #filter of the changed paths (directories included), paths=None when there were too many to list
+        if paths is None or len(paths) > cls.BLOOM_MAX_PATHS:
+            return cls.BLOOM_TOO_LARGE
+        size = max(1,(len(paths) * cls.BLOOM_BITS + 7) // 8)
+        bit_count = size * 8
+        bits = 0
+        for path in paths:
+            hash0,hash1 = cls.bloom_hash(path)
+            for i in range(cls.BLOOM_HASHES):
+                bits |= 1 << ((hash0 + i * hash1) % bit_count)
+        return bits.to_bytes(size,"little")
+
+    def bloom(self,pos:int)->bytes:
+        #the changed-path filter of a commit, None when the graph was written without them
+        if self.bloom_index is None:
+            return None
+        start = self.bloom_index[pos - 1] if pos else 0
+        return self.data[self.bloom_start + start:self.bloom_start + self.bloom_index[pos]]
+
+    def maybe_changed(self,pos:int,keys:List[Tuple[int,int]])->bool:
+        #False only when the commit certainly left the path untouched against its first parent
+        bloom = self.bloom(pos)
+        if not bloom:
+            return True
+        bits = int.from_bytes(bloom,"little")
+        bit_count = len(bloom) * 8
+        for hash0,hash1 in keys:
+            for i in range(self.BLOOM_HASHES):
+                if not bits >> ((hash0 + i * hash1) % bit_count) & 1:
+                    return False
+        return True
+
+    def commits(self):
+        #every commit as hash -> (tree,parent hashes,time), the input format of write()
+        for pos in range(self.count):
+            tree,parents,_,commit_time = self.record(pos)
+            yield self.oid(pos),(tree,[self.oid(parent) for parent in parents],commit_time)
+
+    @classmethod
+    def write(cls,path:Path,commits:Dict[str,Tuple[str,List[str],int]],blooms:Dict[str,bytes] = None):
+        #commits: hash -> (tree,parent hashes,commit time), must contain every parent it mentions
+        #blooms: hash -> changed-path filter, commits without one are written as always "maybe"
+        oids = sorted(commits)
+        positions = {oid:pos for pos,oid in enumerate(oids)}
+
+        #generations parents-first without recursion, histories can be very deep
+        generations = {}
+        for oid in oids:
+            stack = [oid]
+            while stack:
+                current = stack[-1]
+                if current in generations:
+                    stack.pop()
+                    continue
+                pending = [parent for parent in commits[current][1] if parent not in generations]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                generations[current] = 1 + max((generations[parent] for parent in commits[current][1]),default=0)
+
+        fanout = [0] * 256
+        for oid in oids:
+            fanout[int(oid[:2],16)] += 1
+        for i in range(1,256):
+            fanout[i] += fanout[i - 1]
+
+        records = []
+        edges = []
+        for oid in oids:
+            tree,parents,commit_time = commits[oid]
+            parent_positions = [positions[parent] for parent in parents]
+            parent1 = parent_positions[0] if parent_positions else cls.NO_PARENT
+            if len(parent_positions) > 2:
+                parent2 = cls.EXTRA_EDGES | len(edges)
+                extra = parent_positions[1:]
+                edges.extend(extra[:-1])
+                edges.append(extra[-1] | cls.EXTRA_EDGES)
+            elif len(parent_positions) == 2:
+                parent2 = parent_positions[1]
+            else:
+                parent2 = cls.NO_PARENT
+            records.append(cls.RECORD.pack(bytes.fromhex(tree),parent1,parent2,min(generations[oid],cls.GENERATION_INFINITY - 1),commit_time))
+
+        chunks = [
+            (b"OIDF",struct.pack(">256I",*fanout)),
+            (b"OIDL",b"".join(bytes.fromhex(oid) for oid in oids)),
+            (b"CDAT",b"".join(records)),
+        ]
+        if edges:
+            chunks.append((b"EDGE",struct.pack(f">{len(edges)}I",*edges)))
+        if blooms is not None:
+            filters = [blooms.get(oid) or cls.BLOOM_TOO_LARGE for oid in oids]
+            ends = list(itertools.accumulate(len(bloom) for bloom in filters))
+            chunks.append((b"BIDX",struct.pack(f">{len(ends)}I",*ends)))
+            chunks.append((b"BDAT",cls.BLOOM_HEADER.pack(cls.BLOOM_VERSION,cls.BLOOM_HASHES,cls.BLOOM_BITS) + b"".join(filters)))
+        offset = cls.HEADER.size + cls.CHUNK.size * (len(chunks) + 1)
+        parts = [cls.HEADER.pack(cls.SIGNATURE,cls.VERSION,len(chunks))]
+        for chunk_id,chunk in chunks:
+            parts.append(cls.CHUNK.pack(chunk_id,offset))
+            offset += len(chunk)
+        parts.append(cls.CHUNK.pack(b"\0\0\0\0",offset))
+        parts.extend(chunk for _,chunk in chunks)
+        content = b"".join(parts)
+
+        path.parent.mkdir(parents=True,exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_bytes(content + hashlib.sha1(content).digest())
+        os.replace(tmp_path,path)
+
+
+EWAH_ALL_ONES = (1 << 64) - 1
+EWAH_RUN_MAX = (1 << 32) - 1
+EWAH_LITERAL_MAX = (1 << 31) - 1
+
+def ewah_encode(bits:int,bit_count:int)->bytes:
+    # EWAH as git stores it: bit count, word count, 64 bit words, position of the last run-length word
+    # every run-length word says "run * (all 0 or all 1 words), then literals verbatim words" (bit 0: run bit,
+    # bits 1-32: run, bits 33-63: literals), so the long empty stretches of a reachability bitmap take one word
+    word_count = (bit_count + 63) // 64
+    words = struct.unpack(f"<{word_count}Q",bits.to_bytes(word_count * 8,"little"))
+    out = []
+    last_rlw = 0
+    i = 0
+    while i < word_count or not out:
+        run = 0
+        fill = words[i] if i < word_count else 0
+        if fill == 0 or fill == EWAH_ALL_ONES:
+            while i < word_count and words[i] == fill and run < EWAH_RUN_MAX:
+                run += 1
+                i += 1
+        start = i
+        while i < word_count and words[i] != 0 and words[i] != EWAH_ALL_ONES and i - start < EWAH_LITERAL_MAX:
+            i += 1
+        last_rlw = len(out)
+        out.append((1 if fill == EWAH_ALL_ONES and run else 0) | run << 1 | (i - start) << 33)
+        out.extend(words[start:i])
+    return struct.pack(f">II{len(out)}QI",bit_count,len(out),*out,last_rlw)
+
+def ewah_decode(data:bytes,pos:int)->Tuple[int,int]:
+    #(bitmap as an int, position after it)
+    _,word_count = struct.unpack_from(">II",data,pos)
+    words = struct.unpack_from(f">{word_count}Q",data,pos + 8)
+    parts = []
+    i = 0
+    while i < word_count:
+        rlw = words[i]
+        i += 1
+        run = (rlw >> 1) & EWAH_RUN_MAX
+        literals = rlw >> 33
+        if run:
+            parts.append((b"\xff" if rlw & 1 else b"\0") * (8 * run))
+        if literals:
+            parts.append(struct.pack(f"<{literals}Q",*words[i:i + literals]))
+            i += literals
+    return int.from_bytes(b"".join(parts),"little"),pos + 12 + 8 * word_count
+
+
+class BitmapIndex:
+    # objects/pack/pack-<sha>.bitmap: for selected commits, the set of objects they reach as a bitmap
+    # over the pack's idx positions (bit i = i-th hash in the idx), EWAH compressed
+    # header | commit, tree, blob type bitmaps | entries | sha1 trailer
+    # entry: idx position of the commit, xor offset, EWAH bitmap; with a xor offset k the stored bitmap is
+    # XOR'ed with the one of the entry k places earlier (an ancestor usually, so only the difference is stored)
+    SIGNATURE = b"BITM"
+    VERSION = 1
+    HEADER = struct.Struct(">4sII20s") #signature, version, entry count, checksum of the pack it describes
+    ENTRY = struct.Struct(">IB")
+    TYPES = ("commit","tree","blob")
+    MAX_XOR_OFFSET = 10
+    MAX_XOR_DEPTH = 8 #reading one bitmap decodes at most this many more
+
+    def __init__(self,data:bytes,pack:PackFile):
+        if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+            raise ValueError("bitmap checksum mismatch")
+        signature,version,count,pack_sha = self.HEADER.unpack_from(data,0)
+        if signature != self.SIGNATURE or version != self.VERSION:
+            raise ValueError("unknown bitmap format")
+        if pack_sha != pack.data[-20:]:
+            raise ValueError(f"bitmap does not belong to {pack.pack_path.name}")
+        self.data = data
+        self.pack = pack
+        self.bit_count = pack.fanout[255]
+        pos = self.HEADER.size
+        self.types = {}
+        for obj_type in self.TYPES:
+            self.types[obj_type],pos = ewah_decode(data,pos)
+        self.positions = {} #commit hash -> entry number
+        self.offsets = []
+        self.xor_offsets = []
+        for i in range(count):
+            commit_pos,xor_offset = self.ENTRY.unpack_from(data,pos)
+            pos += self.ENTRY.size
+            self.positions[pack.sha_at(commit_pos).hex()] = i
+            self.offsets.append(pos)
+            self.xor_offsets.append(xor_offset)
+            pos += 12 + 8 * struct.unpack_from(">I",data,pos + 4)[0]
+        self._decoded = {}
+
+    @classmethod
+    def load(cls,pack:PackFile)->"BitmapIndex":
+        try:
+            return cls(pack.pack_path.with_suffix(".bitmap").read_bytes(),pack)
+        except (FileNotFoundError,ValueError,struct.error):
+            return None #no bitmap or a stale one: callers walk instead
+
+    def __len__(self)->int:
+        return len(self.offsets)
+
+    def get(self,commit_hash:str)->int:
+        i = self.positions.get(commit_hash)
+        return None if i is None else self._bitmap(i)
+
+    def _bitmap(self,i:int)->int:
+        bitmap = self._decoded.get(i)
+        if bitmap is None:
+            bitmap,_ = ewah_decode(self.data,self.offsets[i])
+            if self.xor_offsets[i]:
+                bitmap ^= self._bitmap(i - self.xor_offsets[i])
+            self._decoded[i] = bitmap
+        return bitmap
+
+    @classmethod
+    def write(cls,path:Path,pack:PackFile,types:Dict[str,int],entries:List[Tuple[int,int]]):
+        # entries: (idx position of the commit, bitmap), ancestors before descendants
+        bit_count = pack.fanout[255]
+        parts = [cls.HEADER.pack(cls.SIGNATURE,cls.VERSION,len(entries),pack.data[-20:])]
+        parts.extend(ewah_encode(types.get(obj_type,0),bit_count) for obj_type in cls.TYPES)
+        depth = []
+        for i,(commit_pos,bitmap) in enumerate(entries):
+            #xor against whichever recent entry leaves the fewest bits set
+            best_offset,best = 0,bitmap
+            for offset in range(1,min(i,cls.MAX_XOR_OFFSET) + 1):
+                if depth[i - offset] >= cls.MAX_XOR_DEPTH:
+                    continue
+                candidate = bitmap ^ entries[i - offset][1]
+                if candidate.bit_count() < best.bit_count():
+                    best_offset,best = offset,candidate
+            depth.append(depth[i - best_offset] + 1 if best_offset else 0)
+            parts.append(cls.ENTRY.pack(commit_pos,best_offset))
+            parts.append(ewah_encode(best,bit_count))
+        content = b"".join(parts)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_bytes(content + hashlib.sha1(content).digest())
+        os.replace(tmp_path,path)
+
+
+class Inotify:
+    # minimal ctypes binding of the Linux inotify API, raises OSError where it isn't available
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT = struct.Struct("iIII") # wd mask cookie name_len, followed by the NUL padded name
+
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(None,use_errno=True)
+            init = self.libc.inotify_init1
+        except (OSError,AttributeError):
+            raise OSError("inotify is not available on this platform")
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(),"inotify_init1 failed")
+        self.watches: Dict[int,str] = {} # watch descriptor -> directory relative to the repository
+
+    def add_watch(self,rel_dir:str,full_path:Path):
+        wd = self.libc.inotify_add_watch(self.fd,os.fsencode(full_path),self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno == 28: #ENOSPC: out of watches (fs.inotify.max_user_watches)
+                raise OSError(errno,"inotify watch limit reached")
+            return #the directory vanished before we got to it, its parent reports that
+        #watching an inode that is already watched (a directory moved inside the tree) reuses its wd
+        self.watches[wd] = rel_dir
+
+    def read_events(self)->List[Tuple[int,int,str]]:
+        #(wd,mask,name) for everything queued so far, never blocks
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd,65536)
+            except BlockingIOError:
+                return events
+            pos = 0
+            while pos < len(data):
+                wd,mask,_,name_len = self.EVENT.unpack_from(data,pos)
+                pos += self.EVENT.size
+                name = os.fsdecode(data[pos:pos + name_len].rstrip(b"\0"))
+                pos += name_len
+                events.append((wd,mask,name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FSMonitor:
+    # background daemon of one repository: remembers the paths that changed and answers
+    # "what changed since <token>" over a unix socket (.pygit/fsmonitor.sock), one json line each way
+    # tokens are "<instance>:<sequence>", a token of another instance (restart, inotify queue overflow)
+    # is answered with paths=null which means "anything may have changed, do a full scan"
+    # uses inotify on Linux, elsewhere (or out of watches) it polls the tree every core.fsmonitorInterval seconds
+    def __init__(self,repo:"Repository"):
+        self.repo = repo
+        self.socket_path = repo.get_dir / "fsmonitor.sock"
+        self.changes: Dict[str,int] = {} # path -> sequence number of its last change
+        self.sequence = 0
+        self.instance = None
+        self._new_instance()
+        self.inotify = None
+        self.snapshot: Dict[str,Tuple[int,int,int]] = {} # polling: path -> (mtime,size,inode)
+        self.running = False
+
+    def _new_instance(self):
+        self.instance = f"{os.getpid()}-{time.time_ns()}"
+        self.changes.clear()
+        self.sequence = 0
+
+    def token(self)->str:
+        return f"{self.instance}:{self.sequence}"
+
+    def _record(self,rel_path:str):
+        self.sequence += 1
+        self.changes[rel_path] = self.sequence
+
+    def since(self,token:str):
+        instance,_,sequence = (token or "").rpartition(":")
+        if instance != self.instance:
+            return None
+        sequence = int(sequence)
+        return [path for path,changed_at in self.changes.items() if changed_at > sequence]
+
+    def _walk(self,rel_dir:str):
+        #(rel path,is dir,stat) below rel_dir, .pygit excluded
+        stack = [rel_dir]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                with os.scandir(self.repo.path / dir_path) as entries:
+                    for entry in entries:
+                        if entry.name == ".pygit":
+                            continue
+                        rel_path = f"{dir_path}/{entry.name}" if dir_path else entry.name
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                        if is_dir:
+                            stack.append(rel_path)
+                        yield rel_path,is_dir,entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+    def _watch(self,rel_dir:str,record:bool = False):
+        #a directory created or moved in may already have content the new watch will never report
+        self.inotify.add_watch(rel_dir,self.repo.path / rel_dir)
+        for rel_path,is_dir,_ in self._walk(rel_dir):
+            if is_dir:
+                self.inotify.add_watch(rel_path,self.repo.path / rel_path)
+            if record:
+                self._record(rel_path)
+
+    def _drain(self):
+        for wd,mask,name in self.inotify.read_events():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                #events were lost, no token handed out so far can be answered any more
+                self._new_instance()
+                continue
+            rel_dir = self.inotify.watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & Inotify.IN_IGNORED:
+                del self.inotify.watches[wd]
+                continue
+            if not name:
+                #the watched directory itself was deleted or moved away
+                self._record(rel_dir)
+                continue
+            if not rel_dir and name == ".pygit":
+                continue
+            rel_path = f"{rel_dir}/{name}" if rel_dir else name
+            self._record(rel_path)
+            if mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                self._watch(rel_path,record=True)
+
+    def _poll(self):
+        snapshot = {rel_path:(st.st_mtime_ns,st.st_size,st.st_ino) for rel_path,_,st in self._walk("")}
+        for rel_path,key in snapshot.items():
+            if self.snapshot.get(rel_path) != key:
+                self._record(rel_path)
+        for rel_path in self.snapshot.keys() - snapshot.keys():
+            self._record(rel_path)
+        self.snapshot = snapshot
+
+    def _catch_up(self):
+        #bring the change log up to date before answering, so a query sees every change made before it
+        if self.inotify:
+            self._drain()
+        else:
+            self._poll()
+
+    def _handle(self,request:dict)->dict:
+        command = request.get("command")
+        if command == "query":
+            self._catch_up()
+            return {"token":self.token(),"paths":self.since(request.get("token"))}
+        if command == "status":
+            return {"backend":"inotify" if self.inotify else "poll","token":self.token(),"paths":len(self.changes)}
+        if command == "stop":
+            self.running = False
+            return {"stopped":True}
+        return {"error":f"unknown command {command}"}
+
+    def run(self):
+        try:
+            self.inotify = Inotify()
+            self._watch("")
+        except OSError:
+            if self.inotify:
+                self.inotify.close()
+            self.inotify = None
+            self._poll()
+            self.changes.clear() #the first snapshot is the baseline, not a change
+        interval = float(self.repo.get_config("core.fsmonitorInterval",1.0))
+
+        if self.socket_path.exists():
+            self.socket_path.unlink()
+        server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        server.bind(str(self.socket_path))
+        server.listen(16)
+        self.running = True
+        try:
+            while self.running:
+                watched = [server] + ([self.inotify.fd] if self.inotify else [])
+                ready,_,_ = select.select(watched,[],[],None if self.inotify else interval)
+                if self.inotify and self.inotify.fd in ready:
+                    self._drain()
+                elif not self.inotify and not ready:
+                    self._poll()
+                if server in ready:
+                    conn,_ = server.accept()
+                    with conn:
+                        conn.settimeout(5)
+                        try:
+                            request = json.loads(conn.makefile("rb").readline() or b"{}")
+                            conn.sendall(json.dumps(self._handle(request)).encode() + b"\n")
+                        except (OSError,ValueError):
+                            continue
+        finally:
+            server.close()
+            if self.socket_path.exists():
+                self.socket_path.unlink()
+            if self.inotify:
+                self.inotify.close()
+
+
+class LockFile:
+    # <path>.lock created with O_EXCL is the lock and also where the new content goes
+    # commit() fsyncs it and renames it over path: readers see the old file or the new one, never half of one
+    # a process that dies holding the lock leaves the .lock behind, writers fail until it is removed by hand
+    def __init__(self,path:Path,timeout:float=1.0,fsync:bool=True):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.fsync = fsync
+        self.fd = None
+        deadline = time.monotonic() + timeout
+        delay = 0.001
+        while True:
+            try:
+                self.fd = os.open(self.lock_path,os.O_WRONLY | os.O_CREAT | os.O_EXCL,0o644)
+                return
+            except FileExistsError:
+                if time.monotonic() >= deadline:
+                    raise RuntimeError(f"Unable to create '{self.lock_path}': File exists. Another pygit process seems to be running in this repository, remove the file if it is not")
+                #back off so many waiting writers don't spin on the same directory
+                time.sleep(delay)
+                delay = min(delay * 2,0.1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.rollback()
+
+    def write(self,data:bytes):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd,view):]
+
+    def commit(self):
+        if self.fsync:
+            os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.lock_path,self.path)
+        if self.fsync:
+            #the rename itself only survives a crash once the directory is on disk
+            dir_fd = os.open(self.path.parent,os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def rollback(self):
+        #no-op after commit(), the .lock name may already belong to the next writer
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        self.lock_path.unlink(missing_ok=True)
+
+
+class ObjectStore(ABC):
+    # where the objects outside packs live: loose files (the default) or one sqlite file, picked by core.objectStore
+    # get() hands back what was stored, a chunked blob comes back as its manifest
+    # has_many/get_many answer a whole batch at once, walks and fsck ask per batch instead of per object
+    name = None
+
+    def has(self,obj_hash:str)->bool:
+        return bool(self.has_many([obj_hash]))
+
+    @abstractmethod
+    def has_many(self,hashes:List[str])->set:
+        ...
+
+    def get(self,obj_hash:str)->GitObject:
+        #None if the object isn't here
+        return self.get_many([obj_hash]).get(obj_hash)
+
+    @abstractmethod
+    def get_many(self,hashes:List[str])->Dict[str,GitObject]:
+        ...
+
+    def object_type(self,obj_hash:str)->str:
+        obj = self.get(obj_hash)
+        return obj.type if obj is not None else None
+
+    @abstractmethod
+    def freshen(self,obj_hash:str)->bool:
+        #True if the object is here; it then counts as new for prune's grace period
+        ...
+
+    @abstractmethod
+    def put(self,obj_hash:str,obj:GitObject):
+        ...
+
+    @abstractmethod
+    def put_stream(self,obj_type:str,size:int,blocks,known)->Tuple[str,bool]:
+        # content that arrives in blocks (a file being added), hashed and compressed on the way in -> (hash,written)
+        # known(hash) says the object is already stored elsewhere (a pack) and needn't be written
+        ...
+
+    @abstractmethod
+    def hashes(self)->List[str]:
+        ...
+
+    @abstractmethod
+    def stat_many(self,hashes:List[str])->Dict[str,Tuple[float,int]]:
+        #hash -> (mtime,stored size) of the ones that are here
+        ...
+
+    @abstractmethod
+    def delete_many(self,hashes:List[str]):
+        ...
+
+    def cleanup(self,cutoff:float,dry_run:bool = False):
+        #leftovers of writers that died before cutoff
+        pass
+
+
+class LooseObjectStore(ObjectStore):
+    # objects/<2 hex>/<38 hex>, one zlib file per object written with temp file + rename
+    name = "loose"
+
+    def __init__(self,objects_dir:Path):
+        self.objects_dir = objects_dir
+
+    def path(self,obj_hash:str)->Path:
+        return self.objects_dir / obj_hash[:2] / obj_hash[2:]
+
+    def has_many(self,hashes:List[str])->set:
+        #a fan-out directory many of the hashes fall into is listed once instead of a stat per hash
+        groups: Dict[str,List[str]] = {}
+        for obj_hash in hashes:
+            groups.setdefault(obj_hash[:2],[]).append(obj_hash)
+        found = set()
+        for prefix,group in groups.items():
+            obj_dir = self.objects_dir / prefix
+            if len(group) < 4:
+                found.update(obj_hash for obj_hash in group if os.path.exists(obj_dir / obj_hash[2:]))
+                continue
+            try:
+                names = set(os.listdir(obj_dir))
+            except FileNotFoundError:
+                continue
+            found.update(obj_hash for obj_hash in group if obj_hash[2:] in names)
+        return found
+
+    def get_many(self,hashes:List[str])->Dict[str,GitObject]:
+        objects = {}
+        for obj_hash in hashes:
+            try:
+                with TRACE.phase("object read"):
+                    data = self.path(obj_hash).read_bytes()
+            except FileNotFoundError:
+                continue
+            with TRACE.phase("decompress"):
+                objects[obj_hash] = GitObject.deserialize(data)
+        return objects
+
+    def object_type(self,obj_hash:str)->str:
+        #only the first bytes are inflated to find out
+        try:
+            with open(self.path(obj_hash),"rb") as f:
+                header = zlib.decompressobj().decompress(f.read(64),16)
+        except FileNotFoundError:
+            return None
+        return header.split(b" ",1)[0].decode()
+
+    def freshen(self,obj_hash:str)->bool:
+        #an object written again counts as new for prune's grace period, so a concurrent prune can't
+        #delete an unreachable object at the moment it is being staged again
+        try:
+            os.utime(self.path(obj_hash))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put(self,obj_hash:str,obj:GitObject):
+        with TRACE.phase("compress"):
+            data = obj.serialize()
+        with TRACE.phase("object write"):
+            obj_dir = self.objects_dir / obj_hash[:2]
+            obj_dir.mkdir(exist_ok=True)
+            #temp file + rename, another writer (or thread) storing the same object never sees half a file
+            fd,tmp_path = tempfile.mkstemp(prefix="tmp_obj_",dir=obj_dir)
+            with os.fdopen(fd,"wb") as f:
+                f.write(data)
+            os.replace(tmp_path,obj_dir / obj_hash[2:])
+
+    def put_stream(self,obj_type:str,size:int,blocks,known)->Tuple[str,bool]:
+        #hash and compress in one pass into a temp file, then rename it to its hash (or drop it if we have it)
+        header = f"{obj_type} {size}\0".encode()
+        sha = hashlib.sha1(header)
+        compressor = zlib.compressobj()
+        fd,tmp_path = tempfile.mkstemp(prefix="tmp_obj_",dir=self.objects_dir)
+        try:
+            with os.fdopen(fd,"wb") as out:
+                out.write(compressor.compress(header))
+                for block in blocks:
+                    with TRACE.phase("hash"):
+                        sha.update(block)
+                    with TRACE.phase("compress"):
+                        block = compressor.compress(block)
+                    with TRACE.phase("object write"):
+                        out.write(block)
+                with TRACE.phase("compress"):
+                    block = compressor.flush()
+                with TRACE.phase("object write"):
+                    out.write(block)
+            obj_hash = sha.hexdigest()
+            if self.freshen(obj_hash) or known(obj_hash):
+                os.unlink(tmp_path)
+                return obj_hash,False
+            with TRACE.phase("object write"):
+                obj_dir = self.objects_dir / obj_hash[:2]
+                obj_dir.mkdir(exist_ok=True)
+                os.replace(tmp_path,obj_dir / obj_hash[2:])
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return obj_hash,True
+
+    def hashes(self)->List[str]:
+        hashes = []
+        try:
+            dirs = list(os.scandir(self.objects_dir))
+        except FileNotFoundError:
+            return hashes
+        for obj_dir in dirs:
+            if len(obj_dir.name) != 2 or not obj_dir.is_dir():
+                continue
+            hashes.extend(obj_dir.name + entry.name for entry in os.scandir(obj_dir.path) if len(entry.name) == 38)
+        return hashes
+
+    def stat_many(self,hashes:List[str])->Dict[str,Tuple[float,int]]:
+        stats = {}
+        for obj_hash in hashes:
+            try:
+                st = os.stat(self.path(obj_hash))
+            except FileNotFoundError:
+                continue
+            stats[obj_hash] = (st.st_mtime,st.st_size)
+        return stats
+
+    def delete_many(self,hashes:List[str]):
+        dirs = set()
+        for obj_hash in hashes:
+            self.path(obj_hash).unlink(missing_ok=True)
+            dirs.add(obj_hash[:2])
+        for prefix in dirs:
+            try:
+                (self.objects_dir / prefix).rmdir() #only succeeds when empty
+            except OSError:
+                pass
+
+    def cleanup(self,cutoff:float,dry_run:bool = False):
+        #temp files of writers that crashed
+        for tmp_path in list(self.objects_dir.glob("tmp_obj_*")) + list(self.objects_dir.glob("??/tmp_obj_*")):
+            try:
+                if tmp_path.stat().st_mtime < cutoff and not dry_run:
+                    tmp_path.unlink()
+            except FileNotFoundError:
+                pass
+        if not dry_run:
+            for obj_dir in self.objects_dir.glob("??"):
+                try:
+                    obj_dir.rmdir()
+                except OSError:
+                    pass
+
+
+class SQLiteObjectStore(ObjectStore):
+    # every object in one file, objects/objects.db: no fan-out directories and no small files, for network
+    # filesystems and filesystems with a high per-file cost; content is zlib compressed like a loose object
+    # one connection shared by the worker threads behind a lock, in WAL mode a write is an append to the log
+    name = "sqlite"
+    BATCH = 500 #sqlite's default limit is 999 parameters per statement
+
+    def __init__(self,db_path:Path,timeout:float=1.0):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(db_path),timeout=timeout,isolation_level=None,check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects (hash TEXT PRIMARY KEY,type TEXT NOT NULL,data BLOB NOT NULL,mtime REAL NOT NULL) WITHOUT ROWID")
+
+    def _query(self,sql:str,hashes:List[str])->list:
+        # sql has one "{}" for the placeholders, hashes go in BATCH at a time
+        rows = []
+        with self.lock:
+            for i in range(0,len(hashes),self.BATCH):
+                batch = hashes[i:i + self.BATCH]
+                rows.extend(self.db.execute(sql.format(",".join("?" * len(batch))),batch).fetchall())
+        return rows
+
+    def has_many(self,hashes:List[str])->set:
+        return {row[0] for row in self._query("SELECT hash FROM objects WHERE hash IN ({})",list(hashes))}
+
+    def get_many(self,hashes:List[str])->Dict[str,GitObject]:
+        with TRACE.phase("object read"):
+            rows = self._query("SELECT hash,type,data FROM objects WHERE hash IN ({})",list(hashes))
+        with TRACE.phase("decompress"):
+            return {obj_hash:GitObject(obj_type,zlib.decompress(data)) for obj_hash,obj_type,data in rows}
+
+    def object_type(self,obj_hash:str)->str:
+        rows = self._query("SELECT type FROM objects WHERE hash IN ({})",[obj_hash])
+        return rows[0][0] if rows else None
+
+    def freshen(self,obj_hash:str)->bool:
+        with self.lock:
+            return self.db.execute("UPDATE objects SET mtime = ? WHERE hash = ?",(time.time(),obj_hash)).rowcount > 0
+
+    def put(self,obj_hash:str,obj:GitObject):
+        with TRACE.phase("compress"):
+            data = zlib.compress(obj.content)
+        with TRACE.phase("object write"),self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?,?,?,?)",(obj_hash,obj.type,data,time.time()))
+
+    def put_stream(self,obj_type:str,size:int,blocks,known)->Tuple[str,bool]:
+        #hashed and compressed block by block into a temp file; only the compressed object is read back for the
+        #insert, a WITHOUT ROWID table has no rowid for blobopen to write it in pieces
+        sha = hashlib.sha1(f"{obj_type} {size}\0".encode())
+        compressor = zlib.compressobj()
+        with tempfile.TemporaryFile(prefix="tmp_obj_",dir=self.db_path.parent) as spool:
+            for block in blocks:
+                with TRACE.phase("hash"):
+                    sha.update(block)
+                with TRACE.phase("compress"):
+                    spool.write(compressor.compress(block))
+            with TRACE.phase("compress"):
+                spool.write(compressor.flush())
+            obj_hash = sha.hexdigest()
+            if self.freshen(obj_hash) or known(obj_hash):
+                return obj_hash,False
+            spool.seek(0)
+            data = spool.read()
+        with TRACE.phase("object write"),self.lock:
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?,?,?,?)",(obj_hash,obj_type,data,time.time()))
+        return obj_hash,True
+
+    def hashes(self)->List[str]:
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT hash FROM objects")]
+
+    def stat_many(self,hashes:List[str])->Dict[str,Tuple[float,int]]:
+        rows = self._query("SELECT hash,mtime,length(data) FROM objects WHERE hash IN ({})",list(hashes))
+        return {obj_hash:(mtime,size) for obj_hash,mtime,size in rows}
+
+    def delete_many(self,hashes:List[str]):
+        hashes = list(hashes)
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for i in range(0,len(hashes),self.BATCH):
+                    batch = hashes[i:i + self.BATCH]
+                    self.db.execute(f"DELETE FROM objects WHERE hash IN ({','.join('?' * len(batch))})",batch)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+
+class PackObjectStore(ObjectStore):
+    # the packs as one store; they are written whole (repack, fetch, begin_batch), never object by object
+    name = "pack"
+
+    def __init__(self,packs:List[PackFile]):
+        self.packs = packs
+
+    def has_many(self,hashes:List[str])->set:
+        return {obj_hash for obj_hash in hashes if any(obj_hash in pack for pack in self.packs)}
+
+    def get_many(self,hashes:List[str])->Dict[str,GitObject]:
+        objects = {}
+        with TRACE.phase("pack read"):
+            for obj_hash in hashes:
+                for pack in self.packs:
+                    obj = pack.load(obj_hash)
+                    if obj is not None:
+                        objects[obj_hash] = obj
+                        break
+        return objects
+
+    def freshen(self,obj_hash:str)->bool:
+        return self.has(obj_hash)
+
+    def put(self,obj_hash:str,obj:GitObject):
+        raise ValueError("packs are written whole by repack, fetch and batches, not one object at a time")
+
+    def put_stream(self,obj_type:str,size:int,blocks,known)->Tuple[str,bool]:
+        raise ValueError("packs are written whole by repack, fetch and batches, not one object at a time")
+
+    def hashes(self)->List[str]:
+        hashes = {}
+        for pack in self.packs:
+            hashes.update(dict.fromkeys(pack.hashes()))
+        return list(hashes)
+
+    def stat_many(self,hashes:List[str])->Dict[str,Tuple[float,int]]:
+        return {}
+
+    def delete_many(self,hashes:List[str]):
+        raise ValueError("objects are dropped from packs by repacking")
+
+
+class AsyncObjectReader:
+    # asyncio front end for object reads, so walks keep reads in flight instead of waiting for each round trip.
+    # Everything asked for during one turn of the event loop (the subtrees of a directory, a window of commits)
+    # is read together: split over at most `limit` concurrent Repository.get_many calls on a thread pool, so a
+    # small object costs no thread hand-off of its own. Used through Repository.run_async
+    def __init__(self,repo:"Repository",limit:int):
+        self.repo = repo
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        #a limit of 1 overlaps nothing, reads then run inline on the loop's thread without a hand-off
+        self.pool = ThreadPoolExecutor(max_workers=limit) if limit > 1 else None
+        self.reads: Dict[str,asyncio.Future] = {} #asked for and not read yet, a hash asked for twice is read once
+        self.queued: List[str] = []
+
+    def __enter__(self)->"AsyncObjectReader":
+        return self
+
+    def __exit__(self,*exc):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    async def run(self,func,*args):
+        #any blocking call (reads, file writes) under the in-flight limit
+        if self.pool is None:
+            return func(*args)
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.pool,func,*args)
 
-    @classmethod
-    # because we nedd to apply the logic to entire class not a particular object
-    def from_content(cls,content:bytes)->"Tree": 
-        tree = cls() # empty instance of the class being assigned to the variable name tree
-        i = 0
+    def _request(self,obj_hash:str)->asyncio.Future:
+        future = self.reads.get(obj_hash)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self.reads[obj_hash] = loop.create_future()
+            if not self.queued:
+                loop.call_soon(self._flush)
+            self.queued.append(obj_hash)
+        return future
 
-        while i < len(content):
-            null_idx = content.find(b"\0",i)
-            # 100644 README.md\0[20bytes of content hash]100644 xyz.md\0[20bytes of content hash]
-            if null_idx == -1:
-                break
-            mode_name = content[i:null_idx].decode()
-            mode,name = mode_name.split(' ',1)
-            obj_hash = content[null_idx + 1 : null_idx + 21].hex()
-            tree.entries.append((mode,name,obj_hash))#class method
+    async def get(self,obj_hash:str)->GitObject:
+        return await self._request(obj_hash)
 
-            i = null_idx + 21
-        return tree
+    def _flush(self):
+        hashes,self.queued = self.queued,[]
+        step = -(-len(hashes) // self.limit)
+        for i in range(0,len(hashes),step):
+            asyncio.ensure_future(self._read(hashes[i:i + step]))
 
+    async def _read(self,hashes:List[str]):
+        try:
+            objects = await self.run(self.repo.get_many,hashes)
+        except Exception:
+            objects = None #one unreadable object fails the batch, the others are read on their own below
+        for obj_hash in hashes:
+            future = self.reads.pop(obj_hash)
+            if objects is not None and obj_hash in objects:
+                future.set_result(objects[obj_hash])
+                continue
+            try:
+                future.set_result(await self.run(self.repo.load_object,obj_hash))
+            except Exception as e:
+                future.set_exception(e)
 
-class Commit(GitObject):
-    def __init__(
-            self,
-            tree_hash:str,
-            parent_hashes:List[str],
-            author:str,
-            committer:str,
-            message:str,
-            timestamp:int = None,
-        ):
-            self.tree_hash = tree_hash
-            self.parent_hashes = parent_hashes 
-            self.author = author
-            self.committer=committer
-            self.message = message
-            self.timestamp =timestamp or int(time.time())
-
-            content = self._serialize_commit()
-            super().__init__("commit",content)
-        
-    def _serialize_commit(self):
-        lines = [f"tree {self.tree_hash}"]
-        for parent in self.parent_hashes:
-            lines.append(f"parent {parent}")   
-        lines.append(f"author {self.author} {self.timestamp} +0000")
-        lines.append(f"committer {self.committer} {self.timestamp} +0000")
-        lines.append("")
-        lines.append(self.message)
+    async def get_many(self,hashes:List[str])->Dict[str,GitObject]:
+        #raises like load_object for a missing one
+        hashes = list(dict.fromkeys(hashes))
+        return dict(zip(hashes,await asyncio.gather(*[self._request(obj_hash) for obj_hash in hashes])))
 
-        return "\n".join(lines).encode()
-    
-    @classmethod
-    def from_content(cls,content:bytes)->"Commit":
-        lines = content.decode().split("\n")
-        tree_hash = None
-        parent_hashes = []
-        author = None
-        committer =None
-        message_start = 0
-
-        for i , line in enumerate(lines):
-            if line.startswith("tree "):
-                tree_hash = line[5:]
-            elif line.startswith("parent "):
-                parent_hashes.append(line[7:])
-            elif line.startswith("author "):
-                author_parts = line[7:].rsplit(" ",2)
-                author = author_parts[0]
-                timestamp = int(author_parts[1])
-            elif line.startswith("committer "):
-                commit_parts = line[10:].rsplit(" ",2)
-                committer = commit_parts[0]
-            elif line == "":
-                message_start = i + 1
-                break
-        message = "\n".join(lines[message_start:])
-        commit = cls(tree_hash,parent_hashes,author,committer,message,timestamp)
+    async def read_tree_entries(self,tree_hash:str)->Dict[str,Tuple[str,str]]:
+        if not tree_hash:
+            return {}
+        tree = Tree.from_content((await self.get(tree_hash)).content)
+        return {name:(mode,obj_hash) for mode,name,obj_hash in tree.entries}
 
-        return commit
-            
+    async def tree_files(self,tree_hash:str,prefix:str = "")->Dict[str,Tuple[str,str]]:
+        # path -> (mode,hash) of every file under the tree; the subtrees of a directory are read concurrently,
+        # a tree that can't be read is reported and skipped
+        files = {}
+
+        async def walk(tree_hash:str,dir_path:str):
+            try:
+                entries = await self.read_tree_entries(tree_hash)
+            except Exception as e:
+                print(f"Warning: Could not read tree {tree_hash}: {e}")
+                return
+            subtrees = []
+            for name,(mode,entry_hash) in entries.items():
+                rel_path = f"{dir_path}/{name}" if dir_path else name
+                if mode == "40000":
+                    subtrees.append(walk(entry_hash,rel_path))
+                else:
+                    files[rel_path] = (mode,entry_hash)
+            await asyncio.gather(*subtrees)
 
+        await walk(tree_hash,prefix)
+        return files
 
 
 class Repository:
@@ -152,13 +2773,52 @@ class Repository:
 
         #.git/objects
         self.objects_dir = self.get_dir / "objects"
+        #.git/objects/pack holds packfiles written by gc/repack
+        self.pack_dir = self.objects_dir / "pack"
+        self._packs = None
+        self._pack_store = None
+        #where objects outside packs go, see object_store
+        self._object_store = None
+        self._object_stores = None
+        self._bitmap = None
         #.git/refs
         self.ref_dir = self.get_dir / "refs" # in refs we have another folder heads
         self.heads_dir = self.ref_dir / "heads" # with in it we have branch name
+        #.git/packed-refs: "<hash> refs/heads/<branch>" per line, loose files in heads_dir take precedence
+        self.packed_refs_file = self.get_dir / "packed-refs"
+        self._packed_refs = None
+        self._packed_refs_stat = None
+        #.git/refs/remotes/<remote>/<branch>: where fetch leaves the branches of a remote
+        self.remotes_dir = self.ref_dir / "remotes"
+        #.git/FETCH_HEAD: tips of the last fetch from a url that is not a configured remote
+        self.fetch_head_file = self.get_dir / "FETCH_HEAD"
         #Head file
         self.head_file = self.get_dir / "HEAD"
+        #.git/MERGE_HEAD: the commit being merged while conflicts wait to be resolved
+        self.merge_head_file = self.get_dir / "MERGE_HEAD"
         #.git/index
         self.index_file = self.get_dir /"index"
+        #index.lock held from load to save by index_lock(), False if an opportunistic one was not free
+        self._index_lock = None
+        #what save_index wrote while the lock is held, it is committed when the lock is released
+        self._index_pending = None
+        #.git/config, flat json of "section.key": value
+        self.config_file = self.get_dir / "config"
+        #.git/info/sparse-checkout: directories of the cone while core.sparseCheckout is on
+        self.sparse_file = self.get_dir / "info" / "sparse-checkout"
+        self._sparse_cone = None
+        self._sparse_cone_loaded = False
+        self._config = None
+        self._delta_cache = None
+        #.git/objects/info/commit-graph
+        self.commit_graph_file = self.objects_dir / "info" / "commit-graph"
+        self._commit_graph = None
+        self._commit_graph_loaded = False
+        #PackWriter of the begin_batch() block in progress
+        self._batch = None
+        #event loop and AsyncObjectReader shared by every run_async call of the command
+        self._async_loop = None
+        self._async_reader = None
 
     def init(self) ->bool:
 
@@ -172,7 +2832,7 @@ class Repository:
         self.heads_dir.mkdir()
 
         #creates a head file that points to a branch
-        self.head_file.write_text("ref: refs/heads/master\n")
+        self.set_head("master")
 
         #creates a index file that stores the file in json format and creates a maping between filename and hashing releated to it
         self.save_index({})
@@ -180,157 +2840,481 @@ class Repository:
         print(f"Initialized empty Git repository in {self.get_dir}")
         return True
      
-    def store_object(self,obj:GitObject)->str:
-        obj_hash = obj.hash()
-        obj_dir = self.objects_dir / obj_hash[:2]
-        obj_file = obj_dir / obj_hash[2:]
+    def store_object(self,obj:GitObject,obj_hash:str=None)->str:
+        #callers that already hashed the object pass obj_hash so it isn't hashed twice
+        if obj_hash is None:
+            with TRACE.phase("hash"):
+                obj_hash = obj.hash()
+        if self._batch is not None:
+            #no stat/mkdir/write per object, the pack writer dedups in memory
+            if obj_hash not in self._batch and not self.in_pack(obj_hash):
+                self._batch.add(obj_hash,obj.type,obj.content)
+            return obj_hash
+        store = self.object_store
+        if store.freshen(obj_hash) or self.in_pack(obj_hash):
+            return obj_hash
+        threshold = self.chunk_threshold()
+        if obj.type == "blob" and threshold and len(obj.content) >= threshold:
+            return self.store_chunked([obj.content],len(obj.content))
+        store.put(obj_hash,obj)
+        TRACE.count("objects written")
+        return obj_hash
 
-        if not obj_file.exists():
-            obj_dir.mkdir(exist_ok=True)
-            obj_file.write_bytes(obj.serialize())
-        
+    @property
+    def object_store(self)->ObjectStore:
+        # core.objectStore: "loose" (one file per object) or "sqlite" (one database file for all of them)
+        if self._object_store is None:
+            backend = self.get_config("core.objectStore","loose")
+            if backend == "loose":
+                self._object_store = LooseObjectStore(self.objects_dir)
+            elif backend == "sqlite":
+                timeout = float(self.get_config("core.lockTimeout",1000)) / 1000
+                self._object_store = SQLiteObjectStore(self.objects_dir / "objects.db",timeout)
+            else:
+                raise ValueError(f"unknown core.objectStore '{backend}', expected loose or sqlite")
+        return self._object_store
+
+    def object_stores(self)->List[ObjectStore]:
+        #the configured store first; loose files written before the switch stay readable until gc packs them
+        if self._object_stores is None:
+            self._object_stores = [self.object_store]
+            if self.object_store.name != "loose":
+                self._object_stores.append(LooseObjectStore(self.objects_dir))
+        return self._object_stores
+
+    @property
+    def pack_store(self)->PackObjectStore:
+        if self._pack_store is None:
+            self._pack_store = PackObjectStore(self.packs())
+        return self._pack_store
+
+    def chunk_threshold(self)->int:
+        #blobs of at least this many bytes are stored as content-defined chunks, 0 turns it off
+        return int(self.get_config("core.chunkedBlobThreshold",0))
+
+    def store_chunked(self,blocks,size:int)->str:
+        # a big blob is stored as "chunk" objects (each one only once, whichever file or revision it came from)
+        # plus a "chunked" manifest at the blob's own hash: per chunk its hash and size
+        # the blob hash is computed over the whole content as usual, trees and commits can't tell the difference
+        sha = hashlib.sha1(f"blob {size}\0".encode())
+        chunker = Chunker(int(self.get_config("core.chunkSize",64 * 1024)))
+        manifest = []
+        for piece in chunker.split(blocks):
+            sha.update(piece)
+            #chunks we already have are hashed but never compressed or written again
+            chunk_hash = self.store_object(GitObject("chunk",piece))
+            manifest.append(bytes.fromhex(chunk_hash) + struct.pack(">I",len(piece)))
+        blob_hash = sha.hexdigest()
+        self.store_object(GitObject("chunked",b"".join(manifest)),blob_hash)
+        return blob_hash
+
+    def load_config(self)->Dict[str,object]:
+        if self._config is None:
+            try:
+                self._config = json.loads(self.config_file.read_text())
+            except (FileNotFoundError,ValueError):
+                self._config = {}
+        return self._config
+
+    def get_config(self,key:str,default=None):
+        return self.load_config().get(key,default)
+
+    def set_config(self,key:str,value):
+        config = self.load_config()
+        config[key] = value
+        self.write_file_atomic(self.config_file,json.dumps(config,indent=2,sort_keys=True).encode())
+
+    def lock(self,path:Path,timeout:float=None)->LockFile:
+        if timeout is None:
+            timeout = float(self.get_config("core.lockTimeout",1000)) / 1000
+        return LockFile(path,timeout,bool(self.get_config("core.fsync",True)))
+
+    def write_file_atomic(self,path:Path,data:bytes):
+        with self.lock(path) as lock:
+            lock.write(data)
+            lock.commit()
+
+    def worker_count(self)->int:
+        return int(self.get_config("core.workers",os.cpu_count() or 1))
+
+    def io_concurrency(self)->int:
+        #object reads and file writes in flight at once, reads mostly wait on storage so this is not cpu bound
+        return max(1,int(self.get_config("core.ioConcurrency",16)))
+
+    def run_async(self,work):
+        #runs work(reader) -> awaitable for the synchronous callers; the event loop and the reader with its
+        #thread pool are made on the first call and kept for the rest of the command (see close_async)
+        self.packs() #open the packs before the workers read from them
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            #called from code that already runs an event loop, this thread can't run a second one: the work
+            #gets a loop of its own on a helper thread and reads inline there (limit 1) while the caller waits
+            async def inline():
+                with AsyncObjectReader(self,1) as reader:
+                    return await work(reader)
+            with ThreadPoolExecutor(max_workers=1) as helper:
+                return helper.submit(asyncio.run,inline()).result()
+
+        async def main():
+            if self._async_reader is None:
+                self._async_reader = AsyncObjectReader(self,self.io_concurrency())
+            return await work(self._async_reader)
+
+        if self._async_loop is None:
+            self._async_loop = asyncio.new_event_loop()
+        return self._async_loop.run_until_complete(main())
+
+    def close_async(self):
+        #ends what run_async kept: the reader's thread pool and the event loop
+        if self._async_reader is not None:
+            self._async_reader.__exit__(None,None,None)
+            self._async_reader = None
+        if self._async_loop is not None:
+            self._async_loop.close()
+            self._async_loop = None
+
+    @property
+    def delta_cache(self)->DeltaBaseCache:
+        #shared by all packs, so the limit holds for the whole repository
+        if self._delta_cache is None:
+            limit = int(self.get_config("core.deltaBaseCacheLimit",96 * 1024 * 1024))
+            self._delta_cache = DeltaBaseCache(limit)
+        return self._delta_cache
+
+    def _read_chunks(self,file_path:Path,size:int):
+        chunk_size = int(self.get_config("core.streamChunkSize",1024 * 1024))
+        read = 0
+        with open(file_path,"rb") as f:
+            while True:
+                with TRACE.phase("file read"):
+                    chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                read += len(chunk)
+                yield chunk
+        #the header already promised `size` bytes
+        if read != size:
+            raise ValueError(f"{file_path} changed while it was being read")
+
+    def hash_file(self,file_path:Path,st:os.stat_result=None)->str:
+        #same as Blob(file_path.read_bytes()).hash() but only one chunk is in memory at a time
+        size = (st or file_path.stat()).st_size
+        sha = hashlib.sha1(f"blob {size}\0".encode())
+        for chunk in self._read_chunks(file_path,size):
+            with TRACE.phase("hash"):
+                sha.update(chunk)
+        TRACE.count("files hashed")
+        TRACE.count("bytes hashed",size)
+        return sha.hexdigest()
+
+    def store_file(self,file_path:Path,st:os.stat_result=None)->str:
+        #streamed into the object store, only one block of the file is in memory at a time
+        size = (st or file_path.stat()).st_size
+        threshold = self.chunk_threshold()
+        if threshold and size >= threshold:
+            return self.store_chunked(self._read_chunks(file_path,size),size)
+        obj_hash,written = self.object_store.put_stream("blob",size,self._read_chunks(file_path,size),self.in_pack)
+        TRACE.count("files hashed")
+        TRACE.count("bytes hashed",size)
+        if written:
+            TRACE.count("objects written")
         return obj_hash
+
+    def packs(self)->List[PackFile]:
+        if self._packs is None:
+            self._packs = []
+            if self.pack_dir.exists():
+                for pack_path in sorted(self.pack_dir.glob("pack-*.pack")):
+                    if pack_path.with_suffix(".idx").exists():
+                        self._packs.append(PackFile(pack_path,self.delta_cache))
+        return self._packs
+
+    def close_packs(self):
+        for pack in self._packs or []:
+            pack.close()
+        self._packs = None
+        self._pack_store = None
+        self._bitmap = None
+        #offsets are only meaningful for the packs they came from
+        self._delta_cache = None
+
+    def bitmap_index(self)->Tuple[PackFile,BitmapIndex]:
+        #the pack with a valid .bitmap next to it (repack leaves one pack), or (None,None)
+        if self._bitmap is None:
+            self._bitmap = (None,None)
+            if self.get_config("pack.useBitmaps",True):
+                for pack in self.packs():
+                    bitmap = BitmapIndex.load(pack)
+                    if bitmap is not None:
+                        self._bitmap = (pack,bitmap)
+                        break
+        return self._bitmap
+
+    def in_pack(self,obj_hash:str)->bool:
+        return self.pack_store.has(obj_hash)
     
-    def load_index(self) -> Dict[str,str]:
+    @traced("index read")
+    def load_index(self) -> Index:
+        if self._index_pending is not None:
+            return Index.from_bytes(self._index_pending)
         if not self.index_file.exists():
-            return  {}
+            return  Index()
         try:
-            return json.loads(self.index_file.read_text())
+            data = self.index_file.read_bytes()
+            if data.lstrip().startswith(b"{"):
+                #old json index, it has no stat data so everything gets hashed once
+                return Index(json.loads(data))
+            index = Index.from_bytes(data)
+            index.timestamp = self.index_file.stat().st_mtime_ns
+            return index
         except:
-            return {}
+            return Index()
 
+    @traced("index write")
     def save_index(self,index:Dict[str,str]):
-        self.index_file.write_text(json.dumps(index,indent=2))
+        if not isinstance(index,Index):
+            index = Index(index)
+        if self._index_lock is None:
+            self.write_file_atomic(self.index_file,index.to_bytes())
+        elif self._index_lock:
+            self._index_pending = index.to_bytes()
 
-    def load_object(self,obj_hash:str)->GitObject:
-        obj_dir = self.objects_dir / obj_hash[:2]
-        obj_file = obj_dir / obj_hash[2:]
+    @contextmanager
+    def index_lock(self,wait:bool=True):
+        #index.lock is taken before the index is read and the saved index goes in through it when the block ends,
+        #so two commands changing the index one after the other both keep their entries
+        #a busy lock is waited for up to core.lockTimeout and then it is an error, without wait (status refreshing
+        #stat data) the block runs unlocked and its save_index is dropped, the other writer's index wins
+        if self._index_lock is not None:
+            yield
+            return
+        try:
+            lock = self.lock(self.index_file,None if wait else 0)
+        except RuntimeError:
+            if wait:
+                raise
+            lock = False
+        self._index_lock = lock
+        try:
+            yield
+            if lock and self._index_pending is not None:
+                lock.write(self._index_pending)
+                lock.commit()
+        finally:
+            if lock:
+                lock.rollback()
+            self._index_lock = None
+            self._index_pending = None
 
-        if not obj_file.exists():
+    def load_object(self,obj_hash:str)->GitObject:
+        if self._batch is not None and obj_hash in self._batch:
+            return self._batch.read(obj_hash)
+        obj = self.get_many([obj_hash]).get(obj_hash)
+        if obj is None:
             raise FileNotFoundError(f"Object {obj_hash} not found")
-        return GitObject.deserialize(obj_file.read_bytes())
-    
+        return obj
+
+    def has_many(self,hashes:List[str])->set:
+        #the ones we have, asked of each store once for the whole batch
+        found = set(obj_hash for obj_hash in hashes if obj_hash in self._batch) if self._batch is not None else set()
+        #the pack indexes are in memory, only what they lack costs a filesystem call or a query
+        for store in [self.pack_store] + self.object_stores():
+            rest = [obj_hash for obj_hash in hashes if obj_hash not in found]
+            if not rest:
+                break
+            found |= store.has_many(rest)
+        return found
+
+    def get_many(self,hashes:List[str])->Dict[str,GitObject]:
+        # hash -> object for the ones we have; each store gets one request for what the ones before it lacked
+        objects = {}
+        if self._batch is not None:
+            objects.update((obj_hash,self._batch.read(obj_hash)) for obj_hash in hashes if obj_hash in self._batch)
+        rest = [obj_hash for obj_hash in hashes if obj_hash not in objects]
+        for store in self.object_stores():
+            if not rest:
+                break
+            found = store.get_many(rest)
+            if found:
+                TRACE.count("loose objects read",len(found))
+            for obj_hash,obj in found.items():
+                if obj.type == "chunked":
+                    #manifest of a chunked blob: 20 byte chunk hash + 4 byte size per chunk
+                    manifest = obj.content
+                    obj = Blob(b"".join(self.load_object(manifest[pos:pos + 20].hex()).content for pos in range(0,len(manifest),24)))
+                objects[obj_hash] = obj
+            rest = [obj_hash for obj_hash in rest if obj_hash not in found]
+        if rest:
+            found = self.pack_store.get_many(rest)
+            if found:
+                TRACE.count("packed objects read",len(found))
+            objects.update(found)
+        return objects
+
 
-    def add_file(self,path:str):
+    @locks_index()
+    def add_file(self,path:str,index:Index=None):
         full_path = self.path / path
         if not full_path.exists():
            raise FileNotFoundError(f"Path {path} not found")
          
-        #Read the file content
-        content = full_path.read_bytes()
-
-        #Create BLOB object from the content (Binary Large object) 
-        blob = Blob(content)
-        #store the blob object in database(./git/objects)
-        blob_hash = self.store_object(blob)
+        #index keys are always relative to the repository root ("./a.txt" and "a.txt" are one file)
+        rel_path = full_path.relative_to(self.path).as_posix()
+        cone = self.sparse_cone()
+        if cone is not None and not cone.contains(rel_path):
+            raise ValueError(f"{path} is outside the sparse-checkout cone, add its directory with sparse-checkout add")
+        #stat before reading, if the file changes while we read it the next status sees a new mtime
+        st = full_path.stat()
+        #stream the file into a BLOB object (Binary Large object) in the database(./git/objects)
+        blob_hash = self.store_file(full_path,st)
         #update index to include the file
-        index = self.load_index()
-        index[path] = blob_hash
-        self.save_index(index)
+        save = index is None
+        if save:
+            index = self.load_index()
+        index.set_entry(rel_path,blob_hash,st)
+        if save:
+            self.save_index(index)
 
         print(f"Added {path}")
 
-    def add_directory(self,path:str):
+    @locks_index()
+    def add_directory(self,path:str,index:Index=None):
         full_path = self.path / path
         if not full_path.exists():
            raise FileNotFoundError(f"Path {path} not found")
         if not full_path.is_dir():
             raise ValueError(f"{path} is not a directory")
+        cone = self.sparse_cone()
+        start = full_path.relative_to(self.path).as_posix()
+        if cone is not None and not cone.includes_dir("" if start == "." else start):
+            raise ValueError(f"{path} is outside the sparse-checkout cone, add it with sparse-checkout add")
         
-        ignore_list = set()
-        ignore_file_path = self.path / ".pygitignore"
-        if ignore_file_path.exists():
-            lines = ignore_file_path.read_text().splitlines()
-            ignore_list = {line.strip() for line in lines if line.strip() and not line.startswith("#")}
-
-        index = self.load_index()
-        added_count = 0
-        #recursively traverse the directory
-        for file_path in full_path.rglob("*"):#recursively yield file,directories matching the relative path in the sub tree
-            
-            if file_path.is_file():
+        save = index is None
+        if save:
+            index = self.load_index()
 
-                rel_path = str(file_path.relative_to(self.path)) #we need rel path here file path is abs path
-                if ".pygit" in file_path.parts:
+        def candidates():
+            #recursively traverse the directory, ignored directories are never entered
+            start = full_path.relative_to(self.path).as_posix()
+            _,changed = self.fsmonitor_changes(index)
+            files,_ = self.scan_working_tree(index,"" if start == "." else start,changed)
+            for rel_path in files:
+                #nothing happened to it since the last status found it clean
+                if changed is not None and rel_path in index and not self._touched(rel_path,changed):
                     continue
-                if any(part in ignore_list for part in file_path.parts) or rel_path in ignore_list:
+                file_path = self.path / rel_path
+                with TRACE.phase("stat"):
+                    st = file_path.stat()
+                #same stat as when it was staged, the content can't have changed
+                if rel_path in index and index.is_unchanged(rel_path,st):
                     continue
-                #creat blob objcts for all files
-                content = file_path.read_bytes()
-                new_hash = Blob(content).hash()
-                #improvement:Only store and update if the hash has changed
-                if index.get(rel_path) != new_hash:
-                    blob = Blob(content)
-                    #store all blobs in the object database(.git/objects)
-                    blob_hash = self.store_object(blob)
-                    #update index
-                    index[rel_path] = blob_hash
-                    added_count += 1
-                    print(f"Staged change: {rel_path}")
+                yield rel_path,file_path,st
+
+        def stage(candidate):
+            #runs on the pool: stream, hash and compress files concurrently
+            #hashlib and zlib drop the GIL on big buffers so threads really run in parallel
+            rel_path,file_path,st = candidate
+            recorded = index.stats.get(rel_path)
+            #a different size means different content, only a same-size file may just have been touched
+            if rel_path in index and not (recorded and recorded[3] != st.st_size):
+                #tracked file with a new stat may only have been touched, check before compressing
+                blob_hash = self.hash_file(file_path,st)
+                if blob_hash == index[rel_path]:
+                    return rel_path,blob_hash,st,False
+            #new or modified: hash and write in a single pass
+            return rel_path,self.store_file(file_path,st),st,True
+
+        self.packs() #open the packs before the workers look objects up in them
+        with ThreadPoolExecutor(max_workers=self.worker_count()) as pool:
+            results = list(pool.map(stage,candidates()))
+
+        #merge into the index on this thread, written once by the caller / below
+        added = []
+        for rel_path,blob_hash,st,changed in results:
+            #unchanged content still gets its stat refreshed so we don't hash it again
+            index.set_entry(rel_path,blob_hash,st)
+            if changed:
+                added.append(rel_path)
+        for rel_path in sorted(added):
+            print(f"Staged change: {rel_path}")
+        added_count = len(added)
         
-        self.save_index(index)
+        if save:
+            self.save_index(index)
         if added_count > 0:
             print(f"Added {added_count} files from directory {path}")
         else:
             print(f"Directory {path} already up to date")
         
 
-    def add_path(self,path:str)->None:
+    def add_path(self,path:str,index:Index=None)->None:
         full_path = self.path / path
         if not full_path.exists():
             raise FileNotFoundError(f"Path {path} not found")
         if full_path.is_file():
-            self.add_file(path)
+            self.add_file(path,index)
         elif full_path.is_dir():
-            self.add_directory(path)
+            self.add_directory(path,index)
         else:
             raise ValueError(f"{path} is neither a file nor a directory")
 
-    def create_tree_from_index(self):
-        index = self.load_index()
+    @traced("tree build")
+    def create_tree_from_index(self,index:Index=None)->str:
+        #trees whose cache-tree entry survived (nothing under them changed) are reused as is,
+        #only the directories along changed paths get serialized and stored again
+        if index is None:
+            index = self.load_index()
         if not index:
             tree = Tree()
             return self.store_object(tree)
-        
-        dirs = {}
-        files = {}
-        for file_path,blob_hash in index.items():
-            parts = file_path.split("/")
-            if len(parts) == 1:
-                #file in root
-                files[parts[0]] = blob_hash
-            else:
-                dir_name = parts[0]
-                if dir_name not in dirs:
-                    dirs[dir_name] = {}
-                
-                current = dirs[dir_name]
-                for part in parts[1:-1]: #last part not included
-                    if part not in current:
-                        current[part] = {}
 
-                    current = current[part]   
-                current[parts[-1]] = blob_hash
-
-        def create_tree_recursively(entries_dict:Dict):
-            tree = Tree()
+        paths = index.sorted_paths()
+        cache = index.cache_tree
 
-            for name,blob_hash in entries_dict.items():
-                if isinstance(blob_hash,str):
-                    tree.add_entry("100644",name,blob_hash)
-                
-                if isinstance(blob_hash,dict):
-                    subtree_hash = create_tree_recursively(blob_hash)
-                    tree.add_entry("40000",name,subtree_hash)
-                
-            return self.store_object(tree)
+        def create_tree_recursively(dir_path:str,lo:int,hi:int)->str:
+            #paths[lo:hi] are exactly the entries under dir_path (sorted, so they are contiguous)
+            prefix = dir_path + "/" if dir_path else ""
+            entries = []
+            names = set()
+            i = lo
+            while i < hi:
+                rest = paths[i][len(prefix):]
+                slash = rest.find("/")
+                name = rest if slash == -1 else rest[:slash]
+                #a file and a directory of the same name would be a corrupt tree
+                if name in names:
+                    raise ValueError(f"{prefix + name} is both a file and a directory in the index")
+                names.add(name)
+                if slash == -1:
+                    entries.append((index.mode(paths[i]),rest,index[paths[i]]))
+                    i += 1
+                    continue
+                if slash == len(rest) - 1:
+                    #a directory the sparse index keeps as one entry: its tree is already written
+                    entries.append(("40000",name,index[paths[i]]))
+                    i += 1
+                    continue
+                sub_dir = prefix + name
+                #"0" sorts right after "/", so this skips past everything under sub_dir/
+                j = bisect.bisect_left(paths,sub_dir + "0",i,hi)
+                cached = cache.get(sub_dir)
+                if cached and cached[1] == j - i:
+                    subtree_hash = cached[0]
+                else:
+                    subtree_hash = create_tree_recursively(sub_dir,i,j)
+                entries.append(("40000",name,subtree_hash))
+                i = j
+            tree_hash = self.store_object(Tree(entries))
+            cache[dir_path] = (tree_hash,hi - lo)
+            return tree_hash
 
-        #decomposing it into one root directory
-        root_entries = {**files}
-        for dir_name,dir_contents in dirs.items():
-            root_entries[dir_name] = dir_contents
-        #do we need to write index to with root_dir no index is always a flat list of paths
-        return create_tree_recursively(root_entries)
+        cached = cache.get("")
+        if cached and cached[1] == len(paths):
+            return cached[0]
+        return create_tree_recursively("",0,len(paths))
        
     #current branch is stored in the HEAD file  
     def get_current_branch(self)->str:
@@ -341,53 +3325,428 @@ class Repository:
             return head_content[16:]
         return "HEAD" #detached Head
     
-    #current commit is present in refs/head/filename(pointing to a commit_hash)
-    def get_branch_commit(self,current_branch:str):
-        branch_file = self.heads_dir / current_branch
+    def set_head(self,branch:str):
+        self.write_file_atomic(self.head_file,f"ref: refs/heads/{branch}\n".encode())
 
-        if branch_file.exists():
-            return branch_file.read_text().strip()
-        return None
+    #current commit is present in refs/head/filename(pointing to a commit_hash), or in packed-refs
+    def get_branch_commit(self,current_branch:str):
+        try:
+            commit_hash = (self.heads_dir / current_branch).read_text().strip()
+        except (FileNotFoundError,NotADirectoryError,IsADirectoryError):
+            return self.packed_refs().get(current_branch)
+        return commit_hash or None
 
-    def set_branch_commit(self,current_branch:str,commit_hash):
+    def set_branch_commit(self,current_branch:str,commit_hash,old_hash=...):
         # if file don't exist it auto create it
-        branch_file = self.heads_dir / current_branch
-        branch_file.write_text(commit_hash + "\n")
+        self.update_ref(current_branch,commit_hash,old_hash)
+
+    @staticmethod
+    def check_ref_name(branch:str):
+        parts = branch.split("/")
+        if not branch or any(not part or part.startswith(".") or part.endswith(".lock") for part in parts) \
+                or any(c in branch for c in " ~^:?*[\\") or any(ord(c) < 32 for c in branch):
+            raise ValueError(f"'{branch}' is not a valid branch name")
+
+    def packed_refs(self)->Dict[str,str]:
+        #parsed once and kept until the file is replaced (every rewrite is a rename, so the inode changes)
+        try:
+            st = self.packed_refs_file.stat()
+        except FileNotFoundError:
+            self._packed_refs,self._packed_refs_stat = {},None
+            return self._packed_refs
+        key = (st.st_ino,st.st_mtime_ns,st.st_size)
+        if key != self._packed_refs_stat:
+            refs = {}
+            for line in self.packed_refs_file.read_text().splitlines():
+                if not line or line[0] in "#^":
+                    continue
+                commit_hash,ref = line.split(" ",1)
+                if ref.startswith("refs/heads/"):
+                    refs[ref[len("refs/heads/"):]] = commit_hash
+            self._packed_refs,self._packed_refs_stat = refs,key
+        return self._packed_refs
+
+    def _write_packed_refs(self,lock:LockFile,refs:Dict[str,str]):
+        lines = ["# pack-refs with: sorted\n"]
+        lines.extend(f"{refs[branch]} refs/heads/{branch}\n" for branch in sorted(refs))
+        lock.write("".join(lines).encode())
+        lock.commit()
+
+    def _loose_refs(self,root:Path = None)->Dict[str,str]:
+        refs = {}
+        pending = [(root or self.heads_dir,"")]
+        while pending:
+            dir_path,prefix = pending.pop()
+            try:
+                entries = list(os.scandir(dir_path))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append((entry.path,prefix + entry.name + "/"))
+                elif not entry.name.endswith(".lock"):
+                    try:
+                        with open(entry.path) as f:
+                            commit_hash = f.read().strip()
+                    except FileNotFoundError:
+                        continue #deleted or packed since the listing
+                    if commit_hash:
+                        refs[prefix + entry.name] = commit_hash
+        return refs
+
+    def update_ref(self,branch:str,new_hash:str,old_hash=...)->str:
+        # compare-and-swap under refs/heads/<branch>.lock: old_hash ... skips the check,
+        # None requires the branch to not exist yet, a hash requires the branch to still point there
+        self.check_ref_name(branch)
+        ref_file = self.heads_dir / branch
+        ref_file.parent.mkdir(parents=True,exist_ok=True)
+        with self.lock(ref_file) as lock:
+            current = self.get_branch_commit(branch)
+            if old_hash is not ... and current != old_hash:
+                if old_hash is None:
+                    raise ValueError(f"branch {branch} already exists")
+                raise ValueError(f"branch {branch} is at {current}, expected {old_hash}; it was updated concurrently")
+            lock.write(f"{new_hash}\n".encode())
+            lock.commit()
+        return current
+
+    def delete_ref(self,branch:str,old_hash=...):
+        ref_file = self.heads_dir / branch
+        ref_file.parent.mkdir(parents=True,exist_ok=True) #a packed branch may have no directory left
+        with self.lock(ref_file):
+            current = self.get_branch_commit(branch)
+            if current is None:
+                raise ValueError(f"branch {branch} not found")
+            if old_hash is not ... and current != old_hash:
+                raise ValueError(f"branch {branch} is at {current}, expected {old_hash}; it was updated concurrently")
+            #packed copy first: removing only the loose file would bring the older packed value back
+            if branch in self.packed_refs():
+                with self.lock(self.packed_refs_file) as packed_lock:
+                    refs = dict(self.packed_refs())
+                    refs.pop(branch,None)
+                    self._write_packed_refs(packed_lock,refs)
+            ref_file.unlink(missing_ok=True)
+
+    def pack_refs(self)->int:
+        # moves every loose branch into packed-refs, listing branches then reads a single file
+        with self.lock(self.packed_refs_file) as packed_lock:
+            loose = self._loose_refs()
+            if not loose:
+                return 0
+            refs = dict(self.packed_refs())
+            refs.update(loose)
+            self._write_packed_refs(packed_lock,refs)
+        for branch,commit_hash in loose.items():
+            #a loose ref is only dropped if nobody holds or moved it meanwhile, otherwise it stays and wins
+            try:
+                with self.lock(self.heads_dir / branch,timeout=0):
+                    if self.get_branch_commit(branch) == commit_hash:
+                        (self.heads_dir / branch).unlink(missing_ok=True)
+            except RuntimeError:
+                continue
+        #empty directories left by branches with a / in their name
+        for dir_path,_,_ in sorted(os.walk(self.heads_dir),reverse=True):
+            if dir_path != str(self.heads_dir):
+                try:
+                    os.rmdir(dir_path)
+                except OSError:
+                    pass
+        return len(loose)
         
-    def get_all_files(self)->List[Path]:
-        # why we don't used tree because tree forms only on commit
-        files = []
-        ignore_list = set()
-        ignore_file_path = self.path / ".pygitignore"
-        if ignore_file_path.exists():
-            lines = ignore_file_path.read_text().splitlines()
-            ignore_list = {line.strip() for line in lines if line.strip() and not line.startswith("#")}
-
-        #recursively yield file,directories matching the relative path in the sub tree
-        for file_path in self.path.rglob("*"):
-            if file_path.is_file():
-                if ".pygit" in file_path.parts:
+    @property
+    def commit_graph(self)->CommitGraph:
+        if not self._commit_graph_loaded:
+            self._commit_graph = CommitGraph.load(self.commit_graph_file)
+            self._commit_graph_loaded = True
+        return self._commit_graph
+
+    def update_commit_graph(self)->int:
+        # after commit, merge, fetch and fast-import: rewriting the whole graph every time costs more than the
+        # lookups it saves, so it is only rewritten once commitGraph.maxNewCommits commits outside it have piled up
+        # (gc and `commit-graph write` always rewrite it); lookups parse the commits that aren't in it
+        if not self.get_config("core.commitGraph",True):
+            return 0
+        limit = int(self.get_config("commitGraph.maxNewCommits",100))
+        graph = self.commit_graph
+        new = set()
+        pending = list(self.all_refs().values())
+        while pending and len(new) < limit:
+            commit_hash = pending.pop()
+            if commit_hash in new or (graph and commit_hash in graph):
+                continue
+            new.add(commit_hash)
+            pending.extend(self.commit_parents(commit_hash))
+        return self.write_commit_graph() if len(new) >= limit else 0
+
+    @traced("commit-graph write")
+    def write_commit_graph(self)->int:
+        # everything already in the graph is copied from it, only commits added since are parsed
+        # changed-path filters are copied the same way, only new commits get diffed against their first parent
+        graph = self.commit_graph
+        commits = dict(graph.commits()) if graph else {}
+        changed_paths = self.get_config("commitGraph.changedPaths",True)
+        blooms = {}
+        if changed_paths and graph and graph.bloom_index is not None:
+            blooms = {graph.oid(pos):graph.bloom(pos) for pos in range(graph.count)}
+        pending = list(self.all_refs().values())
+        while pending:
+            commit_hash = pending.pop()
+            if commit_hash in commits:
+                continue
+            commit = Commit.from_content(self.load_object(commit_hash).content)
+            commits[commit_hash] = (commit.tree_hash,commit.parent_hashes,commit.timestamp)
+            pending.extend(commit.parent_hashes)
+        if not commits:
+            return 0
+        if changed_paths:
+            with TRACE.phase("bloom filters"):
+                for commit_hash,(tree,parents,_) in commits.items():
+                    if commit_hash not in blooms:
+                        parent_tree = commits[parents[0]][0] if parents else None
+                        blooms[commit_hash] = CommitGraph.bloom_filter(self.changed_paths(parent_tree,tree,CommitGraph.BLOOM_MAX_PATHS))
+                        TRACE.count("bloom filters computed")
+        CommitGraph.write(self.commit_graph_file,commits,blooms if changed_paths else None)
+        self._commit_graph_loaded = False
+        return len(commits)
+
+    def commit_parents(self,commit_hash:str)->List[str]:
+        graph = self.commit_graph
+        pos = graph.find(commit_hash) if graph else -1
+        if pos >= 0:
+            return [graph.oid(parent) for parent in graph.parents(pos)]
+        return Commit.from_content(self.load_object(commit_hash).content).parent_hashes
+
+    def commit_generation(self,commit_hash:str)->Tuple[int,int]:
+        #(generation,commit time) for ordering walks, commits outside the graph sort as newest
+        graph = self.commit_graph
+        pos = graph.find(commit_hash) if graph else -1
+        if pos >= 0:
+            _,_,generation,commit_time = graph.record(pos)
+            return generation,commit_time
+        return CommitGraph.GENERATION_INFINITY,Commit.from_content(self.load_object(commit_hash).content).timestamp
+
+    def resolve_commit(self,name:str)->str:
+        if name == "HEAD":
+            commit_hash = self.get_branch_commit(self.get_current_branch())
+        elif self.get_branch_commit(name):
+            commit_hash = self.get_branch_commit(name)
+        elif name == "FETCH_HEAD" and self.fetch_head_file.exists():
+            commit_hash = self.fetch_head_file.read_text().split("\t",1)[0]
+        elif "/" in name and self.remote_refs(name.split("/",1)[0]).get(name.split("/",1)[1]):
+            commit_hash = self.remote_refs(name.split("/",1)[0])[name.split("/",1)[1]]
+        else:
+            commit_hash = name
+        if commit_hash and len(commit_hash) == 40:
+            try:
+                if self.load_object(commit_hash).type == "commit":
+                    return commit_hash
+            except (FileNotFoundError,ValueError):
+                pass
+        raise ValueError(f"unknown revision {name}")
+
+    def is_ancestor(self,ancestor:str,descendant:str)->bool:
+        #only commits with a generation >= the ancestor's can still reach it, everything below is pruned
+        graph = self.commit_graph
+        min_generation = 0
+        if graph and ancestor in graph:
+            min_generation = self.commit_generation(ancestor)[0]
+        seen = {descendant}
+        stack = [descendant]
+        while stack:
+            commit_hash = stack.pop()
+            if commit_hash == ancestor:
+                return True
+            for parent in self.commit_parents(commit_hash):
+                if parent not in seen and self.commit_generation(parent)[0] >= min_generation:
+                    seen.add(parent)
+                    stack.append(parent)
+        return False
+
+    def merge_bases(self,first:str,second:str)->List[str]:
+        # paint both sides down in generation order (children always before parents), a commit reached
+        # from both sides is a merge base and everything below it is stale
+        if first == second:
+            return [first]
+        PARENT1,PARENT2,STALE = 1,2,4
+        flags = {first:PARENT1,second:PARENT2}
+        queue = []
+        for commit_hash in (first,second):
+            generation,commit_time = self.commit_generation(commit_hash)
+            heapq.heappush(queue,(-generation,-commit_time,commit_hash))
+        results = []
+        while any(not flags[commit_hash] & STALE for _,_,commit_hash in queue):
+            _,_,commit_hash = heapq.heappop(queue)
+            paint = flags[commit_hash] & (PARENT1 | PARENT2 | STALE)
+            if paint == PARENT1 | PARENT2:
+                if commit_hash not in results:
+                    results.append(commit_hash)
+                paint |= STALE
+            for parent in self.commit_parents(commit_hash):
+                if flags.get(parent,0) & paint == paint:
                     continue
-                if any(part in ignore_list for part in file_path.parts):
+                flags[parent] = flags.get(parent,0) | paint
+                generation,commit_time = self.commit_generation(parent)
+                heapq.heappush(queue,(-generation,-commit_time,parent))
+        #a base reachable from another base is not a best common ancestor
+        return [commit_hash for commit_hash in results if not flags[commit_hash] & STALE]
+
+    def fsmonitor_request(self,request:dict)->dict:
+        #None when no daemon is listening, callers then fall back to scanning
+        socket_path = self.get_dir / "fsmonitor.sock"
+        if not socket_path.exists():
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as client:
+                client.settimeout(5)
+                client.connect(str(socket_path))
+                client.sendall(json.dumps(request).encode() + b"\n")
+                return json.loads(client.makefile("rb").readline())
+        except (OSError,ValueError):
+            return None
+
+    def fsmonitor_changes(self,index:Index)->Tuple[str,set]:
+        #(new token,paths that may differ from the index) or (token,None) when everything has to be checked
+        #a path can be a directory, it then stands for everything below it
+        if not self.get_config("core.fsmonitor",False):
+            return None,None
+        reply = self.fsmonitor_request({"command":"query","token":index.fsmonitor_token})
+        if not reply or "token" not in reply:
+            return None,None
+        if index.fsmonitor_token is None or reply.get("paths") is None:
+            return reply["token"],None
+        return reply["token"],index.fsmonitor_dirty | set(reply["paths"])
+
+    @staticmethod
+    def _touched(path:str,changed:set)->bool:
+        #path or one of the directories above it changed
+        while path:
+            if path in changed:
+                return True
+            path = path.rpartition("/")[0]
+        return False
+
+    def start_fsmonitor(self)->bool:
+        if self.fsmonitor_request({"command":"status"}):
+            return False
+        subprocess.Popen([sys.executable,os.path.abspath(__file__),"fsmonitor","run"],cwd=self.path,
+                         stdin=subprocess.DEVNULL,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,start_new_session=True)
+        #wait until it listens, the first query after this already gets a token
+        deadline = time.time() + 5
+        while not self.fsmonitor_request({"command":"status"}):
+            if time.time() > deadline:
+                raise RuntimeError("fsmonitor daemon did not start")
+            time.sleep(0.05)
+        self.set_config("core.fsmonitor",True)
+        return True
+
+    def stop_fsmonitor(self)->bool:
+        self.set_config("core.fsmonitor",False)
+        return self.fsmonitor_request({"command":"stop"}) is not None
+
+    def ignore_rules(self)->Tuple[IgnoreRules,bytes]:
+        #the digest tells a cached untracked listing which rules it was filtered with
+        ignore_file_path = self.path / ".pygitignore"
+        data = ignore_file_path.read_bytes() if ignore_file_path.exists() else b""
+        return IgnoreRules(data.decode(errors="replace").splitlines()),hashlib.sha1(data).digest()
+
+    @traced("walk")
+    def scan_working_tree(self,index:Index,start:str = "",changed:set = None)->Tuple[List[str],bool]:
+        #every non-ignored file under start (relative to the repository), ignored directories are pruned
+        #a directory whose mtime still matches the untracked cache is not listed again:
+        #adding, removing or renaming an entry always bumps the mtime of its directory
+        #with the fsmonitor's changed paths, cached directories nothing changed in are not even stat'ed
+        rules,digest = self.ignore_rules()
+        use_cache = bool(self.get_config("core.untrackedCache",True))
+        cache = index.untracked_cache if use_cache else {}
+        cache_changed = False
+        if use_cache and index.untracked_digest != digest:
+            cache.clear()
+            index.untracked_digest = digest
+            cache_changed = True
+
+        changed_dirs = {path.rpartition("/")[0] for path in changed} if changed is not None else None
+        #directories outside the sparse-checkout cone are not entered, the cache keeps them listed anyway
+        cone = self.sparse_cone()
+        visited = {}
+        files = []
+        stack = [start]
+        while stack:
+            dir_path = stack.pop()
+            cached = cache.get(dir_path)
+            if cached and changed is not None and dir_path not in changed_dirs and not self._touched(dir_path,changed):
+                visited[dir_path] = cached
+                prefix = dir_path + "/" if dir_path else ""
+                files.extend(prefix + name for name in cached[1])
+                stack.extend(prefix + name for name in cached[2] if cone is None or cone.includes_dir(prefix + name))
+                continue
+            try:
+                mtime = os.stat(self.path / dir_path).st_mtime_ns
+            except OSError:
+                continue
+            #racy clean like file stats: a listing taken in the same mtime tick as a change can't be trusted
+            if cached and cached[0] == mtime and mtime < index.timestamp:
+                names,subdirs = cached[1],cached[2]
+            else:
+                names,subdirs = [],[]
+                try:
+                    with os.scandir(self.path / dir_path) as entries:
+                        for entry in entries:
+                            if entry.name == ".pygit":
+                                continue
+                            rel_path = f"{dir_path}/{entry.name}" if dir_path else entry.name
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            if rules.is_ignored(rel_path,is_dir):
+                                continue
+                            if is_dir:
+                                subdirs.append(entry.name)
+                            elif entry.is_file():
+                                names.append(entry.name)
+                except OSError:
                     continue
-                files.append(file_path)
-        return files
+                cache_changed = cache_changed or use_cache
+            visited[dir_path] = (mtime,names,subdirs)
+            prefix = dir_path + "/" if dir_path else ""
+            files.extend(prefix + name for name in names)
+            stack.extend(prefix + name for name in subdirs if cone is None or cone.includes_dir(prefix + name))
+
+        if use_cache:
+            if start:
+                cache.update(visited)
+            else:
+                #a walk from the root saw every directory, forget the ones that are gone
+                cache_changed = cache_changed or cache.keys() != visited.keys()
+                cache.clear()
+                cache.update(visited)
+        return files,cache_changed
+
+    def get_all_files(self)->List[Path]:
+        # why we don't used tree because tree forms only on commit
+        # with a sparse checkout only the files inside the cone
+        files,_ = self.scan_working_tree(self.load_index())
+        return [self.path / rel_path for rel_path in files]
 
 
+    @locks_index()
     def commit(self,message:str,author:str):
+        index = self.load_index()
+        if not index:
+            print("nothing to commit working tree clean")
+            return None
+
         # create the tree object from the index (staging area)
-        tree_hash = self.create_tree_from_index()
+        tree_hash = self.create_tree_from_index(index)
+        #keep the refreshed cache tree so the next commit only rebuilds what changes
+        self.save_index(index)
 
         current_branch = self.get_current_branch()
         parent_commit = self.get_branch_commit(current_branch)
         parent_hashes = [parent_commit] if parent_commit else [] #subsequent commit: parent_commit holds the hash of the previous commit. This line creates a list with that one hash inside it: ["abc123..."].
-        
-        index = self.load_index()
-        if not index:
-            print("nothing to commit working tree clean")
-            return None
-        
-        if parent_commit:
+        #concluding a merge that stopped on conflicts: the merged commit is the second parent
+        merge_head = self.merge_head_file.read_text().strip() if self.merge_head_file.exists() else None
+        if merge_head:
+            parent_hashes.append(merge_head)
+
+        if parent_commit and not merge_head:
             parent_git_commit_obj = self.load_object(parent_commit)
             parent_commit_data = Commit.from_content(parent_git_commit_obj.content) 
             if tree_hash == parent_commit_data.tree_hash:
@@ -403,121 +3762,409 @@ class Repository:
         )
         #Save the commit object to the objects database
         commit_hash = self.store_object(commit)
-        # 5. UPDATE THE BRANCH POINTER
-        self.set_branch_commit(current_branch,commit_hash)
-        self.save_index({})
+        # 5. UPDATE THE BRANCH POINTER, only if no other process moved it since we read the parent
+        self.set_branch_commit(current_branch,commit_hash,parent_commit)
+        self.merge_head_file.unlink(missing_ok=True)
+        #the index keeps describing the committed tree, clearing it would throw away the stat cache
+        self.update_commit_graph()
         print(f"Created commit {commit_hash} on branch {current_branch}")
         return commit_hash
 
 
     def get_files_from_tree_recursive(self,tree_hash:str,prefix:str=""):
-        files = {}
-        try:
-            tree_obj = self.load_object(tree_hash)
-            tree = Tree.from_content(tree_obj.content)
-            #list<tuple<str,str,str>>
-            for mode,name,obj_hash in tree.entries:
-                rel_path = f"{prefix}/{name}" if prefix else name
+        #sibling subtrees are read concurrently instead of one round trip after another
+        files = self.run_async(lambda reader: reader.tree_files(tree_hash,prefix))
+        return {path:obj_hash for path,(_,obj_hash) in files.items()}
 
-                if mode == "40000":
-                    subtree_files = self.get_files_from_tree_recursive(
-                        obj_hash , rel_path
-                    )
-                    files.update(subtree_files)
-                else:
-                    files[rel_path] = obj_hash
-        except Exception as e:
-            print(f"Warning: Could not read tree {tree_hash}: {e}")
-        return files
+    def get_commit_tree(self,commit_hash:str)->str:
+        if not commit_hash:
+            return None
+        graph = self.commit_graph
+        pos = graph.find(commit_hash) if graph else -1
+        if pos >= 0:
+            return graph.record(pos)[0]
+        return Commit.from_content(self.load_object(commit_hash).content).tree_hash
 
     def is_dirty(self)->bool:
         index = self.load_index()
+        _,changed = self.fsmonitor_changes(index)
+        cone = self.sparse_cone()
 
         #Compare Index to Working Directory 
         for rel_path,blob_hash in index.items():
+            if changed is not None and not self._touched(rel_path,changed):
+                continue
+            #outside the sparse-checkout cone there is nothing on disk to compare
+            if cone is not None and not cone.contains(rel_path):
+                continue
             full_path = self.path / rel_path
             if not full_path.exists():
                 return True # File was deleted manually
             
+            #stat matches what was staged, no need to read the file
+            if index.is_unchanged(rel_path,full_path.stat()):
+                continue
             # Read current file and see if its hash matches the index
-            current_content = full_path.read_bytes()
-            current_blob = Blob(current_content)
-            if current_blob.hash() != blob_hash:
+            if self.hash_file(full_path) != blob_hash:
                 return True #File has been modified but not added
             
-            #2 Compare Head to Index
-            head_files ={}
-            current_branch = self.get_current_branch()
-            head_commit_hash = self.get_branch_commit(current_branch)
-            if head_commit_hash:
-                head_commit_obj = self.load_object(head_commit_hash)
-                head_commit = Commit.from_content(head_commit_obj.content)
-                if head_commit.tree_hash:
-                    head_files = self.get_files_from_tree_recursive(head_commit.tree_hash)
-
-            if head_files != index:
-                return True # There are staged changed not yet commited
-        return False    
-
-    def restore_tree(self,tree_hash:str,path:Path):
-        # this function is to write back to file
-        try:
-            tree_obj = self.load_object(tree_hash)
-            tree = Tree.from_content(tree_obj.content)
-            for mode,name,obj_hash in tree.entries:
-                file_path = path / name
-                if mode.startswith("100"):
-                    blob_obj = self.load_object(obj_hash)
-                    blob = Blob(blob_obj.content)
-                    file_path.write_bytes(blob.content)
-                elif mode.startswith("400"):
-                    file_path.mkdir(exist_ok=True)
-                    self.restore_tree(
-                        obj_hash,file_path
-                    )
-                  
-        except Exception as e:
-            print(f"Warning: Could not read tree {tree_hash}: {e}")
+        #2 Compare Head to Index, once, outside the loop
+        head_tree = self.get_commit_tree(self.get_branch_commit(self.get_current_branch()))
+        if not head_tree:
+            return bool(index)
+        #a valid cache tree already is the tree the index would commit
+        cached = index.cache_tree.get("")
+        if cached and cached[1] == len(index):
+            return cached[0] != head_tree
+        staged,head_only = self._staged_changes(index,head_tree)
+        return bool(staged or head_only) # There are staged changed not yet commited
 
-        
+    def read_tree_entries(self,tree_hash:str)->Dict[str,Tuple[str,str]]:
+        if not tree_hash:
+            return {}
+        tree = Tree.from_content(self.load_object(tree_hash).content)
+        return {name:(mode,obj_hash) for mode,name,obj_hash in tree.entries}
 
-    def restore_working_directory(self,branch:str,files_to_clear:Dict[str,str]):
-        target_commit_hash = self.get_branch_commit(branch)
-        if not target_commit_hash:
+    @traced("tree diff")
+    def diff_trees(self,old_tree:str,new_tree:str,prefix:str="",cone:SparseCone = None)->List[Tuple[str,Tuple[str,str],Tuple[str,str]]]:
+        # (path,(old mode,old hash),(new mode,new hash)) for every file that differs, None for a missing side
+        # subtrees with equal hashes are skipped without reading them
+        # with a cone (for a sparse index) a differing directory outside it is one ("dir/",tree,tree) change
+        changes = []
+        if old_tree == new_tree:
+            return changes
+        old_entries = self.read_tree_entries(old_tree)
+        new_entries = self.read_tree_entries(new_tree)
+        for name in sorted(old_entries.keys() | new_entries.keys()):
+            old = old_entries.get(name)
+            new = new_entries.get(name)
+            if old == new:
+                continue
+            path = prefix + name
+            old_dir = old[1] if old and old[0] == "40000" else None
+            new_dir = new[1] if new and new[0] == "40000" else None
+            if old_dir or new_dir:
+                if cone is not None and not cone.includes_dir(path):
+                    changes.append((path + "/",("40000",old_dir) if old_dir else None,("40000",new_dir) if new_dir else None))
+                else:
+                    changes.extend(self.diff_trees(old_dir,new_dir,path + "/",cone))
+            old_file = old if old and not old_dir else None
+            new_file = new if new and not new_dir else None
+            if old_file or new_file:
+                changes.append((path,old_file,new_file))
+        return changes
+
+    def changed_paths(self,old_tree:str,new_tree:str,limit:int)->set:
+        #files and directories that differ between two trees, None as soon as there are more than limit
+        paths = set()
+
+        def walk(old_tree:str,new_tree:str,prefix:str)->bool:
+            old_entries = self.read_tree_entries(old_tree)
+            new_entries = self.read_tree_entries(new_tree)
+            for name in old_entries.keys() | new_entries.keys():
+                old = old_entries.get(name)
+                new = new_entries.get(name)
+                if old == new:
+                    continue
+                path = prefix + name
+                paths.add(path)
+                if len(paths) > limit:
+                    return False
+                old_dir = old[1] if old and old[0] == "40000" else None
+                new_dir = new[1] if new and new[0] == "40000" else None
+                if (old_dir or new_dir) and not walk(old_dir,new_dir,path + "/"):
+                    return False
+            return True
+
+        if old_tree != new_tree and not walk(old_tree,new_tree,""):
+            return None
+        return paths
+
+    def find_in_tree(self,tree_hash:str,path:str)->Tuple[str,str]:
+        #(mode,hash) of path inside tree_hash or None, one Tree.find per directory level
+        entry = ("40000",tree_hash)
+        for name in path.split("/"):
+            if not entry[1] or entry[0] != "40000":
+                return None
+            entry = Tree.from_content(self.load_object(entry[1]).content).find(name)
+            if entry is None:
+                return None
+        return entry
+
+    @staticmethod
+    def _split_lines(content:bytes)->List[bytes]:
+        #lines keep their "\n", only a last line without one comes back bare
+        lines = content.split(b"\n")
+        last = lines.pop()
+        lines = [line + b"\n" for line in lines]
+        if last:
+            lines.append(last)
+        return lines
+
+    def _print_diff(self,path:str,old:Tuple[str,bytes],new:Tuple[str,bytes]):
+        #old/new: (mode,content) or None for a missing side, printed as a unified diff with 3 lines of context
+        print(f"diff --git a/{path} b/{path}")
+        if old is None:
+            print(f"new file mode {new[0]}")
+        elif new is None:
+            print(f"deleted file mode {old[0]}")
+        elif old[0] != new[0]:
+            print(f"old mode {old[0]}")
+            print(f"new mode {new[0]}")
+        old_content = old[1] if old else b""
+        new_content = new[1] if new else b""
+        if old and new and old_content == new_content:
             return
-        
-        #load the file of checkout branch
-        target_commit_obj = self.load_object(target_commit_hash)
-        target_commit = Commit.from_content(target_commit_obj.content)
-        # This gives us EXACTLY what the index needs to look like
-        new_files = self.get_files_from_tree_recursive(target_commit.tree_hash)
-        
-        #SMART CLEAR: Only delete files that are NOT in the new branch
-        # remove the files from working_Dir tracked by previous branch
-        for rel_path in files_to_clear.keys():
-            if rel_path not in new_files:
-                file_path = self.path / rel_path # we need absolute path
+        if b"\0" in old_content[:8000] or b"\0" in new_content[:8000]:
+            print(f"Binary files {'a/' + path if old else '/dev/null'} and {'b/' + path if new else '/dev/null'} differ")
+            return
+        print(f"--- {'a/' + path if old else '/dev/null'}")
+        print(f"+++ {'b/' + path if new else '/dev/null'}")
+        for line in unified_hunks(self._split_lines(old_content),self._split_lines(new_content)):
+            text = line.decode(errors="replace")
+            print(text if text.endswith("\n") else text + "\n\\ No newline at end of file\n",end="")
+
+    def _blob_side(self,entry:Tuple[str,str])->Tuple[str,bytes]:
+        return None if entry is None else (entry[0],self.load_object(entry[1]).content)
+
+    def diff(self,commits:List[str] = None,cached:bool = False):
+        # two commits: tree vs tree, --cached: HEAD vs index, otherwise index vs working tree
+        # equal subtrees and blobs (by hash, or by stat for working files) are skipped before any content is read
+        if commits:
+            if len(commits) != 2:
+                raise ValueError("diff compares exactly two commits")
+            old_tree,new_tree = (self.get_commit_tree(self.resolve_commit(name)) for name in commits)
+            for path,old,new in self.diff_trees(old_tree,new_tree):
+                self._print_diff(path,self._blob_side(old),self._blob_side(new))
+            return
+
+        index = self.load_index()
+        if cached:
+            head_tree = self.get_commit_tree(self.get_branch_commit(self.get_current_branch()))
+            staged,head_only = self._staged_changes(index,head_tree)
+            changes = [(path,self.find_in_tree(head_tree,path),self.index_entry(index,path)) for _,path in staged]
+            changes += [(path,self.find_in_tree(head_tree,path),None) for path in head_only]
+            for path,old,new in sorted(changes,key=lambda change: change[0]):
+                self._print_diff(path,self._blob_side(old),self._blob_side(new))
+            return
+
+        _,changed = self.fsmonitor_changes(index)
+        cone = self.sparse_cone()
+        for path in sorted(index):
+            if changed is not None and not self._touched(path,changed):
+                continue
+            if cone is not None and not cone.contains(path):
+                continue
+            full_path = self.path / path
             try:
-                if file_path.is_file():
-                    file_path.unlink()
-                #removing empty directory
-                elif file_path.is_dir():
-                    if not any(file_path.iterdir()):
-                        file_path.rmdir()
-            except Exception:
+                st = full_path.stat()
+            except OSError:
+                st = None
+            if st is None or st.st_mode & 0o170000 != 0o100000:
+                new = None
+            elif index.is_unchanged(path,st):
+                continue
+            else:
+                content = full_path.read_bytes()
+                mode = "100755" if st.st_mode & 0o111 else "100644"
+                if mode == index.mode(path) and Blob(content).hash() == index[path]:
+                    continue
+                new = (mode,content)
+            self._print_diff(path,self._blob_side((index.mode(path),index[path])),new)
+
+    def _remove_empty_dirs(self,dir_path:Path):
+        while dir_path != self.path:
+            try:
+                dir_path.rmdir()
+            except OSError:
+                return #not empty (or already gone)
+            dir_path = dir_path.parent
+
+    def apply_tree_changes(self,changes:List[Tuple[str,Tuple[str,str],Tuple[str,str]]],index:Index):
+        # make the working directory and index follow `changes` (from diff_trees), nothing else is touched
+        # outside the sparse-checkout cone only the index follows ("dir/" changes of a sparse index included)
+        cone = self.sparse_cone()
+        #checked before anything is touched, a checkout that can't finish leaves everything as it was
+        blockers = self._untracked_in_the_way(changes,cone)
+        if blockers:
+            listed = ", ".join(blockers[:10]) + (f" and {len(blockers) - 10} more" if len(blockers) > 10 else "")
+            raise ValueError(f"untracked working tree files would be overwritten: {listed}, move or remove them first")
+        #deletions first, a path may turn from a file into a directory or back
+        for path,old,new in changes:
+            if new is None:
+                if cone is None or cone.contains(path):
+                    self._remove_files([path])
+                if path in index:
+                    del index[path]
+
+        writes = []
+        for path,old,new in changes:
+            if new is None:
+                continue
+            if cone is None or cone.contains(path):
+                writes.append((path,old,new))
+            else:
+                index.set_entry(path,new[1],mode=new[0])
+        for path,blob_hash,mode,st in self._write_files(writes):
+            index.set_entry(path,blob_hash,st,mode)
+
+    def _untracked_in_the_way(self,changes:List[Tuple[str,Tuple[str,str],Tuple[str,str]]],cone:SparseCone)->List[str]:
+        #untracked files that applying `changes` would lose: one where a new file goes, whatever is left in a
+        #directory that becomes a file, one where a new directory goes; only new paths can meet them
+        tracked = {path for path,old,_ in changes if old is not None}
+        blockers = []
+        checked_dirs = set()
+        for path,old,new in changes:
+            if old is not None or new is None or (cone is not None and not cone.contains(path)):
+                continue
+            full_path = self.path / path
+            if full_path.is_dir() and not full_path.is_symlink():
+                for dir_path,_,files in os.walk(full_path):
+                    prefix = Path(dir_path).relative_to(self.path).as_posix() + "/"
+                    blockers.extend(prefix + name for name in files if prefix + name not in tracked)
+            elif os.path.lexists(full_path):
+                blockers.append(path)
+            parent = path.rpartition("/")[0]
+            while parent and parent not in checked_dirs:
+                checked_dirs.add(parent)
+                parent_path = self.path / parent
+                if parent not in tracked and os.path.lexists(parent_path) and not parent_path.is_dir():
+                    blockers.append(parent)
+                parent = parent.rpartition("/")[0]
+        return sorted(set(blockers))
+
+    def _remove_files(self,paths:List[str]):
+        for path in paths:
+            file_path = self.path / path
+            try:
+                file_path.unlink()
+            except FileNotFoundError:
                 pass
+            self._remove_empty_dirs(file_path.parent)
 
-        
-        # Restore/Overwrite files from the NEW branch
-        if target_commit.tree_hash:
-            self.restore_tree(target_commit.tree_hash,self.path)
-            
-        # Update index to match the new branch state
-        self.save_index(new_files)
+    def _write_files(self,writes:List[Tuple[str,Tuple[str,str],Tuple[str,str]]])->List[Tuple[str,str,str,os.stat_result]]:
+        # (path,old,new) -> (path,hash,mode,stat) once written, on the pool
+        for path,_,_ in writes:
+            (self.path / path).parent.mkdir(parents=True,exist_ok=True)
+
+        def write(change):
+            path,old,new = change
+            mode,blob_hash = new
+            file_path = self.path / path
+            #same content, only the mode changed: chmod is enough
+            if not (old and old[1] == blob_hash and file_path.is_file()):
+                content = self.load_object(blob_hash).content
+                with TRACE.phase("checkout write"):
+                    file_path.write_bytes(content)
+            with TRACE.phase("checkout write"):
+                if mode == "100755" or (old and old[0] != mode):
+                    os.chmod(file_path,0o755 if mode == "100755" else 0o644)
+                return path,blob_hash,mode,file_path.stat()
+
+        if not writes:
+            return []
+
+        def write_all(part):
+            return [write(change) for change in part]
+
+        #up to io_concurrency slices read and write at once, each holds one blob's content at a time
+        step = -(-len(writes) // self.io_concurrency())
+        parts = [writes[i:i + step] for i in range(0,len(writes),step)]
+        results = self.run_async(lambda reader: asyncio.gather(*(reader.run(write_all,part) for part in parts)))
+        return [result for part in results for result in part]
+
+    def sparse_cone(self)->SparseCone:
+        #None unless core.sparseCheckout is on
+        if not self._sparse_cone_loaded:
+            self._sparse_cone_loaded = True
+            if self.get_config("core.sparseCheckout",False):
+                try:
+                    self._sparse_cone = SparseCone(self.sparse_file.read_text().splitlines())
+                except FileNotFoundError:
+                    self._sparse_cone = SparseCone([])
+        return self._sparse_cone
+
+    def index_entry(self,index:Index,path:str)->Tuple[str,str]:
+        #(mode,hash) the index has for path, looked up in the tree of a sparse "dir/" entry if need be
+        if path in index:
+            return index.mode(path),index[path]
+        end = path.find("/")
+        while end != -1:
+            if path[:end + 1] in index:
+                return self.find_in_tree(index[path[:end + 1]],path[end + 1:])
+            end = path.find("/",end + 1)
+        return None
+
+    @locks_index()
+    def sparse_checkout(self,action:str,dirs:List[str] = None):
+        # set/add: change the cone, disable: check everything out again, reapply: rebuild for the current
+        # cone and index.sparse. The index is rebuilt from HEAD (keeping the stat data of files that stay),
+        # files leaving the cone are deleted and files entering it written
+        old_cone = self.sparse_cone()
+        if action == "list":
+            for dir_path in old_cone.dirs if old_cone else []:
+                print(dir_path)
+            return
+        if self.is_dirty():
+            raise ValueError("Your local changes would be overwritten by sparse-checkout, commit them first")
+        if action == "disable":
+            new_cone = None
+        elif action == "reapply":
+            new_cone = old_cone
+        else:
+            new_cone = SparseCone((old_cone.dirs if action == "add" and old_cone else []) + list(dirs or []))
+
+        old_index = self.load_index()
+        head_tree = self.get_commit_tree(self.get_branch_commit(self.get_current_branch()))
+        sparse_index = new_cone is not None and bool(self.get_config("index.sparse",True))
+        index = self._index_from_tree(head_tree,new_cone if sparse_index else None)
+        before = {path:(old_index.mode(path),old_index[path]) for path in old_index if old_cone is None or old_cone.contains(path)}
+        after = {path:(index.mode(path),index[path]) for path in index if new_cone is None or new_cone.contains(path)}
+        self._remove_files([path for path in before if path not in after])
+        for path,blob_hash,mode,st in self._write_files([(path,None,entry) for path,entry in after.items() if before.get(path) != entry]):
+            index.set_entry(path,blob_hash,st,mode)
+        for path,entry in after.items():
+            if before.get(path) == entry and path in old_index.stats:
+                index.stats[path] = old_index.stats[path]
+        index.untracked_cache = old_index.untracked_cache
+        index.untracked_digest = old_index.untracked_digest
+        self.save_index(index)
+
+        if new_cone is None:
+            self.set_config("core.sparseCheckout",False)
+            self.sparse_file.unlink(missing_ok=True)
+        else:
+            self.sparse_file.parent.mkdir(exist_ok=True)
+            self.write_file_atomic(self.sparse_file,"".join(dir_path + "\n" for dir_path in new_cone.dirs).encode())
+            self.set_config("core.sparseCheckout",True)
+        self._sparse_cone = new_cone
+        print(f"{len(after)} files checked out" + (f", {len(index) - len(after)} index entries outside the cone" if new_cone else ""))
 
+    @locks_index()
+    def restore_working_directory(self,branch:str,previous_commit_hash:str):
+        target_commit_hash = self.get_branch_commit(branch)
+        if not target_commit_hash:
+            return
+        
+        #only the paths that differ between the two commits are written or deleted
+        target_tree = self.get_commit_tree(target_commit_hash)
+        previous_tree = self.get_commit_tree(previous_commit_hash)
 
+        #the index matches the previous commit (checkout refuses dirty trees), so it is updated in place
+        #and every untouched entry keeps its stat data and cached subtree
+        index = self.load_index() if previous_tree else Index()
+        cone = self.sparse_cone()
+        if not previous_tree:
+            index.sparse = cone is not None and bool(self.get_config("index.sparse",True))
+        #a sparse index takes the directories outside the cone as a whole, nothing under them is read
+        changes = self.diff_trees(previous_tree,target_tree,cone = cone if index.sparse else None)
+        self.apply_tree_changes(changes,index)
+        #re-fill the cache tree, only directories along the changed paths are recomputed
+        self.create_tree_from_index(index)
+        self.save_index(index)
 
 
+    @locks_index()
     def checkout(self,branch:str,create_branch:bool):
         #safety check
         if self.is_dirty():
@@ -525,28 +4172,14 @@ class Repository:
             print("Please commit your changes or stash them before you switch branches.")
             return
         
-        #computed the files to clear from the prevous commit
         previous_branch = self.get_current_branch()
-        files_to_clear = {}
-        try:
-            previous_commit_hash = self.get_branch_commit(previous_branch)
-            if previous_commit_hash:
-                previous_commit_object = self.load_object(previous_commit_hash)
-                prev_commit = Commit.from_content(previous_commit_object.content)
-                if prev_commit.tree_hash:
-                    files_to_clear = self.get_files_from_tree_recursive(
-                        prev_commit.tree_hash
-                    )
-        
-        except Exception:
-            files_to_clear = {}
+        previous_commit_hash = self.get_branch_commit(previous_branch)
 
         #created a new branch
-        branch_file = self.heads_dir / branch
-        if not branch_file.exists():
+        if self.get_branch_commit(branch) is None:
             if create_branch:
                 if previous_commit_hash:
-                    self.set_branch_commit(branch,previous_commit_hash)
+                    self.set_branch_commit(branch,previous_commit_hash,None)
                     print(f"Created the new branch")
                 else:
                     print("No commits yet, cannot create a branch")
@@ -559,12 +4192,145 @@ class Repository:
                 )
                 return
 
-        self.head_file.write_text(f"ref: refs/heads/{branch}\n")
-        #restore working directory remove the files prev_branch and add load the files of curr_branch
-        self.restore_working_directory(branch,files_to_clear) 
+        #update the working directory from the previous commit to the one of the new branch,
+        #HEAD only moves once the files and the index are there
+        self.restore_working_directory(branch,previous_commit_hash)
+        self.set_head(branch)
         print(f"Switched to branch {branch}")   
 
 
+    def _merge_blobs(self,base:Tuple[str,str],ours:Tuple[str,str],theirs:Tuple[str,str],labels:Tuple[str,str])->Tuple[Tuple[str,str],bool]:
+        #((mode,hash),clean) of a file both sides changed, the result is stored even with conflict markers in it
+        mode = theirs[0] if base and base[0] == ours[0] else ours[0]
+        base_content = self.load_object(base[1]).content if base else b""
+        ours_content = self.load_object(ours[1]).content
+        theirs_content = self.load_object(theirs[1]).content
+        if b"\0" in ours_content[:8000] or b"\0" in theirs_content[:8000] or b"\0" in base_content[:8000]:
+            return ours,False #binary: keep ours, nothing sensible to mark up
+        merged,clean = merge3(self._split_lines(base_content),self._split_lines(ours_content),self._split_lines(theirs_content),labels)
+        return (mode,self.store_object(Blob(merged))),clean
+
+    def _merge_trees(self,base:str,ours:str,theirs:str,prefix:str,conflicts:List[Tuple[str,str]],labels:Tuple[str,str])->str:
+        # three-way merge of two trees, returns the merged tree hash (None when it ends up empty)
+        # a subtree only one side changed is taken as a whole, only subtrees both sides changed are read
+        if ours == theirs or base == theirs:
+            return ours
+        if base == ours:
+            return theirs
+        base_entries = self.read_tree_entries(base)
+        ours_entries = self.read_tree_entries(ours)
+        theirs_entries = self.read_tree_entries(theirs)
+        entries = []
+        for name in sorted(base_entries.keys() | ours_entries.keys() | theirs_entries.keys()):
+            base_entry,ours_entry,theirs_entry = base_entries.get(name),ours_entries.get(name),theirs_entries.get(name)
+            path = prefix + name
+            if ours_entry == theirs_entry or base_entry == theirs_entry:
+                result = ours_entry
+            elif base_entry == ours_entry:
+                result = theirs_entry
+            elif all(entry is None or entry[0] == "40000" for entry in (base_entry,ours_entry,theirs_entry)):
+                #directories on every side that has the name: merge inside them
+                subtree = self._merge_trees(*(entry[1] if entry else None for entry in (base_entry,ours_entry,theirs_entry)),path + "/",conflicts,labels)
+                result = ("40000",subtree) if subtree else None
+            elif ours_entry and theirs_entry and "40000" not in (ours_entry[0],theirs_entry[0]):
+                base_file = base_entry if base_entry and base_entry[0] != "40000" else None
+                result,clean = self._merge_blobs(base_file,ours_entry,theirs_entry,labels)
+                if not clean:
+                    conflicts.append((path,"content"))
+            elif ours_entry is None or theirs_entry is None:
+                #changed on one side, deleted on the other: the changed version stays for the user to decide
+                result = ours_entry or theirs_entry
+                conflicts.append((path,"modify/delete"))
+            else:
+                result = ours_entry
+                conflicts.append((path,"file/directory"))
+            if result:
+                entries.append((result[0],name,result[1]))
+        if not entries:
+            return None
+        return self.store_object(Tree(entries))
+
+    def _merge_base_tree(self,bases:List[str])->str:
+        #several best common ancestors (criss-cross history): merge them into one virtual base first
+        tree = self.get_commit_tree(bases[0])
+        for other in bases[1:]:
+            inner = self.merge_bases(bases[0],other)
+            inner_tree = self._merge_base_tree(inner) if inner else None
+            tree = self._merge_trees(inner_tree,tree,self.get_commit_tree(other),"",[],("base","base"))
+        return tree
+
+    @locks_index()
+    def merge(self,branch:str,author:str):
+        if self.merge_head_file.exists():
+            print("Error: a merge is already in progress, commit the result first")
+            return None
+        if self.is_dirty():
+            print("Error: Your local changes would be overwritten by merge.")
+            print("Please commit your changes or stash them before you merge.")
+            return None
+        current_branch = self.get_current_branch()
+        ours = self.get_branch_commit(current_branch)
+        theirs = self.resolve_commit(branch)
+        ours_tree = self.get_commit_tree(ours)
+        theirs_tree = self.get_commit_tree(theirs)
+        index = self.load_index() if ours else Index()
+        cone = self.sparse_cone()
+        if not ours:
+            index.sparse = cone is not None and bool(self.get_config("index.sparse",True))
+        tree_cone = cone if index.sparse else None
+
+        if ours and self.is_ancestor(theirs,ours):
+            print("Already up to date.")
+            return ours
+        if not ours or self.is_ancestor(ours,theirs):
+            #fast-forward: no merge commit, just move the branch and the files
+            self.apply_tree_changes(self.diff_trees(ours_tree,theirs_tree,cone = tree_cone),index)
+            self.create_tree_from_index(index)
+            self.save_index(index)
+            self.set_branch_commit(current_branch,theirs,ours)
+            print(f"Fast-forward to {theirs}")
+            return theirs
+
+        bases = self.merge_bases(ours,theirs)
+        base_tree = self._merge_base_tree(bases) if bases else None
+        conflicts = []
+        merged_tree = self._merge_trees(base_tree,ours_tree,theirs_tree,"",conflicts,(current_branch,branch)) or self.store_object(Tree())
+        #a conflict has to be resolved in the working tree, which doesn't have the files outside the cone
+        outside = sorted(path for path,_ in conflicts if cone is not None and not cone.contains(path))
+        if outside:
+            raise ValueError(f"merge conflicts outside the sparse-checkout cone ({', '.join(outside)}), add their directories with sparse-checkout add first")
+        self.apply_tree_changes(self.diff_trees(ours_tree,merged_tree,cone = tree_cone),index)
+
+        if conflicts:
+            #conflicted files keep their version from HEAD in the index, so they show as modified until added
+            for path,kind in conflicts:
+                if kind != "content":
+                    continue
+                mode,blob_hash = self.find_in_tree(ours_tree,path)
+                index.set_entry(path,blob_hash,mode=mode)
+            self.save_index(index)
+            self.write_file_atomic(self.merge_head_file,f"{theirs}\n".encode())
+            for path,kind in sorted(conflicts):
+                print(f"CONFLICT ({kind}): {path}")
+            print("Automatic merge failed; fix conflicts and then commit the result.")
+            return None
+
+        self.create_tree_from_index(index)
+        self.save_index(index)
+        commit = Commit(
+            tree_hash=merged_tree,
+            parent_hashes=[ours,theirs],
+            author=author,
+            committer=author,
+            message=f"Merge branch '{branch}' into {current_branch}",
+        )
+        commit_hash = self.store_object(commit)
+        self.set_branch_commit(current_branch,commit_hash,ours)
+        self.update_commit_graph()
+        print(f"Merge made commit {commit_hash}")
+        return commit_hash
+
+
     def branch(self,branch_name:str,delete:bool = False):
         current_branch =  self.get_current_branch() 
         # delete 
@@ -573,12 +4339,11 @@ class Repository:
                 print("Error: You must provide a branch name to delete.")
                 return
             
-            branch_file = self.heads_dir / branch_name
-            if branch_file.exists():
+            if self.get_branch_commit(branch_name) is not None:
                 if branch_name == self.get_current_branch():
                     print(f"Error: Cannot delete the branch you are currently on: {branch_name}")
                     return
-                branch_file.unlink()
+                self.delete_ref(branch_name)
                 print(f"Deleted branch {branch_name}")
             else:
                 print(f"Branch {branch_name} not found")
@@ -587,85 +4352,263 @@ class Repository:
         elif branch_name:
             current_commit = self.get_branch_commit(current_branch)
             if current_commit:
-                self.set_branch_commit(branch_name,current_commit)
+                self.set_branch_commit(branch_name,current_commit,None)
                 print(f"Created branch {branch_name}")
             else:
                     print(f"No commits yet, cannot create a new branch")
             return
         # Case 3: Listing
         else:
-            branches = []
-            for branch_file in self.heads_dir.iterdir():
-                if branch_file.is_file():
-                    branches.append(branch_file.name)
-            
-            for branch in sorted(branches):
+            for branch in sorted(self.get_branches()):
                 current_marker = "* " if branch == current_branch else "  "
                 print(f"{current_marker}{branch}")
 
-    def log(self,max_count:int = 10):
+    def _print_log_entry(self,commit_hash:str,commit_obj:GitObject = None):
+        commit = Commit.from_content((commit_obj or self.load_object(commit_hash)).content)
+        print(f"commit: {commit_hash}")
+        print(f"Author: {commit.author}")
+        print(f"Data: {time.ctime(commit.timestamp)}")
+        print(f"\n      {commit.message}\n")
+
+    def log(self,max_count:int = 10,paths:List[str] = None):
         current_branch = self.get_current_branch()
         commit_hash = self.get_branch_commit(current_branch)
         if commit_hash == None:
             print("No commits yet")
             return
+        if paths:
+            self._log_paths(commit_hash,max_count,paths)
+            return
         
+        #the walk itself goes through the commit-graph when there is one, it then knows the next commits
+        #without reading them and a window of them is read concurrently
+        #the newest commits may not be in the graph yet, those are read one by one until it is reached
+        graph = self.commit_graph
         count = 0
-        while commit_hash and count < max_count:
-            commit_obj = self.load_object(commit_hash)
-            commit = Commit.from_content(commit_obj.content)
+        while commit_hash and count < max_count and not (graph and commit_hash in graph):
+            self._print_log_entry(commit_hash)
+            parents = self.commit_parents(commit_hash)
+            commit_hash = parents[0] if parents else None
+            count += 1
+        if not commit_hash or count >= max_count:
+            return
 
-            print(f"commit: {commit_hash}")
-            print(f"Author: {commit.author}")
-            print(f"Data: {time.ctime(commit.timestamp)}")
-            print(f"\n      {commit.message}\n")
+        async def walk(reader:AsyncObjectReader):
+            nonlocal commit_hash,count
+            while commit_hash and count < max_count:
+                window = []
+                while commit_hash and len(window) < min(16 * reader.limit,max_count - count):
+                    window.append(commit_hash)
+                    parents = self.commit_parents(commit_hash)
+                    commit_hash = parents[0] if parents else None
+                commits = await reader.get_many(window)
+                for listed_hash in window:
+                    self._print_log_entry(listed_hash,commits[listed_hash])
+                count += len(window)
 
-            commit_hash = commit.parent_hashes[0] if commit.parent_hashes else None
-            count += 1
+        self.run_async(walk)
+
+    @traced("log paths")
+    def _log_paths(self,commit_hash:str,max_count:int,paths:List[str]):
+        # history simplification as in git: a commit whose paths equal those of one parent (TREESAME) is hidden
+        # and only that parent is followed, the others show and continue through every parent, newest first
+        # the first-parent comparison asks the commit-graph bloom filters before loading any tree
+        paths = [path.strip("/") for path in paths]
+        paths = ["" if path == "." else path for path in paths] #"" is the whole tree
+        keys = [key for path in paths for key in CommitGraph.bloom_keys(path)] if "" not in paths else None
+        graph = self.commit_graph
+        if graph is None or graph.bloom_index is None:
+            keys = None
+        entries_cache = {}
+
+        def entries(commit_hash:str)->tuple:
+            if commit_hash not in entries_cache:
+                tree = self.get_commit_tree(commit_hash)
+                entries_cache[commit_hash] = tuple(self.find_in_tree(tree,path) if path else ("40000",tree) for path in paths)
+            return entries_cache[commit_hash]
+
+        def changed_from_first_parent(commit_hash:str,pos:int,parent:str)->bool:
+            if keys is None or pos < 0:
+                return entries(commit_hash) != entries(parent)
+            if not graph.maybe_changed(pos,keys):
+                TRACE.count("bloom definitely not")
+                return False
+            TRACE.count("bloom maybe")
+            changed = entries(commit_hash) != entries(parent)
+            if not changed:
+                TRACE.count("bloom false positive")
+            return changed
+
+        #walked by graph position where possible: parents come with theirs, so no lookup per commit
+        queue = []
+        seen = set()
+
+        def push(commit_hash:str,pos:int = -1):
+            if commit_hash in seen:
+                return
+            seen.add(commit_hash)
+            if pos < 0 and graph:
+                pos = graph.find(commit_hash)
+            if pos >= 0:
+                _,parent_positions,generation,commit_time = graph.record(pos)
+                parents = [(graph.oid(parent),parent) for parent in parent_positions]
+            else:
+                commit = Commit.from_content(self.load_object(commit_hash).content)
+                generation,commit_time = CommitGraph.GENERATION_INFINITY,commit.timestamp
+                parents = [(parent,-1) for parent in commit.parent_hashes]
+            heapq.heappush(queue,(-commit_time,-generation,commit_hash,pos,parents))
+
+        push(commit_hash)
+        count = 0
+        while queue and count < max_count:
+            _,_,commit_hash,pos,parents = heapq.heappop(queue)
+            treesame = None
+            for i,(parent,_) in enumerate(parents):
+                changed = changed_from_first_parent(commit_hash,pos,parent) if i == 0 else entries(commit_hash) != entries(parent)
+                if not changed:
+                    treesame = i
+                    break
+            if treesame is not None:
+                push(*parents[treesame])
+                continue
+            if parents or any(entries(commit_hash)):
+                self._print_log_entry(commit_hash)
+                count += 1
+            for parent in parents:
+                push(*parent)
+
+    def _staged_changes(self,index:Index,head_tree:str)->Tuple[List[Tuple[str,str]],set]:
+        #("new_file"|"modified",path) for every index entry that differs from HEAD, and the HEAD paths the index dropped
+        #directories whose cache-tree hash equals the HEAD subtree are skipped without reading them
+        paths = index.sorted_paths()
+        staged = []
+        head_only = set()
+
+        def compare(tree_hash:str,dir_path:str,lo:int,hi:int):
+            cached = index.cache_tree.get(dir_path)
+            if cached and cached[0] == tree_hash and cached[1] == hi - lo:
+                return
+            prefix = dir_path + "/" if dir_path else ""
+            entries = self.read_tree_entries(tree_hash)
+            matched = set()
+            i = lo
+            while i < hi:
+                rest = paths[i][len(prefix):]
+                slash = rest.find("/")
+                if slash == -1:
+                    head = entries.get(rest)
+                    if head is None or head[0] == "40000":
+                        staged.append(("new_file",paths[i]))
+                    else:
+                        matched.add(rest)
+                        if head[1] != index[paths[i]]:
+                            staged.append(("modified",paths[i]))
+                    i += 1
+                    continue
+                name = rest[:slash]
+                head = entries.get(name)
+                if slash == len(rest) - 1:
+                    #a sparse index directory: only a different tree is read, file by file
+                    head_dir = head[1] if head and head[0] == "40000" else None
+                    if head_dir:
+                        matched.add(name)
+                    for path,old,new in self.diff_trees(head_dir,index[paths[i]],paths[i]):
+                        if new is None:
+                            head_only.add(path)
+                        else:
+                            staged.append(("modified" if old else "new_file",path))
+                    i += 1
+                    continue
+                j = bisect.bisect_left(paths,prefix + name + "0",i,hi)
+                if head and head[0] == "40000":
+                    matched.add(name)
+                    compare(head[1],prefix + name,i,j)
+                else:
+                    staged.extend(("new_file",path) for path in paths[i:j])
+                i = j
+            for name,(mode,obj_hash) in entries.items():
+                if name in matched:
+                    continue
+                if mode == "40000":
+                    head_only.update(self.get_files_from_tree_recursive(obj_hash,prefix + name))
+                else:
+                    head_only.add(prefix + name)
+
+        if head_tree:
+            compare(head_tree,"",0,len(paths))
+        else:
+            staged.extend(("new_file",path) for path in paths)
+        return staged,head_only
 
+    @locks_index(wait=False)
     def status(self):
         # what branch we are on
         current_branch = self.get_current_branch()
         print(f"On branch {current_branch}")
         index = self.load_index()
-        current_commit_hash = self.get_branch_commit(current_branch)
-        # build the index of the latest commit
-        last_index = {}
-        if current_commit_hash:
-            try:
-                commit_obj = self.load_object(current_commit_hash)
-                commit = Commit.from_content(commit_obj.content)
-                if commit.tree_hash:
-                    last_index = self.get_files_from_tree_recursive(commit.tree_hash)
-            except:
-                last_index = {}
-        
+        # compare the index with the latest commit, unchanged directories are skipped through the cache tree
+        try:
+            head_tree = self.get_commit_tree(self.get_branch_commit(current_branch))
+            staged_files,head_only = self._staged_changes(index,head_tree)
+        except Exception:
+            staged_files,head_only = [("new_file",path) for path in index],set()
 
-        #figure out ll the files present in working dir 
-        working_files = {}  # filename -> hash
-        for  item in self.get_all_files():  
-            rel_path = str(item.relative_to(self.path))
+        #with a running fsmonitor only the paths it saw change since the last status are looked at
+        token,changed = self.fsmonitor_changes(index)
 
+        #figure out all the files present in working dir, ignored directories are never entered
+        working_files,cache_changed = self.scan_working_tree(index,changed=changed)
+
+        #tracked files: a stat each, only the ones whose stat moved get hashed (on the pool)
+        deleted_files = []
+        candidates = []
+        cone = self.sparse_cone()
+        with TRACE.phase("stat"):
+            for rel_path in index:
+                if changed is not None and not self._touched(rel_path,changed):
+                    continue
+                #outside the sparse-checkout cone: not checked out, not a deletion
+                if cone is not None and not cone.contains(rel_path):
+                    continue
+                try:
+                    st = os.stat(self.path / rel_path)
+                except OSError:
+                    deleted_files.append(rel_path)
+                    continue
+                if st.st_mode & 0o170000 != 0o100000: #replaced by a directory or something else that isn't a file
+                    deleted_files.append(rel_path)
+                elif not index.is_unchanged(rel_path,st):
+                    candidates.append((rel_path,st))
+
+        def check(candidate):
+            rel_path,st = candidate
             try:
-                content = item.read_bytes()
-                blob = Blob(content)
-                working_files[rel_path] = blob.hash()
-            except:
-                continue    
+                return rel_path,st,self.hash_file(self.path / rel_path,st)
+            except OSError:
+                return rel_path,st,None
 
-        staged_files = []
         unstaged_files = []
-        untracked_files = []
-        deleted_files = []
+        refreshed = False
+        if candidates:
+            with ThreadPoolExecutor(max_workers=self.worker_count()) as pool:
+                for rel_path,st,blob_hash in pool.map(check,candidates):
+                    if blob_hash is None:
+                        deleted_files.append(rel_path)
+                    elif blob_hash != index[rel_path] or not index.refresh_stat(rel_path,st):
+                        #new content or a chmod, either way it stays in fsmonitor_dirty until it is staged
+                        unstaged_files.append(rel_path)
+                    else:
+                        #same content with a new stat (touched file), remember it so next time is a stat check
+                        refreshed = True
+        #nothing new since the stored token: keeping it gives the next status the same answer
+        if token != index.fsmonitor_token and changed != index.fsmonitor_dirty:
+            index.fsmonitor_token = token
+            index.fsmonitor_dirty = set(unstaged_files) | set(deleted_files)
+            refreshed = True
+        if refreshed or cache_changed:
+            self.save_index(index)
+
         # what files are present in staging area ready for commiting
-        for file_path in set(index.keys()) | set(last_index.keys()):
-            index_hash = index.get(file_path)
-            last_index_hash = last_index.get(file_path)
-
-            if index_hash and not last_index_hash:
-                staged_files.append(("new_file" , file_path))
-            elif index_hash and last_index_hash and index_hash != last_index_hash:
-                staged_files.append(("modified",file_path))
         if staged_files:
             print("\nChanges to be commited:")
             for stage_status,file_path in sorted(staged_files):
@@ -673,11 +4616,6 @@ class Repository:
 
            
         # what files are modified but are not been staged
-        for file_path in working_files:
-            if file_path in index:
-                if working_files[file_path] != index[file_path]:
-                    unstaged_files.append(file_path)
-    
         if unstaged_files:
             print("\nChanges not staged for commit:")
             for file_path in sorted(unstaged_files):
@@ -685,10 +4623,8 @@ class Repository:
 
 
 
-        #what files are untracked(not in index and not in prev_commit)
-        for file_path in working_files:
-            if file_path not in index and file_path not in last_index:
-                untracked_files.append(file_path)
+        #what files are untracked(not in index and not in prev_commit), they are listed but never read
+        untracked_files = [file_path for file_path in working_files if file_path not in index and file_path not in head_only]
 
         if untracked_files:
             print("\nUntracked files:")
@@ -696,23 +4632,1268 @@ class Repository:
                 print(f"  untracked: {file_path}")
 
         #what files have been deleted
-        for file_path in index:
-            if file_path not in working_files:
-                deleted_files.append(file_path)
-            
         if deleted_files:
             print("\nDeleted files:")
             for file_path in sorted(deleted_files):
                 print(f"  deleted: {file_path}")
 
+        if self.merge_head_file.exists():
+            print("\nYou have unmerged changes, commit to conclude the merge")
         if not staged_files and not unstaged_files and not untracked_files and not deleted_files:
             print(f"\nnothing to commit working tree clean")
 
+
+    @contextmanager
+    def begin_batch(self):
+        # objects stored inside the block go into one new pack: one sequential write and one fsync at the end
+        # instead of a stat, a mkdir and a small file per object; duplicates are dropped in memory
+        # they can be read back before the block ends, the pack becomes visible to others when it closes
+        if self._batch is not None:
+            yield self._batch #nested: the outer batch owns the pack
+            return
+        writer = PackWriter(self.pack_dir)
+        self._batch = writer
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        else:
+            writer.finish()
+        finally:
+            self._batch = None
+            self.close_packs()
+
+    def _index_from_tree(self,tree_hash:str,cone:SparseCone = None)->Index:
+        #index of a whole tree with its cache tree filled in, so rebuilding it after a few changes is cheap
+        #with a cone it is a sparse index: directories outside it become one entry and are not read
+        index = Index()
+        index.sparse = cone is not None
+
+        async def walk(reader:AsyncObjectReader,tree_hash:str,dir_path:str)->int:
+            #the subtrees of a directory are read concurrently
+            count = 0
+            prefix = dir_path + "/" if dir_path else ""
+            subtrees = []
+            for name,(mode,obj_hash) in (await reader.read_tree_entries(tree_hash)).items():
+                if mode == "40000" and cone is not None and not cone.includes_dir(prefix + name):
+                    index.set_entry(prefix + name + "/",obj_hash,mode=mode)
+                    count += 1
+                elif mode == "40000":
+                    subtrees.append(walk(reader,obj_hash,prefix + name))
+                else:
+                    index.set_entry(prefix + name,obj_hash,mode=mode)
+                    count += 1
+            count += sum(await asyncio.gather(*subtrees))
+            index.cache_tree[dir_path] = (tree_hash,count)
+            return count
+
+        if tree_hash:
+            self.run_async(lambda reader: walk(reader,tree_hash,""))
+        return index
+
+    def fast_import(self,stream)->Dict[str,str]:
+        # reads a git fast-import stream: blob, commit (mark, author, committer, data, from, merge, M, D, C, R, deleteall),
+        # reset, done; progress/checkpoint/feature/option are accepted and ignored
+        # everything is written through one batch, refs move only once the pack is complete
+        marks: Dict[str,str] = {}
+        tips: Dict[str,str] = {} # branch -> commit hash
+        trees: Dict[str,Tuple[str,Index]] = {} # branch -> (commit hash,index of its tree)
+        counts = {"blob":0,"commit":0}
+
+        ended = False
+
+        def read_line()->bytes:
+            #b"" for a blank line and at the end of the stream, `ended` tells them apart
+            nonlocal ended
+            line = stream.readline()
+            if not line:
+                ended = True
+            return line[:-1] if line.endswith(b"\n") else line
+
+        def read_data(line:bytes)->bytes:
+            if not line.startswith(b"data "):
+                raise ValueError(f"expected data, got {line[:40]!r}")
+            spec = line[5:]
+            if spec.startswith(b"<<"):
+                delimiter = spec[2:]
+                lines = []
+                while True:
+                    data_line = stream.readline()
+                    if not data_line or data_line.rstrip(b"\n") == delimiter:
+                        break
+                    lines.append(data_line)
+                return b"".join(lines)
+            size = int(spec)
+            data = stream.read(size)
+            if len(data) != size:
+                raise ValueError("unexpected end of fast-import stream")
+            return data
+
+        def resolve(ref:str)->str:
+            if ref.startswith(":"):
+                if ref not in marks:
+                    raise ValueError(f"unknown mark {ref}")
+                return marks[ref]
+            name = ref[len("refs/heads/"):] if ref.startswith("refs/heads/") else ref
+            if name in tips:
+                return tips[name]
+            return self.resolve_commit(name)
+
+        def branch_name(ref:str)->str:
+            if not ref.startswith("refs/heads/"):
+                raise ValueError(f"only refs/heads/ refs can be imported, not {ref}")
+            return ref[len("refs/heads/"):]
+
+        def person(value:str)->Tuple[str,int]:
+            #"Name <email> <time> <tz>": the time becomes the commit timestamp, the zone is not kept
+            name,_,when = value.rpartition(">")
+            parts = when.split()
+            return name + ">",int(parts[0]) if parts else int(time.time())
+
+        with self.begin_batch():
+            line = read_line()
+            while line != b"done":
+                if not line:
+                    if ended:
+                        break
+                    line = read_line()
+                    continue
+                command = line.decode()
+                if command == "blob":
+                    line = read_line()
+                    mark = None
+                    if line.startswith(b"mark "):
+                        mark = line[5:].decode()
+                        line = read_line()
+                    blob_hash = self.store_object(Blob(read_data(line)))
+                    counts["blob"] += 1
+                    if mark:
+                        marks[mark] = blob_hash
+                    line = read_line()
+                elif command.startswith("commit "):
+                    branch = branch_name(command[7:])
+                    line = read_line()
+                    mark = None
+                    author = committer = None
+                    if line.startswith(b"mark "):
+                        mark = line[5:].decode()
+                        line = read_line()
+                    if line.startswith(b"author "):
+                        author = person(line[7:].decode())
+                        line = read_line()
+                    if not line.startswith(b"committer "):
+                        raise ValueError(f"commit {branch}: missing committer")
+                    committer = person(line[10:].decode())
+                    message = read_data(read_line()).decode(errors="replace")
+                    line = read_line()
+                    if not line:
+                        line = read_line()
+                    parents = []
+                    if line.startswith(b"from "):
+                        parents.append(resolve(line[5:].decode()))
+                        line = read_line()
+                    elif branch in tips or self.get_branch_commit(branch):
+                        parents.append(resolve(branch))
+                    while line.startswith(b"merge "):
+                        parents.append(resolve(line[6:].decode()))
+                        line = read_line()
+
+                    #the branch's index is reused while commits keep building on its tip
+                    state = trees.get(branch)
+                    if state and parents and state[0] == parents[0]:
+                        index = state[1]
+                    else:
+                        index = self._index_from_tree(self.get_commit_tree(parents[0]) if parents else None)
+                    while line[:2] in (b"M ",b"D ",b"C ",b"R ") or line == b"deleteall":
+                        if line == b"deleteall":
+                            index = Index()
+                        elif line.startswith(b"D "):
+                            path,_ = unquote_c_path(line[2:])
+                            for tracked in [p for p in index if p == path or p.startswith(path + "/")]:
+                                del index[tracked]
+                        elif line[:2] in (b"C ",b"R "):
+                            #copy or rename of a file or of a whole directory
+                            source,rest = unquote_c_path(line[2:],last=False)
+                            target,_ = unquote_c_path(rest)
+                            moved = [(p,index[p],index.mode(p)) for p in index if p == source or p.startswith(source + "/")]
+                            if not moved:
+                                raise ValueError(f"path {source} not in branch")
+                            if line.startswith(b"R "):
+                                for p,_,_ in moved:
+                                    del index[p]
+                            for p,blob_hash,mode in moved:
+                                index.set_entry(target + p[len(source):],blob_hash,mode=mode)
+                        else:
+                            mode,dataref,path = line[2:].split(b" ",2)
+                            mode,dataref = mode.decode(),dataref.decode()
+                            path,_ = unquote_c_path(path)
+                            mode = {"644":"100644","755":"100755"}.get(mode,mode)
+                            if mode not in ("100644","100755"):
+                                raise ValueError(f"unsupported file mode {mode} for {path}")
+                            if dataref == "inline":
+                                blob_hash = self.store_object(Blob(read_data(read_line())))
+                                counts["blob"] += 1
+                            elif dataref.startswith(":"):
+                                blob_hash = marks[dataref]
+                            else:
+                                blob_hash = dataref
+                            index.set_entry(path,blob_hash,mode=mode)
+                        line = read_line()
+
+                    tree_hash = self.create_tree_from_index(index)
+                    author = author or committer
+                    commit = Commit(
+                        tree_hash=tree_hash,
+                        parent_hashes=parents,
+                        author=author[0],
+                        committer=committer[0],
+                        message=message,
+                        timestamp=committer[1],
+                    )
+                    commit_hash = self.store_object(commit)
+                    counts["commit"] += 1
+                    tips[branch] = commit_hash
+                    trees[branch] = (commit_hash,index)
+                    if mark:
+                        marks[mark] = commit_hash
+                elif command.startswith("reset "):
+                    branch = branch_name(command[6:])
+                    line = read_line()
+                    if line.startswith(b"from "):
+                        tips[branch] = resolve(line[5:].decode())
+                        line = read_line()
+                    else:
+                        tips.pop(branch,None)
+                        trees.pop(branch,None)
+                elif command.split(" ",1)[0] in ("progress","checkpoint","feature","option"):
+                    line = read_line()
+                else:
+                    raise ValueError(f"unsupported fast-import command: {command[:40]}")
+
+        for branch,commit_hash in tips.items():
+            self.set_branch_commit(branch,commit_hash)
+        if tips:
+            self.update_commit_graph()
+        print(f"Imported {counts['blob']} blobs and {counts['commit']} commits")
+        return tips
+
+    def get_branches(self)->Dict[str,str]:
+        branches = dict(self.packed_refs())
+        branches.update(self._loose_refs())
+        return branches
+
+    def remote_refs(self,remote:str)->Dict[str,str]:
+        return self._loose_refs(self.remotes_dir / remote) if remote and not remote.startswith(".") else {}
+
+    def all_refs(self)->Dict[str,str]:
+        #full ref name -> commit of every branch and remote-tracking branch
+        refs = {f"refs/heads/{branch}":commit_hash for branch,commit_hash in self.get_branches().items()}
+        refs.update((f"refs/remotes/{name}",commit_hash) for name,commit_hash in self._loose_refs(self.remotes_dir).items())
+        return refs
+
+    def has_object(self,obj_hash:str)->bool:
+        return obj_hash in self.has_many([obj_hash])
+
+    def _packed_entry(self,obj_hash:str):
+        #(pack,position) of an object in a pack, or (None,-1)
+        for pack in self.packs():
+            i = pack.find(obj_hash)
+            if i >= 0:
+                return pack,i
+        return None,-1
+
+    def _objects_to_send(self,wants:List[str],common:List[str])->Tuple[Dict[str,str],set,Dict[str,str]]:
+        # -> ({hash:kind} the other side is missing, hashes known to be on the other side, {hash:thin delta base})
+        # the other side has every ancestor of common; only commits between wants and those are walked, and
+        # trees of the boundary commits (parents the other side has) mark what doesn't need sending,
+        # by path, so a changed file can go as a delta against the version the other side already has
+        pack,bitmap = self.bitmap_index()
+        if not common and bitmap is not None:
+            #a clone: everything reachable, listed from the bitmaps without reading trees
+            bits,extra = self.bitmap_walk(wants,pack,bitmap)
+            bits = int.from_bytes(bits,"little")
+            send = {}
+            for obj_type in BitmapIndex.TYPES:
+                typed = bits & bitmap.types[obj_type]
+                data = typed.to_bytes((typed.bit_length() + 7) // 8,"little")
+                for byte_index,byte in enumerate(data):
+                    while byte:
+                        low = byte & -byte
+                        send[pack.sha_at(byte_index * 8 + low.bit_length() - 1).hex()] = obj_type
+                        byte ^= low
+            send.update((obj_hash,kind) for obj_hash,kind in extra.items() if kind != "chunk")
+            return send,set(),{}
+
+        have_commits = set()
+        pending = list(common)
+        while pending:
+            commit_hash = pending.pop()
+            if commit_hash not in have_commits:
+                have_commits.add(commit_hash)
+                pending.extend(self.commit_parents(commit_hash))
+        send = {}
+        boundary = set()
+        pending = list(wants)
+        while pending:
+            commit_hash = pending.pop()
+            if commit_hash in send or commit_hash in have_commits:
+                continue
+            send[commit_hash] = "commit"
+            for parent in self.commit_parents(commit_hash):
+                (boundary.add(parent) if parent in have_commits else pending.append(parent))
+
+        theirs = set()
+        by_path = {}
+        for commit_hash in boundary:
+            pending = [(self.get_commit_tree(commit_hash),"")]
+            while pending:
+                tree_hash,dir_path = pending.pop()
+                by_path.setdefault(dir_path,tree_hash)
+                if tree_hash in theirs:
+                    continue
+                theirs.add(tree_hash)
+                for mode,name,obj_hash in Tree.from_content(self.load_object(tree_hash).content).entries:
+                    path = f"{dir_path}/{name}" if dir_path else name
+                    if mode == "40000":
+                        pending.append((obj_hash,path))
+                    else:
+                        by_path.setdefault(path,obj_hash)
+                        theirs.add(obj_hash)
+
+        bases = {}
+        pending = [(self.get_commit_tree(commit_hash),"") for commit_hash in send]
+        while pending:
+            tree_hash,dir_path = pending.pop()
+            if tree_hash in theirs or tree_hash in send:
+                continue
+            send[tree_hash] = "tree"
+            if by_path.get(dir_path) in theirs:
+                bases[tree_hash] = by_path[dir_path]
+            for mode,name,obj_hash in Tree.from_content(self.load_object(tree_hash).content).entries:
+                path = f"{dir_path}/{name}" if dir_path else name
+                if mode == "40000":
+                    pending.append((obj_hash,path))
+                elif obj_hash not in theirs and obj_hash not in send:
+                    send[obj_hash] = "blob"
+                    if path in by_path:
+                        bases[obj_hash] = by_path[path]
+        return send,theirs,bases
+
+    def _pack_entries(self,send:Dict[str,str],theirs:set,bases:Dict[str,str])->Iterator[Tuple[int,int,str,bytes]]:
+        # stored deltas whose base is sent too or already on the other side are copied as they are,
+        # other objects are deltified against the same path's old version when that pays off
+        # one entry per object in `send`, made as the stream asks for it so only one payload is held at a time
+        for obj_hash,kind in send.items():
+            pack,i = self._packed_entry(obj_hash)
+            if pack is not None:
+                obj_type,size,base_hash,payload = pack.raw_entry(i)
+                if base_hash is None or base_hash in send or base_hash in theirs:
+                    yield obj_type,size,base_hash,payload
+                    continue
+            content = self.load_object(obj_hash).content
+            base_hash = bases.get(obj_hash)
+            if base_hash and len(content) > DELTA_BLOCK:
+                limit = len(content) // 2
+                delta = create_delta(self.load_object(base_hash).content,content,limit)
+                if delta is not None and len(delta) < limit:
+                    yield REF_DELTA,len(delta),base_hash,zlib.compress(delta)
+                    continue
+            yield PACK_TYPES[kind],len(content),None,zlib.compress(content)
+
+    def upload_pack(self,inp,out):
+        # server side of fetch: advertise the branches, answer "have" rounds with ACKs for the commits it
+        # has too, then send a thin pack with what the client is missing
+        refs = self.get_branches()
+        capabilities = f"\0symref=HEAD:refs/heads/{self.get_current_branch()}"
+        if refs:
+            for i,branch in enumerate(sorted(refs)):
+                out.write(pkt_line(f"{refs[branch]} refs/heads/{branch}{capabilities if i == 0 else ''}\n"))
+        else:
+            out.write(pkt_line(f"{'0' * 40} capabilities^{{}}{capabilities}\n"))
+        out.write(FLUSH_PKT)
+        out.flush()
+
+        wants = []
+        while (line := read_pkt(inp)) is not None:
+            want = line.split()[1]
+            if want not in refs.values():
+                out.write(pkt_line(f"ERR {want} is not a branch tip\n"))
+                out.flush()
+                return
+            wants.append(want)
+        if not wants:
+            return
+        common = []
+        haves = []
+        while True:
+            line = read_pkt(inp)
+            if line is not None and line.startswith("have "):
+                haves.append(line.split()[1])
+                continue
+            #a round's haves are looked up together
+            found = self.has_many(haves)
+            for have in haves:
+                if have in found:
+                    common.append(have)
+                    out.write(pkt_line(f"ACK {have} common\n"))
+            haves = []
+            if line == "done\n":
+                break
+            if line is None:
+                out.write(pkt_line("NAK\n")) #end of a round
+                out.flush()
+        send,theirs,bases = self._objects_to_send(wants,common)
+        write_pack_stream(out,len(send),self._pack_entries(send,theirs,bases))
+
+    def _connect(self,url:str,upload_pack:str = None)->subprocess.Popen:
+        # a local path runs this script's upload-pack, anything else can be reached with a command
+        # (e.g. "ssh host python main.py upload-pack") that gets the path as its last argument
+        command = shlex.split(upload_pack) if upload_pack else [sys.executable,os.path.abspath(__file__),"upload-pack"]
+        return subprocess.Popen(command + [url],stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+
+    def fetch_pack(self,url:str,upload_pack:str = None)->Tuple[Dict[str,str],str]:
+        # client side: -> (remote branches, remote HEAD branch); objects end up in one new local pack
+        process = self._connect(url,upload_pack)
+        inp,out = process.stdout,process.stdin
+        try:
+            refs = {}
+            head = None
+            while (line := read_pkt(inp)) is not None:
+                if line.startswith("ERR "):
+                    raise ValueError(line[4:].strip())
+                line,_,capabilities = line.rstrip("\n").partition("\0")
+                commit_hash,ref = line.split(" ",1)
+                for capability in capabilities.split():
+                    if capability.startswith("symref=HEAD:refs/heads/"):
+                        head = capability[len("symref=HEAD:refs/heads/"):]
+                if ref.startswith("refs/heads/"):
+                    refs[ref[len("refs/heads/"):]] = commit_hash
+
+            have = self.has_many(list(refs.values()))
+            wants = sorted({commit_hash for commit_hash in refs.values() if commit_hash not in have})
+            for want in wants:
+                out.write(pkt_line(f"want {want}\n"))
+            out.write(FLUSH_PKT)
+            out.flush()
+            if not wants:
+                return refs,head
+
+            #haves newest first in rounds of 32; once a commit is ACKed its ancestors are known common and skipped
+            tips = set(self.all_refs().values())
+            queue = [(-self.commit_generation(commit_hash)[0],commit_hash) for commit_hash in tips]
+            heapq.heapify(queue)
+            seen = set(tips)
+            common = set()
+            haves = 0
+            in_vain = 0 #haves sent since the last new ACK, past 256 more rounds are unlikely to help
+            while queue and in_vain < 256:
+                sent = 0
+                while queue and sent < 32:
+                    _,commit_hash = heapq.heappop(queue)
+                    if commit_hash in common:
+                        continue
+                    out.write(pkt_line(f"have {commit_hash}\n"))
+                    sent += 1
+                    for parent in self.commit_parents(commit_hash):
+                        if parent not in seen:
+                            seen.add(parent)
+                            heapq.heappush(queue,(-self.commit_generation(parent)[0],parent))
+                if not sent:
+                    break
+                haves += sent
+                in_vain += sent
+                out.write(FLUSH_PKT)
+                out.flush()
+                while (line := read_pkt(inp)) != "NAK\n":
+                    if line and line.startswith("ACK "):
+                        in_vain = 0
+                        acked = [line.split()[1]]
+                        while acked:
+                            commit_hash = acked.pop()
+                            if commit_hash not in common:
+                                common.add(commit_hash)
+                                acked.extend(parent for parent in self.commit_parents(commit_hash) if parent in seen)
+            out.write(pkt_line("done\n"))
+            out.flush()
+
+            reader = PackStreamReader(inp)
+            deltas = []
+            count = 0
+            with self.begin_batch():
+                for obj_type,content,base_hash in reader.entries():
+                    count += 1
+                    if base_hash:
+                        deltas.append((content,base_hash))
+                    else:
+                        self.store_object(GitObject(obj_type,content))
+                #bases are in this pack or already here (thin pack); a delta may also build on another delta
+                while deltas:
+                    pending = []
+                    for delta,base_hash in deltas:
+                        if self.has_object(base_hash):
+                            base = self.load_object(base_hash)
+                            self.store_object(GitObject(base.type,apply_delta(base.content,delta)))
+                        else:
+                            pending.append((delta,base_hash))
+                    if len(pending) == len(deltas):
+                        raise ValueError(f"pack stream has deltas against missing objects ({pending[0][1]})")
+                    deltas = pending
+            have = self.has_many(wants)
+            missing = [want for want in wants if want not in have]
+            if missing:
+                raise ValueError(f"remote did not send {missing[0]}")
+            print(f"Received {count} objects, {reader.received} bytes ({haves} haves, {len(common)} in common)")
+            return refs,head
+        finally:
+            out.close()
+            inp.close()
+            process.wait()
+
+    def fetch(self,remote:str = "origin",upload_pack:str = None)->Tuple[Dict[str,str],str]:
+        # a configured remote updates refs/remotes/<remote>/*, or refs/heads/* for a mirror;
+        # a plain path only records what it fetched in FETCH_HEAD
+        url = self.get_config(f"remote.{remote}.url")
+        upload_pack = upload_pack or self.get_config(f"remote.{remote}.uploadpack")
+        if url is None:
+            if not (Path(remote) / ".pygit").exists():
+                raise ValueError(f"'{remote}' is neither a configured remote nor a repository")
+            refs,head = self.fetch_pack(os.path.abspath(remote),upload_pack)
+            self.write_file_atomic(self.fetch_head_file,"".join(
+                f"{commit_hash}\t\tbranch '{branch}' of {os.path.abspath(remote)}\n" for branch,commit_hash in sorted(refs.items())).encode())
+            for branch,commit_hash in sorted(refs.items()):
+                print(f" * branch            {branch} -> FETCH_HEAD")
+            return refs,head
+        refs,head = self.fetch_pack(url,upload_pack)
+        mirror = self.get_config(f"remote.{remote}.mirror",False)
+        old_refs = self.get_branches() if mirror else self.remote_refs(remote)
+        for branch,commit_hash in sorted(refs.items()):
+            old = old_refs.get(branch)
+            if old == commit_hash:
+                continue
+            target = branch if mirror else f"{remote}/{branch}"
+            if mirror:
+                self.update_ref(branch,commit_hash)
+            else:
+                self.check_ref_name(branch)
+                ref_file = self.remotes_dir / remote / branch
+                ref_file.parent.mkdir(parents=True,exist_ok=True)
+                self.write_file_atomic(ref_file,f"{commit_hash}\n".encode())
+            print(f"   {old[:7]}..{commit_hash[:7]}  {branch} -> {target}" if old else f" * [new branch]      {branch} -> {target}")
+        if mirror and head:
+            self.set_head(head)
+        self.update_commit_graph()
+        return refs,head
+
+    @classmethod
+    def clone(cls,url:str,directory:str = None,mirror:bool = False,upload_pack:str = None)->"Repository":
+        # new repository with url as "origin": all its branches fetched, its HEAD branch created and checked out
+        # a mirror copies the branches themselves and checks nothing out, so later fetches can move them
+        directory = directory or Path(url.rstrip("/")).name
+        if Path(directory).exists() and any(Path(directory).iterdir()):
+            raise ValueError(f"destination path '{directory}' already exists and is not an empty directory")
+        Path(directory).mkdir(parents=True,exist_ok=True)
+        repo = cls(directory)
+        repo.init()
+        local = Path(url).exists()
+        repo.set_config("remote.origin.url",os.path.abspath(url) if local else url)
+        if upload_pack:
+            repo.set_config("remote.origin.uploadpack",upload_pack)
+        if mirror:
+            repo.set_config("remote.origin.mirror",True)
+        refs,head = repo.fetch("origin")
+        if mirror or not refs:
+            return repo
+        if head not in refs:
+            head = sorted(refs)[0]
+        repo.update_ref(head,refs[head],None)
+        repo.set_head(head)
+        repo.restore_working_directory(head,None)
+        print(f"Checked out branch {head}")
+        return repo
+
+    def _object_names(self)->Dict[str,str]:
+        # name hint for every reachable tree/blob, so revisions of one file sit next to each other when deltifying
+        names = {}
+        seen = set()
+        commits = list(self.get_branches().values())
+        while commits:
+            commit_hash = commits.pop()
+            if commit_hash in seen:
+                continue
+            seen.add(commit_hash)
+            try:
+                commit = Commit.from_content(self.load_object(commit_hash).content)
+            except Exception:
+                continue
+            commits.extend(commit.parent_hashes)
+            trees = [(commit.tree_hash,"")]
+            while trees:
+                tree_hash,name = trees.pop()
+                if tree_hash in seen:
+                    continue
+                seen.add(tree_hash)
+                names.setdefault(tree_hash,name)
+                try:
+                    tree = Tree.from_content(self.load_object(tree_hash).content)
+                except Exception:
+                    continue
+                for mode,entry_name,obj_hash in tree.entries:
+                    if mode == "40000":
+                        trees.append((obj_hash,entry_name))
+                    else:
+                        names.setdefault(obj_hash,entry_name)
+        return names
+
+    def loose_objects(self)->Dict[str,ObjectStore]:
+        #hash -> store of every object that isn't in a pack (loose files or the sqlite store)
+        objects = {}
+        for store in reversed(self.object_stores()):
+            objects.update(dict.fromkeys(store.hashes(),store))
+        return objects
+
+    def object_ids(self,loose:Dict[str,ObjectStore])->Dict[str,int]:
+        #every object in the repository numbered once, the reachability walk marks them in a bytearray by number
+        ids = dict.fromkeys(loose)
+        for pack in self.packs():
+            ids.update(dict.fromkeys(pack.hashes()))
+        for i,obj_hash in enumerate(ids):
+            ids[obj_hash] = i
+        return ids
+
+    def _root_objects(self)->List[Tuple[str,str,str]]:
+        # (hash,kind,referrer) the walk starts from: branches, an unfinished merge, and the index
+        # the index counts too: staged blobs and the cached subtrees of the next commit must survive prune
+        roots = [(commit_hash,"commit",ref) for ref,commit_hash in self.all_refs().items()]
+        if self.merge_head_file.exists():
+            roots.append((self.merge_head_file.read_text().strip(),"commit","MERGE_HEAD"))
+        index = self.load_index()
+        roots.extend((obj_hash,"tree" if path.endswith("/") else "blob",f"index:{path}") for path,obj_hash in index.items())
+        roots.extend((tree_hash,"tree",f"index:{dir_path}/" if dir_path else "index") for dir_path,(tree_hash,_) in index.cache_tree.items())
+        return roots
+
+    def _object_links(self,obj_hash:str,kind:str,loose:Dict[str,ObjectStore],obj:GitObject = None)->List[Tuple[str,str]]:
+        #(hash,kind) of the objects obj_hash points to, obj is the commit or tree if the caller already has it
+        if kind == "commit":
+            commit = Commit.from_content((obj or self.load_object(obj_hash)).content)
+            return [(commit.tree_hash,"tree")] + [(parent,"commit") for parent in commit.parent_hashes]
+        if kind == "tree":
+            tree = Tree.from_content((obj or self.load_object(obj_hash)).content)
+            return [(entry_hash,"tree" if mode == "40000" else "blob") for mode,_,entry_hash in tree.entries]
+        if kind == "blob" and obj_hash in loose:
+            return [(chunk_hash,"chunk") for chunk_hash in self._chunk_hashes(obj_hash,loose[obj_hash])]
+        return []
+
+    def _chunk_hashes(self,obj_hash:str,store:ObjectStore = None)->List[str]:
+        #chunks of a blob stored as a chunk manifest, the type is looked at before the manifest is read
+        for store in [store] if store else self.object_stores():
+            obj_type = store.object_type(obj_hash)
+            if obj_type is None:
+                continue
+            if obj_type != "chunked":
+                return []
+            manifest = store.get(obj_hash).content
+            return [manifest[pos:pos + 20].hex() for pos in range(0,len(manifest),24)]
+        return []
+
+    def bitmap_walk(self,commits:List[str],pack:PackFile,bitmaps,kinds:bytearray = None)->Tuple[bytearray,Dict[str,str]]:
+        # objects reachable from commits -> (bits over pack's idx positions, {hash:kind} of those outside pack)
+        # a commit bitmaps has an entry for is not walked, its bitmap is OR'ed in; commits go first and
+        # trees after them, so whatever those bitmaps cover is skipped subtree by subtree
+        # kinds (one byte per idx position) records 1/2/3 for the commits/trees/blobs marked along the way
+        count = pack.fanout[255] if pack else 0
+        size = (count + 7) // 8
+        bits = bytearray(size)
+        extra = {}
+        codes = {"commit":1,"tree":2,"blob":3}
+
+        def add(obj_hash:str,kind:str)->bool:
+            pos = pack.find(obj_hash) if pack else -1
+            if pos < 0:
+                if obj_hash in extra:
+                    return False
+                extra[obj_hash] = kind
+                return True
+            mask = 1 << (pos & 7)
+            if bits[pos >> 3] & mask:
+                return False
+            bits[pos >> 3] |= mask
+            if kinds is not None:
+                kinds[pos] = codes[kind]
+            return True
+
+        graph = self.commit_graph
+        pending = list(commits)
+        trees = []
+        while pending:
+            commit_hash = pending.pop()
+            bitmap = bitmaps.get(commit_hash) if bitmaps else None
+            if bitmap is not None:
+                pos = pack.find(commit_hash)
+                if not bits[pos >> 3] & (1 << (pos & 7)):
+                    bits[:] = (int.from_bytes(bits,"little") | bitmap).to_bytes(size,"little")
+                continue
+            if not add(commit_hash,"commit"):
+                continue
+            pos = graph.find(commit_hash) if graph else -1
+            if pos >= 0:
+                tree_hash,parents,_,_ = graph.record(pos)
+                parents = [graph.oid(parent) for parent in parents]
+            else:
+                commit = Commit.from_content(self.load_object(commit_hash).content)
+                tree_hash,parents = commit.tree_hash,commit.parent_hashes
+            trees.append(tree_hash)
+            pending.extend(parents)
+
+        pending = [tree_hash for tree_hash in trees if add(tree_hash,"tree")]
+        while pending:
+            tree = Tree.from_content(self.load_object(pending.pop()).content)
+            for mode,_,obj_hash in tree.entries:
+                if mode == "40000":
+                    if add(obj_hash,"tree"):
+                        pending.append(obj_hash)
+                elif add(obj_hash,"blob") and obj_hash in extra:
+                    for chunk_hash in self._chunk_hashes(obj_hash):
+                        extra.setdefault(chunk_hash,"chunk")
+        return bits,extra
+
+    @traced("bitmap write")
+    def write_bitmap(self,pack:PackFile)->int:
+        # bitmaps for every branch tip and every commit whose generation is a multiple of pack.bitmapInterval,
+        # so a query never walks more than about that many commits before it hits one
+        # built ancestors first: each one only walks back to the previous bitmapped commits and ORs them
+        interval = int(self.get_config("pack.bitmapInterval",100))
+        tips = set(self.get_branches().values())
+        generation = {}
+        stack = [(commit_hash,False) for commit_hash in tips]
+        while stack:
+            commit_hash,expanded = stack.pop()
+            if commit_hash in generation:
+                continue
+            parents = self.commit_parents(commit_hash)
+            if expanded:
+                generation[commit_hash] = 1 + max((generation[parent] for parent in parents),default=0)
+                continue
+            stack.append((commit_hash,True))
+            stack.extend((parent,False) for parent in parents if parent not in generation)
+        selected = sorted((commit_hash for commit_hash,gen in generation.items() if commit_hash in tips or gen % interval == 0),
+                          key=lambda commit_hash: generation[commit_hash])
+
+        kinds = bytearray(pack.fanout[255])
+        bitmaps = {}
+        entries = []
+        for commit_hash in selected:
+            bits,extra = self.bitmap_walk([commit_hash],pack,bitmaps,kinds)
+            if extra:
+                continue #reaches objects outside the pack (loose, chunked), a bitmap can't describe it
+            bitmaps[commit_hash] = int.from_bytes(bits,"little")
+            entries.append((pack.find(commit_hash),bitmaps[commit_hash]))
+        bitmap_path = pack.pack_path.with_suffix(".bitmap")
+        if not entries:
+            bitmap_path.unlink(missing_ok=True)
+            return 0
+        #kinds byte string -> "0"/"1" per object, reversed so bit i is position i
+        types = {}
+        for code,obj_type in enumerate(BitmapIndex.TYPES,1):
+            table = bytes(ord("1") if byte == code else ord("0") for byte in range(256))
+            types[obj_type] = int(kinds.translate(table)[::-1] or b"0",2)
+        BitmapIndex.write(bitmap_path,pack,types,entries)
+        self._bitmap = None
+        return len(entries)
+
+    def rev_list(self,commits:List[str],objects:bool = False,count:bool = False):
+        # commits (and with objects=True also trees and blobs) reachable from commits, by bitmap where possible
+        pack,bitmap = self.bitmap_index()
+        bits,extra = self.bitmap_walk([self.resolve_commit(name) for name in commits],pack,bitmap)
+        bits = int.from_bytes(bits,"little")
+        if not objects:
+            bits &= bitmap.types["commit"] if bitmap else 0
+            extra = {obj_hash:kind for obj_hash,kind in extra.items() if kind == "commit"}
+        if count:
+            print(bits.bit_count() + len(extra))
+            return
+        hashes = list(extra)
+        data = bits.to_bytes((bits.bit_length() + 7) // 8,"little")
+        for byte_index,byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                hashes.append(pack.sha_at(byte_index * 8 + low.bit_length() - 1).hex())
+                byte ^= low
+        if not objects:
+            #newest first, as log shows them
+            hashes.sort(key=self.commit_generation,reverse=True)
+        for obj_hash in hashes:
+            print(obj_hash)
+
+    @traced("reachability")
+    def reachable_objects(self,ids:Dict[str,int],loose:Dict[str,ObjectStore],use_graph:bool = True):
+        # -> (visited bitmap indexed by ids, missing {hash:(kind,referrer)}, broken {hash:error})
+        # commits are walked first, through the commit-graph where it has them, then the trees
+        # level by level on a thread pool: inflating and parsing a level's trees runs in parallel
+        visited = bytearray(len(ids))
+        missing = {}
+        broken = {}
+
+        def mark(obj_hash:str,kind:str,referrer:str)->bool:
+            i = ids.get(obj_hash)
+            if i is None:
+                missing.setdefault(obj_hash,(kind,referrer))
+                return False
+            if visited[i]:
+                return False
+            visited[i] = 1
+            return True
+
+        roots = self._root_objects()
+        commits = [obj_hash for obj_hash,kind,referrer in roots if kind == "commit" and mark(obj_hash,kind,referrer)]
+        frontier = [(obj_hash,kind) for obj_hash,kind,referrer in roots if kind != "commit" and mark(obj_hash,kind,referrer)]
+        graph = self.commit_graph if use_graph else None
+        #prune trusts derived data: everything under a bitmapped commit is known without reading it
+        pack,bitmap = self.bitmap_index() if use_graph else (None,None)
+        covered = 0
+        while commits:
+            commit_hash = commits.pop()
+            if bitmap is not None:
+                commit_bitmap = bitmap.get(commit_hash)
+                if commit_bitmap is not None:
+                    covered |= commit_bitmap
+                    continue
+            pos = graph.find(commit_hash) if graph else -1
+            try:
+                if pos >= 0:
+                    tree_hash,parents,_,_ = graph.record(pos)
+                    links = [(tree_hash,"tree")] + [(graph.oid(parent),"commit") for parent in parents]
+                else:
+                    links = self._object_links(commit_hash,"commit",loose)
+            except Exception as e:
+                broken[commit_hash] = str(e)
+                continue
+            for obj_hash,kind in links:
+                if mark(obj_hash,kind,commit_hash):
+                    (commits.append(obj_hash) if kind == "commit" else frontier.append((obj_hash,kind)))
+        #marked before the trees are walked, so subtrees the bitmaps cover are not read again
+        data = covered.to_bytes((covered.bit_length() + 7) // 8,"little")
+        for byte_index,byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                visited[ids[pack.sha_at(byte_index * 8 + low.bit_length() - 1).hex()]] = 1
+                byte ^= low
+
+        def expand(items):
+            #the slice's commits and trees are fetched in one go, one by one again if any of them is broken
+            try:
+                loaded = self.get_many([obj_hash for obj_hash,kind in items if kind != "blob"])
+            except Exception:
+                loaded = {}
+            results = []
+            for obj_hash,kind in items:
+                try:
+                    results.append((obj_hash,self._object_links(obj_hash,kind,loose,loaded.get(obj_hash)),None))
+                except Exception as e:
+                    results.append((obj_hash,[],str(e)))
+            return results
+
+        workers = self.worker_count()
+        self.packs() #open the packs before the workers read from them
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while frontier:
+                #only packed blobs have nothing to read, a loose one may be a chunk manifest
+                frontier = [item for item in frontier if item[1] in ("tree","commit") or (item[1] == "blob" and item[0] in loose)]
+                next_frontier = []
+                for results in pool.map(expand,self._slices(frontier,workers)):
+                    for obj_hash,links,error in results:
+                        if error:
+                            broken[obj_hash] = error
+                        for link_hash,kind in links:
+                            if mark(link_hash,kind,obj_hash):
+                                next_frontier.append((link_hash,kind))
+                frontier = next_frontier
+        return visited,missing,broken
+
+    @staticmethod
+    def _slices(items:list,workers:int)->List[list]:
+        #a few slices per worker: one future per object costs more than reading a small object
+        step = max(64,len(items) // (workers * 4) + 1)
+        return [items[i:i + step] for i in range(0,len(items),step)]
+
+    def verify_object(self,obj_hash:str,store:ObjectStore = None,obj:GitObject = None)->str:
+        #None if the object reads back and hashes to its name, otherwise what is wrong with it
+        #store is where it is kept outside a pack (None: packed), obj the stored object if already read
+        try:
+            if store is None:
+                obj = self.load_object(obj_hash)
+                if obj.hash() != obj_hash:
+                    return f"hash mismatch, packed content hashes to {obj.hash()}"
+                return self._tree_error(obj)
+            if obj is None:
+                obj = store.get(obj_hash)
+                if obj is None:
+                    return "unreadable: object disappeared"
+            if obj.type == "chunked":
+                #named after the whole blob: hash the chunks in order (each one is verified on its own)
+                manifest = obj.content
+                chunks = [self.load_object(manifest[pos:pos + 20].hex()).content for pos in range(0,len(manifest),24)]
+                sha = hashlib.sha1(f"blob {sum(map(len,chunks))}\0".encode())
+                for chunk in chunks:
+                    sha.update(chunk)
+            else:
+                sha = hashlib.sha1(f"{obj.type} {len(obj.content)}\0".encode())
+                sha.update(obj.content)
+            if sha.hexdigest() != obj_hash:
+                return f"hash mismatch, content hashes to {sha.hexdigest()}"
+            return self._tree_error(obj)
+        except Exception as e:
+            return f"unreadable: {e}"
+
+    @staticmethod
+    def _tree_error(obj:GitObject)->str:
+        #a tree naming the same entry twice (a file and a directory `p`) can't be checked out
+        if obj.type != "tree":
+            return None
+        names = [name for _,name,_ in Tree.from_content(obj.content).entries]
+        if len(set(names)) != len(names):
+            return "contains duplicate file entries"
+        return None
+
+    def fsck(self,unreachable:bool = False)->bool:
+        # checks every pack checksum, every object's hash and that everything reachable is present
+        loose = self.loose_objects()
+        ids = self.object_ids(loose)
+        errors = 0
+        for pack in self.packs():
+            #hashed straight from the mapping, slicing pack.data would copy the whole pack into memory
+            if hashlib.sha1(pack.view[:-20]).digest() != pack.data[-20:]:
+                print(f"error: {pack.pack_path.name}: pack checksum mismatch")
+                errors += 1
+        #the graph is derived data, fsck walks the commit objects themselves
+        visited,missing,broken = self.reachable_objects(ids,loose,use_graph = False)
+
+        def check(hashes:List[str]):
+            #one get_many per store for the slice, a broken object makes it fall back to one by one
+            stored = {}
+            for store in self.object_stores():
+                try:
+                    stored.update(store.get_many([obj_hash for obj_hash in hashes if loose.get(obj_hash) is store]))
+                except Exception:
+                    pass
+            return [(obj_hash,self.verify_object(obj_hash,loose.get(obj_hash),stored.get(obj_hash))) for obj_hash in hashes]
+
+        workers = self.worker_count()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for results in pool.map(check,self._slices(list(ids),workers)):
+                for obj_hash,error in results:
+                    if error:
+                        broken.setdefault(obj_hash,error)
+        for obj_hash,error in sorted(broken.items()):
+            print(f"error: {obj_hash}: {error}")
+        for obj_hash,(kind,referrer) in sorted(missing.items()):
+            print(f"missing {kind} {obj_hash} (referenced by {referrer})")
+        dangling = [obj_hash for obj_hash,i in ids.items() if not visited[i]]
+        if unreachable:
+            for obj_hash in sorted(dangling):
+                print(f"unreachable {obj_hash}")
+        errors += len(broken) + len(missing)
+        print(f"Checked {len(ids)} objects: {len(ids) - len(dangling)} reachable, {len(dangling)} unreachable, {errors} errors")
+        return errors == 0
+
+    @traced("prune")
+    def prune(self,expire:float = None,dry_run:bool = False)->int:
+        # deletes loose objects nothing reaches that are older than the grace period (gc.pruneExpire seconds)
+        # younger ones may belong to an add or commit still in progress, packed objects are left to repack
+        if expire is None:
+            expire = float(self.get_config("gc.pruneExpire",14 * 24 * 3600))
+        cutoff = time.time() - expire
+        loose = self.loose_objects()
+        ids = self.object_ids(loose)
+        visited,_,broken = self.reachable_objects(ids,loose)
+        if broken:
+            #an unreadable tree hides what it references, deleting anything now could lose data
+            raise ValueError(f"refusing to prune, {len(broken)} objects could not be read; run fsck")
+        pruned = 0
+        freed = 0
+        for store in self.object_stores():
+            unreachable = [obj_hash for obj_hash,owner in loose.items() if owner is store and not visited[ids[obj_hash]]]
+            expired = []
+            for obj_hash,(mtime,size) in store.stat_many(unreachable).items():
+                if mtime >= cutoff:
+                    continue
+                expired.append(obj_hash)
+                pruned += 1
+                freed += size
+                if dry_run:
+                    print(f"{obj_hash} {size}")
+            if not dry_run:
+                store.delete_many(expired)
+            store.cleanup(cutoff,dry_run)
+        print(f"{'Would prune' if dry_run else 'Pruned'} {pruned} unreachable objects ({freed} bytes)")
+        return pruned
+
+    def repack(self,window:int = 10,max_depth:int = 50):
+        # gather loose objects and existing packs, write everything into one pack, then drop the old copies
+        objects = {}  # hash -> (type,content)
+        packed = [] # (store,hashes) to delete once the pack is written
+        for store in self.object_stores():
+            stored = store.hashes()
+            #copies of what an earlier store had (loose files left from before core.objectStore changed)
+            #are not read again, they go with the rest once the pack is written
+            hashes = [obj_hash for obj_hash in stored if obj_hash in objects]
+            for obj_hash,obj in store.get_many([obj_hash for obj_hash in stored if obj_hash not in objects]).items():
+                #chunked blobs stay loose, packing them whole would undo the chunk sharing
+                if obj.type in ("chunk","chunked"):
+                    continue
+                objects[obj_hash] = (obj.type,obj.content)
+                hashes.append(obj_hash)
+            packed.append((store,hashes))
+        old_packs = self.packs()
+        for pack in old_packs:
+            for obj_hash in pack.hashes():
+                if obj_hash not in objects:
+                    obj = pack.load(obj_hash)
+                    objects[obj_hash] = (obj.type,obj.content)
+        if not objects:
+            print("Nothing to pack")
+            return None
+
+        #same type, same file name, biggest first: good delta bases end up inside each other's window
+        names = self._object_names()
+        order = sorted(objects,key=lambda h: (objects[h][0],names.get(h,""),-len(objects[h][1])))
+        writer = PackWriter(self.pack_dir)
+        candidates = deque(maxlen=window)
+        indexes = {} #delta_index of each candidate, built the first time it is tried as a base
+        depth = {}
+        delta_count = 0
+        try:
+            for obj_hash in order:
+                obj_type,content = objects[obj_hash]
+                if candidates and objects[candidates[-1]][0] != obj_type:
+                    candidates.clear()
+                    indexes.clear()
+                best_base = best_delta = None
+                if obj_type != "commit" and len(content) > DELTA_BLOCK:
+                    limit = len(content) // 2 #not worth it if we don't save at least half
+                    for base_hash in candidates:
+                        if depth.get(base_hash,0) >= max_depth:
+                            continue
+                        with TRACE.phase("delta search"):
+                            base = objects[base_hash][1]
+                            if base_hash not in indexes:
+                                indexes[base_hash] = delta_index(base)
+                            delta = create_delta(base,content,limit,indexes[base_hash])
+                        if delta is not None and len(delta) < limit:
+                            best_base,best_delta,limit = base_hash,delta,len(delta)
+                with TRACE.phase("pack write"):
+                    if best_base:
+                        writer.add(obj_hash,obj_type,content,best_base,best_delta)
+                        depth[obj_hash] = depth.get(best_base,0) + 1
+                        delta_count += 1
+                    else:
+                        writer.add(obj_hash,obj_type,content)
+                if candidates and len(candidates) == window:
+                    indexes.pop(candidates[0],None) #about to leave the window
+                candidates.append(obj_hash)
+            with TRACE.phase("pack write"):
+                pack_path = writer.finish()
+        except BaseException:
+            writer.abort()
+            raise
+
+        #everything is safely in the new pack, remove what it replaces
+        self.close_packs()
+        for pack in old_packs:
+            if pack.pack_path != pack_path:
+                pack.pack_path.unlink(missing_ok=True)
+                pack.idx_path.unlink(missing_ok=True)
+                pack.pack_path.with_suffix(".bitmap").unlink(missing_ok=True)
+        for store,hashes in packed:
+            store.delete_many(hashes)
+        print(f"Packed {len(objects)} objects ({delta_count} deltas) into {pack_path.name}")
+        if self.get_config("pack.writeBitmaps",True):
+            pack = next(pack for pack in self.packs() if pack.pack_path == pack_path)
+            count = self.write_bitmap(pack)
+            if count:
+                print(f"Wrote bitmaps for {count} commits")
+        return pack_path
+
+    def gc(self):
+        self.pack_refs()
+        #before repack, so unreachable objects past the grace period don't get packed
+        self.prune()
+        self.repack()
+        count = self.write_commit_graph()
+        if count:
+            print(f"Wrote commit-graph with {count} commits")
+
+
+class Benchmark:
+    # pygit bench: builds a synthetic repository and times add/commit/status/checkout/log/diff on it
+    # every operation gets a fresh Repository, like a separate CLI run, and records its TRACE phases
+    # results can be saved as json and compared against an earlier run to catch regressions
+    AUTHOR = "PyGit bench <bench@pygit.com>"
+
+    def __init__(self,args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.results: Dict[str,Dict[str,object]] = {}
+        #file contents are slices of one text made of random words: compresses and deltifies like source code
+        words = ["".join(self.rnd.choice("abcdefghijklmnopqrstuvwxyz_") for _ in range(self.rnd.randint(2,10))) for _ in range(4000)]
+        text = " ".join(self.rnd.choice(words) + ("\n" if self.rnd.random() < 0.12 else "") for _ in range(250000)).encode()
+        self.text = text + text
+        self.path = None
+        self.files: List[str] = []
+        #mtimes handed out by modify(), one second apart and an hour back
+        self.mtime = time.time_ns() - 3600 * 10**9
+
+    def content(self)->bytes:
+        #log-normal sizes around --size: mostly small files with a long tail of big ones
+        size = min(int(self.rnd.lognormvariate(math.log(self.args.size),1.0)),self.args.max_size,len(self.text) // 2)
+        start = self.rnd.randrange(len(self.text) // 2)
+        return self.text[start:start + size]
+
+    def generate(self):
+        dirs = set()
+        for i in range(self.args.files):
+            depth = self.rnd.randint(0,self.args.depth)
+            parts = [f"dir{self.rnd.randrange(self.args.width)}" for _ in range(depth)]
+            self.files.append("/".join(parts + [f"file{i}.txt"]))
+            dirs.add("/".join(parts))
+        for dir_path in dirs:
+            (self.path / dir_path).mkdir(parents=True,exist_ok=True)
+        for rel_path in self.files:
+            (self.path / rel_path).write_bytes(self.content())
+
+    def modify(self,count:int):
+        #each round's files get an mtime no index entry has, even on coarse timestamp filesystems, and old
+        #enough not to be racy; no sleeping, modify() also runs inside measured operations
+        self.mtime -= 10**9
+        for rel_path in self.rnd.sample(self.files,min(count,len(self.files))):
+            (self.path / rel_path).write_bytes(self.content())
+            os.utime(self.path / rel_path,ns=(self.mtime,self.mtime))
+
+    def churn(self)->int:
+        return max(1,int(len(self.files) * self.args.churn))
+
+    def measure(self,name:str,func):
+        repo = Repository(self.path)
+        TRACE.reset()
+        TRACE.enabled = True
+        start = time.perf_counter()
+        try:
+            with redirect_stdout(io.StringIO()):
+                func(repo)
+        finally:
+            wall = time.perf_counter() - start
+            TRACE.enabled = False
+            repo.close_async()
+        self.results[name] = {"wall":wall,"phases":dict(TRACE.times),"counters":dict(TRACE.counters)}
+        top = sorted(TRACE.times.items(),key=lambda item: -item[1])[:3]
+        print(f"{name:<24}{wall * 1000:>10.1f}   " + "  ".join(f"{phase} {seconds * 1000:.1f}" for phase,seconds in top))
+        if self.args.verbose:
+            TRACE.report(sys.stdout)
+            print()
+
+    def run(self)->bool:
+        args = self.args
+        self.path = Path(args.dir or tempfile.mkdtemp(prefix="pygit-bench-")).resolve()
+        self.path.mkdir(parents=True,exist_ok=True)
+        try:
+            with redirect_stdout(io.StringIO()):
+                Repository(self.path).init()
+            repo = Repository(self.path)
+            for setting in args.config:
+                key,_,value = setting.partition("=")
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+                repo.set_config(key,value)
+            self.generate()
+            print(f"{args.files} files, depth {args.depth}, {args.commits} commits, {args.branches} branches in {self.path}")
+            print(f"{'operation':<24}{'wall ms':>10}   top phases (ms)")
+
+            def add_all(repo:Repository):
+                with repo.index_lock():
+                    index = repo.load_index()
+                    repo.add_path(".",index)
+                    repo.save_index(index)
+
+            self.measure("add (initial)",add_all)
+            self.measure("commit (initial)",lambda repo: repo.commit("initial",self.AUTHOR))
+            self.measure("status (clean)",lambda repo: repo.status())
+            self.modify(self.churn())
+            self.measure("status (modified)",lambda repo: repo.status())
+            self.measure("add (modified)",add_all)
+            self.measure("commit (modified)",lambda repo: repo.commit("modified",self.AUTHOR))
+
+            def history(repo:Repository):
+                for i in range(args.commits - 2):
+                    self.modify(self.churn())
+                    add_all(repo)
+                    repo.commit(f"change {i}",self.AUTHOR)
+            if args.commits > 2:
+                self.measure(f"history ({args.commits - 2} commits)",history)
+
+            branches = [f"branch{i}" for i in range(args.branches)]
+
+            def fan_out(repo:Repository):
+                for branch in branches:
+                    repo.checkout(branch,True)
+                    self.modify(self.churn())
+                    add_all(repo)
+                    repo.commit(f"work on {branch}",self.AUTHOR)
+                repo.checkout("master",False)
+            if branches:
+                self.measure(f"branches ({len(branches)})",fan_out)
+
+                def switch(repo:Repository):
+                    for branch in branches + ["master"]:
+                        repo.checkout(branch,False)
+                self.measure(f"checkout ({len(branches) + 1})",switch)
+
+            self.measure("log",lambda repo: repo.log(args.commits + 1))
+            repo = Repository(self.path)
+            head = repo.get_branch_commit("master")
+            first = head
+            while repo.commit_parents(first):
+                first = repo.commit_parents(first)[0]
+            self.measure("diff (first..last)",lambda repo: repo.diff([first,head],False))
+            path = min(repo.load_index())
+            self.measure("log -- path",lambda repo: repo.log(args.commits + 1,[path]))
+            if args.gc:
+                self.measure("gc",lambda repo: repo.gc())
+                self.measure("status (packed)",lambda repo: repo.status())
+                self.measure("log (packed)",lambda repo: repo.log(args.commits + 1))
+        finally:
+            if not args.dir and not args.keep:
+                shutil.rmtree(self.path,ignore_errors=True)
+
+        if args.json:
+            result = {"params":{key:value for key,value in vars(args).items() if key not in ("command","json","compare")},"operations":self.results}
+            Path(args.json).write_text(json.dumps(result,indent=2,sort_keys=True))
+        if args.compare:
+            return self.compare(json.loads(Path(args.compare).read_text()))
+        return True
+
+    def compare(self,baseline:Dict[str,object])->bool:
+        # wall time of every operation against the baseline run, slower by more than --threshold % fails
+        print(f"\n{'operation':<24}{'base ms':>10}{'now ms':>10}{'change':>9}")
+        ok = True
+        for name,result in self.results.items():
+            base = baseline["operations"].get(name)
+            if not base:
+                continue
+            change = (result["wall"] - base["wall"]) / base["wall"] * 100 if base["wall"] else 0
+            #a millisecond either way is noise, not a regression
+            regressed = change > self.args.threshold and result["wall"] - base["wall"] > 0.001
+            ok = ok and not regressed
+            print(f"{name:<24}{base['wall'] * 1000:>10.1f}{result['wall'] * 1000:>10.1f}{change:>+8.1f}%{'  REGRESSION' if regressed else ''}")
+        return ok
+
                 
 def main():
     parser = argparse.ArgumentParser(
         description="PyGit -A simple git clone!"
     )
+    parser.add_argument("--profile",action="store_true",help="Print per-phase timings to stderr (also PYGIT_PROFILE=1)")
     subparsers = parser.add_subparsers(dest="command",help="Availaible commands")
 
     # init command
@@ -741,16 +5922,100 @@ def main():
     #log command
     log_parser = subparsers.add_parser("log",help="Show commit history")
     log_parser.add_argument("-n","--max-count",type=int,default=10,help="Limit commits shown")
+    log_parser.add_argument("paths",nargs="*",help="Only show commits that changed these paths (after --)")
 
     #status command
     status_parser = subparsers.add_parser("status", help="Show repository status")
 
+    #diff command
+    diff_parser = subparsers.add_parser("diff",help="Show changes between the working tree, the index and commits")
+    diff_parser.add_argument("commits",nargs="*",help="Two commits to compare")
+    diff_parser.add_argument("--cached",action="store_true",help="Compare the index with HEAD")
+
+    #merge command
+    merge_parser = subparsers.add_parser("merge",help="Join another branch into the current one")
+    merge_parser.add_argument("branch",help="Branch name or commit hash to merge")
+    merge_parser.add_argument("--author",help="Author name and email")
+
+    #fast-import command
+    fast_import_parser = subparsers.add_parser("fast-import",help="Import commits and files from a fast-import stream on stdin")
+
+    #config command
+    config_parser = subparsers.add_parser("config",help="Get or set repository options")
+    config_parser.add_argument("key",help="Option name, e.g. core.deltaBaseCacheLimit")
+    config_parser.add_argument("value",nargs="?",help="New value, omit to print the current one")
+
+    #merge-base command
+    merge_base_parser = subparsers.add_parser("merge-base",help="Find the best common ancestor of two commits")
+    merge_base_parser.add_argument("commits",nargs=2,help="Branch names or commit hashes")
+    merge_base_parser.add_argument("--is-ancestor",action="store_true",help="Exit with 0 if the first commit is an ancestor of the second, 1 otherwise")
+
+    #commit-graph command
+    commit_graph_parser = subparsers.add_parser("commit-graph",help="Write the commit-graph file")
+    commit_graph_parser.add_argument("action",choices=["write"])
+
+    #fsmonitor command
+    fsmonitor_parser = subparsers.add_parser("fsmonitor",help="Run a daemon that tracks changed files for status")
+    fsmonitor_parser.add_argument("action",choices=["start","stop","status","run"])
+
+    #sparse-checkout command
+    sparse_parser = subparsers.add_parser("sparse-checkout",help="Only check out some directories (cone mode)")
+    sparse_parser.add_argument("action",choices=["set","add","list","disable","reapply"],help="reapply also picks up a changed index.sparse")
+    sparse_parser.add_argument("dirs",nargs="*",help="Directories to check out with everything under them")
+
+    #gc / repack commands
+    gc_parser = subparsers.add_parser("gc",help="Cleanup and optimize the repository")
+    pack_refs_parser = subparsers.add_parser("pack-refs",help="Move loose branches into the packed-refs file")
+    clone_parser = subparsers.add_parser("clone",help="Copy a repository and check out its HEAD branch")
+    clone_parser.add_argument("url",help="Path of the repository to clone")
+    clone_parser.add_argument("directory",nargs="?",help="Where to create the clone")
+    clone_parser.add_argument("--mirror",action="store_true",help="Copy the branches as they are, check nothing out")
+    clone_parser.add_argument("--upload-pack",help="Command that serves the repository, the url is appended to it")
+    fetch_parser = subparsers.add_parser("fetch",help="Download the objects and branches of another repository")
+    fetch_parser.add_argument("remote",nargs="?",default="origin",help="Configured remote or repository path")
+    fetch_parser.add_argument("--upload-pack",help="Command that serves the repository, the url is appended to it")
+    upload_pack_parser = subparsers.add_parser("upload-pack",help="Serve fetch and clone over stdin/stdout")
+    upload_pack_parser.add_argument("path",help="Repository to serve")
+    bench_parser = subparsers.add_parser("bench",help="Time the main commands on a generated repository")
+    bench_parser.add_argument("--files",type=int,default=2000,help="Number of files")
+    bench_parser.add_argument("--depth",type=int,default=3,help="Maximum directory depth")
+    bench_parser.add_argument("--width",type=int,default=6,help="Directories per level")
+    bench_parser.add_argument("--size",type=int,default=2048,help="Median file size in bytes (log-normal)")
+    bench_parser.add_argument("--max-size",type=int,default=1 << 20,help="Largest file size in bytes")
+    bench_parser.add_argument("--commits",type=int,default=10,help="Length of the history")
+    bench_parser.add_argument("--churn",type=float,default=0.01,help="Fraction of the files each commit changes")
+    bench_parser.add_argument("--branches",type=int,default=3,help="Branches forked from master")
+    bench_parser.add_argument("--seed",type=int,default=1,help="Random seed, the same seed builds the same repository")
+    bench_parser.add_argument("-c","--config",action="append",default=[],help="key=value set in the generated repository")
+    bench_parser.add_argument("--gc",action="store_true",help="Also time gc and the packed repository")
+    bench_parser.add_argument("--dir",help="Build the repository here and keep it")
+    bench_parser.add_argument("--keep",action="store_true",help="Keep the generated repository")
+    bench_parser.add_argument("--json",help="Write the results to this file")
+    bench_parser.add_argument("--compare",help="Compare with the results of an earlier --json run")
+    bench_parser.add_argument("--threshold",type=float,default=10.0,help="Percent slower that counts as a regression")
+    bench_parser.add_argument("-v","--verbose",action="store_true",help="Print every phase of every operation")
+    rev_list_parser = subparsers.add_parser("rev-list",help="List the commits (or objects) reachable from commits")
+    rev_list_parser.add_argument("commits",nargs="+",help="Branches or commit hashes")
+    rev_list_parser.add_argument("--objects",action="store_true",help="Include trees and blobs")
+    rev_list_parser.add_argument("--count",action="store_true",help="Only print how many there are")
+    fsck_parser = subparsers.add_parser("fsck",help="Verify object hashes and the connectivity of the object graph")
+    fsck_parser.add_argument("--unreachable",action="store_true",help="List objects no ref or index entry reaches")
+    prune_parser = subparsers.add_parser("prune",help="Delete unreachable loose objects older than the grace period")
+    prune_parser.add_argument("--expire",type=float,help="Grace period in seconds (default gc.pruneExpire, two weeks)")
+    prune_parser.add_argument("-n","--dry-run",action="store_true",help="List what would be deleted")
+    repack_parser = subparsers.add_parser("repack",help="Pack loose objects into a delta compressed packfile")
+    repack_parser.add_argument("--window",type=int,default=10,help="Number of objects considered as delta bases")
+    repack_parser.add_argument("--depth",type=int,default=50,help="Maximum delta chain length")
+
     args = parser.parse_args()
 
     if not args.command:
         parser.print_help()
         return
     repo = Repository()
+    if args.profile or os.environ.get("PYGIT_PROFILE"):
+        TRACE.enabled = True
+    start = time.perf_counter()
     try:
         if args.command == "init":
             # Call the function and check if it failed.
@@ -761,8 +6026,12 @@ def main():
             if not repo.get_dir.exists():
                 print("Not a git repository")  
                 return
-            for path in args.paths:
-                repo.add_path(path) 
+            #load and write the index once for all paths, under one index.lock
+            with repo.index_lock():
+                index = repo.load_index()
+                for path in args.paths:
+                    repo.add_path(path,index)
+                repo.save_index(index)
         elif args.command == "commit":
             if not repo.get_dir.exists():
                 print("Not a git repository")  
@@ -783,16 +6052,138 @@ def main():
             if not repo.get_dir.exists():
                 print("Not a git repository")
                 return
-            repo.log(args.max_count)
+            repo.log(args.max_count,args.paths)
         elif args.command == "status":
             if not repo.get_dir.exists():
                 print("Not a git repository")
                 return
             repo.status()
+        elif args.command == "diff":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            repo.diff(args.commits,args.cached)
+        elif args.command == "merge":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            repo.merge(args.branch,args.author or "PyGit user <user@pygit.com>")
+        elif args.command == "fast-import":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            repo.fast_import(sys.stdin.buffer)
+        elif args.command == "config":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            if args.value is None:
+                value = repo.get_config(args.key)
+                if value is not None:
+                    print(value)
+            else:
+                #store numbers and booleans as such so callers don't have to parse them
+                try:
+                    value = json.loads(args.value)
+                except ValueError:
+                    value = args.value
+                repo.set_config(args.key,value)
+        elif args.command == "merge-base":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            first,second = (repo.resolve_commit(name) for name in args.commits)
+            if args.is_ancestor:
+                sys.exit(0 if repo.is_ancestor(first,second) else 1)
+            bases = repo.merge_bases(first,second)
+            if not bases:
+                sys.exit(1)
+            for base in bases:
+                print(base)
+        elif args.command == "commit-graph":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            print(f"Wrote commit-graph with {repo.write_commit_graph()} commits")
+        elif args.command == "fsmonitor":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            if args.action == "run":
+                FSMonitor(repo).run()
+            elif args.action == "start":
+                print("fsmonitor started" if repo.start_fsmonitor() else "fsmonitor is already running")
+            elif args.action == "stop":
+                print("fsmonitor stopped" if repo.stop_fsmonitor() else "fsmonitor is not running")
+            else:
+                reply = repo.fsmonitor_request({"command":"status"})
+                if reply:
+                    print(f"fsmonitor running ({reply['backend']}), {reply['paths']} paths changed, token {reply['token']}")
+                else:
+                    print("fsmonitor is not running")
+        elif args.command == "sparse-checkout":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            repo.sparse_checkout(args.action,args.dirs)
+        elif args.command == "gc":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            repo.gc()
+        elif args.command == "pack-refs":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            print(f"Packed {repo.pack_refs()} refs")
+        elif args.command == "clone":
+            Repository.clone(args.url,args.directory,args.mirror,args.upload_pack)
+        elif args.command == "fetch":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            repo.fetch(args.remote,args.upload_pack)
+        elif args.command == "upload-pack":
+            #stdout is the protocol stream, errors go to stderr
+            server = Repository(args.path)
+            if not server.get_dir.exists():
+                sys.stderr.write(f"{args.path} is not a git repository\n")
+                sys.exit(1)
+            server.upload_pack(sys.stdin.buffer,sys.stdout.buffer)
+        elif args.command == "bench":
+            if not Benchmark(args).run():
+                sys.exit(1)
+        elif args.command == "rev-list":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            repo.rev_list(args.commits,args.objects,args.count)
+        elif args.command == "fsck":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            if not repo.fsck(args.unreachable):
+                sys.exit(1)
+        elif args.command == "prune":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            repo.prune(args.expire,args.dry_run)
+        elif args.command == "repack":
+            if not repo.get_dir.exists():
+                print("Not a git repository")
+                return
+            repo.repack(args.window,args.depth)
 
 
     except Exception as e:
-        print(f"Error: {e}")
+        #upload-pack's stdout belongs to the protocol
+        print(f"Error: {e}",file=sys.stderr if args.command == "upload-pack" else sys.stdout)
         sys.exit(1)
+    finally:
+        repo.close_async()
+        if TRACE.enabled:
+            extra = {"delta cache":repo._delta_cache.stats()} if repo._delta_cache is not None else None
+            TRACE.report(sys.stderr,time.perf_counter() - start,extra)
 
 main()
\ No newline at end of file
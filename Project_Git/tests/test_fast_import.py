@@ -0,0 +1,80 @@
+import subprocess,sys,tempfile,unittest
+from pathlib import Path
+
+MAIN = Path(__file__).resolve().parent.parent / "main.py"
+
+#what `git fast-export -M -C` writes for names it has to quote: octal bytes of the UTF-8 name and C escapes
+FIRST_COMMIT = b'''blob
+mark :1
+data 2
+q
+
+blob
+mark :2
+data 2
+x
+
+blob
+mark :3
+data 2
+e
+
+commit refs/heads/imported
+mark :4
+author a <a@b> 1700000000 +0000
+committer a <a@b> 1700000000 +0000
+data 4
+one
+M 100644 :1 "a \\"q\\".txt"
+M 100644 :2 "d ir/t\\tab.txt"
+M 100644 :3 "\\303\\251.txt"
+
+'''
+
+SECOND_COMMIT = b'''commit refs/heads/imported
+mark :5
+author a <a@b> 1700000001 +0000
+committer a <a@b> 1700000001 +0000
+data 4
+two
+from :4
+R "a \\"q\\".txt" "b \\"q\\".txt"
+C "\\303\\251.txt" "copy of \\303\\251.txt"
+D "d ir/t\\tab.txt"
+
+'''
+
+
+class FastImportQuotedPathsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        self.pygit("init")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def pygit(self,*args,stdin:bytes = None)->str:
+        result = subprocess.run([sys.executable,str(MAIN),*args],cwd=self.path,input=stdin,capture_output=True)
+        self.assertEqual(result.returncode,0,result.stdout + result.stderr)
+        return result.stdout.decode()
+
+    def files(self)->set:
+        return {path.relative_to(self.path).as_posix() for path in self.path.rglob("*") if path.is_file() and ".pygit" not in path.parts}
+
+    def test_quoted_names_round_trip(self):
+        self.assertIn("Imported 3 blobs and 2 commits",self.pygit("fast-import",stdin=FIRST_COMMIT + SECOND_COMMIT + b"done\n"))
+        self.pygit("checkout","imported")
+        self.assertEqual(self.files(),{"b \"q\".txt","é.txt","copy of é.txt"})
+        self.assertEqual((self.path / "é.txt").read_bytes(),b"e\n")
+        self.assertEqual((self.path / "copy of é.txt").read_bytes(),b"e\n")
+        self.assertEqual((self.path / "b \"q\".txt").read_bytes(),b"q\n")
+
+    def test_first_commit_keeps_escaped_characters(self):
+        self.pygit("fast-import",stdin=FIRST_COMMIT + b"done\n")
+        self.pygit("checkout","imported")
+        self.assertEqual(self.files(),{"a \"q\".txt","d ir/t\tab.txt","é.txt"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import os,subprocess,sys,tempfile,time,unittest
+from pathlib import Path
+
+MAIN = Path(__file__).resolve().parent.parent / "main.py"
+
+
+class FSMonitorStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name)
+        self.pygit("init")
+        (self.path / "run.sh").write_text("echo hi\n")
+        self.pygit("add","run.sh")
+        self.pygit("commit","-m","initial")
+        self.assertIn("fsmonitor started",self.pygit("fsmonitor","start"))
+
+    def tearDown(self):
+        self.pygit("fsmonitor","stop")
+        self.tmp.cleanup()
+
+    def pygit(self,*args)->str:
+        result = subprocess.run([sys.executable,str(MAIN),*args],cwd=self.path,capture_output=True)
+        self.assertEqual(result.returncode,0,result.stdout + result.stderr)
+        return result.stdout.decode()
+
+    def status_after_event(self)->str:
+        #the daemon reports what it has seen by the time it is asked, give it a moment to read the event
+        time.sleep(0.5)
+        return self.pygit("status")
+
+    def test_chmod_is_reported_while_fsmonitor_runs(self):
+        self.assertNotIn("modified",self.pygit("status"))
+        os.chmod(self.path / "run.sh",0o755)
+        self.assertIn("modified: run.sh",self.status_after_event())
+        #the second status only looks at what fsmonitor reports, the chmod must still be there
+        self.assertIn("modified: run.sh",self.pygit("status"))
+        os.chmod(self.path / "run.sh",0o644)
+        self.assertNotIn("modified",self.status_after_event())
+
+
+if __name__ == "__main__":
+    unittest.main()